@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from glob import glob
+from os.path import (join as pjoin,
+                     dirname as pdirname,
+                     basename as pbasename,
+                     abspath as pabspath,
+                     exists as pexists,
+                     )
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import synthetic
+
+
+# Timed in the python/ folder of the qdk2 under test:
+#   argv: python_dir qpkg_dir repeat
+PARSE_TIMER = '''
+import json, sys, timeit
+sys.path.insert(0, sys.argv[1])
+from controlfiles import ControlFile, ChangelogFile
+from settings import VERSION
+times = {'control_parse': [], 'changelog_parse': []}
+for _ in range(int(sys.argv[3])):
+    for name, cls in (('control_parse', ControlFile),
+                      ('changelog_parse', ChangelogFile)):
+        f = cls(sys.argv[2])
+        start = timeit.default_timer()
+        f.parse()
+        times[name].append(timeit.default_timer() - start)
+json.dump({'version': VERSION, 'times': times}, sys.stdout)
+'''
+
+
+def log(message):
+    sys.stderr.write('[bench] {}\n'.format(message))
+
+
+def summary(runs):
+    runs = sorted(runs)
+    n = len(runs)
+    median = runs[n // 2] if n % 2 else (runs[n // 2 - 1] + runs[n // 2]) / 2
+    return {'runs': runs, 'min': runs[0], 'median': median,
+            'max': runs[-1], 'mean': sum(runs) / n}
+
+
+class Benchmark(object):
+    """Time a qdk2 checkout on a synthetic source tree
+
+    The build is run with --trace when the qdk2 under test supports it, so
+    that the time of each Cook recipe and of the other build phases comes
+    from the trace. Times are in seconds.
+    """
+    def __init__(self, qdk2, tree, work, repeat=3, jobs=1, build_args=()):
+        self._qdk2 = pabspath(qdk2)
+        self._prefix = pdirname(pdirname(self._qdk2))
+        self._tree = tree
+        self._work = work
+        self._repeat = max(1, repeat)
+        self._jobs = jobs
+        self._build_args = list(build_args)
+        self._times = defaultdict(list)
+
+    @property
+    def src(self):
+        return pjoin(self._work, 'src')
+
+    def run(self):
+        log('generate {}'.format(self.src))
+        start = default_timer()
+        size = self._tree.generate(self.src)
+        log('generated {} bytes in {:.2f}s'.format(size,
+                                                   default_timer() - start))
+        version = self._time_parse()
+        options = self._build_options()
+        for i in xrange(self._repeat):
+            log('build {}/{}'.format(i + 1, self._repeat))
+            qpkgs = self._time_build(i, options)
+            self._time_extract(i, qpkgs)
+        if '--no-cache' in options:
+            self._time_rebuild(options)
+        shape = self._tree.shape
+        shape['bytes'] = size
+        return {'qdk2': {'path': self._prefix,
+                         'version': version,
+                         'revision': self._revision()},
+                'host': {'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'cpus': multiprocessing.cpu_count()},
+                'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'shape': shape,
+                'repeat': self._repeat,
+                'jobs': self._jobs,
+                'results': dict((k, summary(v))
+                                for k, v in self._times.iteritems()),
+                }
+
+    def _qdk2_cmd(self, *args):
+        return [sys.executable, self._qdk2] + list(args)
+
+    def _env(self):
+        env = os.environ.copy()
+        # keep the cache of the user out of the measurements
+        env['QDK2_CACHE_DIR'] = pjoin(self._work, 'cache')
+        return env
+
+    def _call(self, cmd, cwd=None):
+        with open(pjoin(self._work, 'qdk2.log'), 'a') as out:
+            start = default_timer()
+            subprocess.check_call(cmd, cwd=cwd, env=self._env(), stdout=out,
+                                  stderr=subprocess.STDOUT)
+            return default_timer() - start
+
+    def _time_parse(self):
+        out = subprocess.check_output(
+            [sys.executable, '-c', PARSE_TIMER, pjoin(self._prefix, 'python'),
+             self.src, str(self._repeat)])
+        result = json.loads(out)
+        for name, runs in result['times'].iteritems():
+            self._times[name].extend(runs)
+        return result['version']
+
+    def _build_options(self):
+        """Options of the build supported by the qdk2 under test
+        """
+        usage = subprocess.check_output(self._qdk2_cmd('build', '--help'),
+                                        env=self._env())
+        options = []
+        for option in ('--no-cache', '--trace'):
+            if option in usage:
+                options.append(option)
+            else:
+                log('{} is not supported; skipped'.format(option))
+        if self._jobs > 1:
+            options.append('--jobs={}'.format(self._jobs))
+        return options
+
+    def _build_dir(self):
+        return pjoin(self._work, 'build-area')
+
+    def _build_cmd(self, options, trace):
+        cmd = self._qdk2_cmd('build', '--build-dir', self._build_dir())
+        for option in options:
+            if option == '--trace':
+                cmd.extend(['--trace', trace])
+            else:
+                cmd.append(option)
+        return cmd + self._build_args
+
+    def _time_build(self, i, options):
+        if pexists(self._build_dir()):
+            rmtree(self._build_dir())
+        trace = pjoin(self._work, 'trace-{}.json'.format(i))
+        self._times['build'].append(
+            self._call(self._build_cmd(options, trace), cwd=self.src))
+        if pexists(trace):
+            self._add_trace(trace)
+        return sorted(glob(pjoin(self._build_dir(), '*.qpkg')))
+
+    def _time_rebuild(self, options):
+        # a build with the cache, then an unchanged one reusing it
+        options = [o for o in options if o not in ('--no-cache', '--trace')]
+        for i in xrange(self._repeat + 1):
+            log('rebuild {}/{}'.format(i, self._repeat) if i else
+                'fill the cache')
+            seconds = self._call(self._build_cmd(options, None),
+                                 cwd=self.src)
+            if i:
+                self._times['rebuild'].append(seconds)
+
+    def _add_trace(self, trace):
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+        phases = defaultdict(float)
+        for event in events:
+            # the package and build spans are the sum of the others
+            if event.get('ph') != 'X' or \
+                    event.get('cat') in ('package', 'build'):
+                continue
+            key = '{}.{}'.format(event['cat'], event['name'])
+            phases[key] += event['dur'] / 1e6
+        for key, seconds in phases.iteritems():
+            self._times[key].append(seconds)
+
+    def _time_extract(self, i, qpkgs):
+        seconds = 0
+        for qpkg in qpkgs:
+            dest = pjoin(self._work, 'extract-{}'.format(i),
+                         pbasename(qpkg))
+            seconds += self._call(self._qdk2_cmd('extract', '--as-qpkg', qpkg,
+                                                 '-d', dest))
+        self._times['extract'].append(seconds)
+
+    def _revision(self):
+        try:
+            with open(os.devnull, 'w') as null:
+                return subprocess.check_output(
+                    ['git', 'describe', '--always', '--dirty'],
+                    cwd=self._prefix, stderr=null).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+def compare(baseline, report):
+    """Lines comparing the medians of report to those of baseline
+    """
+    lines = ['{:<32} {:>10} {:>10} {:>7}'.format('', 'baseline', 'current',
+                                                 'ratio')]
+    old, new = baseline['results'], report['results']
+    for name in sorted(set(old) | set(new)):
+        a = old.get(name, {}).get('median')
+        b = new.get(name, {}).get('median')
+        ratio = '{:.2f}'.format(b / a) if a and b is not None else '-'
+        lines.append('{:<32} {:>10} {:>10} {:>7}'.format(
+            name, '-' if a is None else '{:.4f}'.format(a),
+            '-' if b is None else '{:.4f}'.format(b), ratio))
+    if baseline.get('shape') != report.get('shape'):
+        lines.append('warning: the trees have different shapes')
+    return lines
+
+
+def main():
+    here = pdirname(pabspath(__file__))
+    parser = ArgumentParser(description='Time qdk2 on a synthetic source'
+                                        ' tree and report in JSON')
+    parser.add_argument('--qdk2', metavar='PATH',
+                        default=pjoin(pdirname(here), 'bin', 'qdk2'),
+                        help='bin/qdk2 of the checkout under test'
+                             ' (default: %(default)s)')
+    parser.add_argument('-n', '--repeat', metavar='N', type=int, default=3,
+                        help='runs of each measurement'
+                             ' (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='qdk2 build --jobs (default: %(default)s)')
+    parser.add_argument('--build-arg', metavar='ARG', dest='build_args',
+                        action='append', default=[],
+                        help='extra argument of qdk2 build, e.g.'
+                             ' --build-arg=--packager=python')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the report to FILE instead of stdout')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with the report in FILE')
+    parser.add_argument('--work-dir', metavar='PATH',
+                        help='keep the tree and builds in PATH'
+                             ' (default: a temporary folder, removed)')
+    synthetic.build_argparse(parser)
+    args = parser.parse_args()
+    try:
+        tree = synthetic.from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    work = args.work_dir or mkdtemp(prefix='qdk2-bench.')
+    if pexists(pjoin(work, 'src')):
+        parser.error('{} exists'.format(pjoin(work, 'src')))
+    try:
+        report = Benchmark(args.qdk2, tree, work, args.repeat, args.jobs,
+                           args.build_args).run()
+    except subprocess.CalledProcessError as e:
+        # the work folder is kept for the log
+        log('{}; see {}'.format(e, pjoin(work, 'qdk2.log')))
+        return 1
+    if not args.work_dir:
+        rmtree(work, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            for line in compare(json.load(f), report):
+                log(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from os.path import (join as pjoin,
+                     dirname as pdirname,
+                     abspath as pabspath,
+                     )
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+import json
+import os
+import subprocess
+import sys
+
+from run import log, summary
+
+
+# Runs bin/qdk2 in process, timing every import as python -X importtime
+# of Python 3 does:
+#   argv: report qdk2 args...
+IMPORT_TIMER = '''
+import __builtin__, json, os, runpy, sys, timeit
+report, qdk2 = sys.argv[1], os.path.abspath(sys.argv[2])
+sys.argv = [qdk2] + sys.argv[3:]
+_import = __builtin__.__import__
+imports = []
+stack = [0.0]
+
+def timed_import(name, *args):
+    before = set(sys.modules)
+    stack.append(0.0)
+    start = timeit.default_timer()
+    try:
+        return _import(name, *args)
+    finally:
+        elapsed = timeit.default_timer() - start
+        children = stack.pop()
+        stack[-1] += elapsed
+        new = [m for m in sys.modules
+               if m not in before and sys.modules[m] is not None]
+        if new:
+            # the module itself rather than a relative name, e.g. qdk2.build
+            name = min(new, key=len) if name not in new else name
+            imports.append((len(stack) - 1, name, elapsed - children, elapsed))
+
+__builtin__.__import__ = timed_import
+try:
+    runpy.run_path(qdk2, run_name='__main__')
+except SystemExit:
+    pass
+finally:
+    __builtin__.__import__ = _import
+    python = os.path.join(os.path.dirname(os.path.dirname(qdk2)), 'python')
+    modules = sorted(
+        name for name, m in sys.modules.items()
+        if m is not None and
+        (getattr(m, '__file__', None) or '').startswith(python + os.sep))
+    with open(report, 'w') as f:
+        json.dump({'modules': modules, 'imports': imports}, f)
+'''
+
+
+class Startup(object):
+    """Time the start of qdk2 commands against a budget
+
+    The budget maps a name to the argv of a command, the qdk2 modules it
+    may import and the median milliseconds it may take; a command importing
+    another module of qdk2, or slower than its budget times scale, is a
+    failure.
+    """
+    def __init__(self, qdk2, budget, repeat=10, scale=1.0):
+        self._qdk2 = pabspath(qdk2)
+        self._budget = budget
+        self._repeat = max(1, repeat)
+        self._scale = scale
+        self.failures = []
+
+    def run(self, work):
+        results = {}
+        for name in sorted(self._budget):
+            budget = self._budget[name]
+            log('{}: qdk2 {}'.format(name, ' '.join(budget['argv'])))
+            times = [self._time(budget['argv'])
+                     for _ in xrange(self._repeat)]
+            result = summary([t * 1000 for t in times])
+            imported = self._imports(budget['argv'],
+                                     pjoin(work, name + '.json'))
+            result.update(imported)
+            results[name] = result
+            self._check(name, budget, result)
+        return results
+
+    def _env(self):
+        env = os.environ.copy()
+        # the cold start, not the one of a qdk2 serve daemon
+        env['QDK2_NO_SERVE'] = '1'
+        return env
+
+    def _time(self, argv):
+        with open(os.devnull, 'w') as null:
+            start = default_timer()
+            subprocess.check_call([sys.executable, self._qdk2] + argv,
+                                  env=self._env(), stdout=null, stderr=null)
+            return default_timer() - start
+
+    def _imports(self, argv, report):
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call([sys.executable, '-c', IMPORT_TIMER, report,
+                                   self._qdk2] + argv,
+                                  env=self._env(), stdout=null, stderr=null)
+        with open(report) as f:
+            return json.load(f)
+
+    def _check(self, name, budget, result):
+        extra = sorted(set(result['modules']) - set(budget['modules']))
+        if extra:
+            self.failures.append('{}: imports {}'.format(name,
+                                                         ', '.join(extra)))
+        limit = budget['max_ms'] * self._scale
+        if result['median'] > limit:
+            self.failures.append('{}: {:.1f} ms, over {:.1f} ms'.format(
+                name, result['median'], limit))
+
+
+def importtime(imports):
+    """Lines in the format of python -X importtime
+    """
+    lines = ['import time: self [us] | cumulative | imported package']
+    for depth, name, self_time, cumulative in imports:
+        lines.append('import time: {:>9} | {:>10} | {}{}'.format(
+            int(self_time * 1e6), int(cumulative * 1e6), '  ' * depth, name))
+    return lines
+
+
+def main():
+    here = pdirname(pabspath(__file__))
+    parser = ArgumentParser(description='Time the start of qdk2 commands'
+                                        ' against a budget and report in'
+                                        ' JSON; exit with 1 when over it')
+    parser.add_argument('--qdk2', metavar='PATH',
+                        default=pjoin(pdirname(here), 'bin', 'qdk2'),
+                        help='bin/qdk2 of the checkout under test'
+                             ' (default: %(default)s)')
+    parser.add_argument('--budget', metavar='FILE',
+                        default=pjoin(here, 'startup-budget.json'),
+                        help='budget of the commands'
+                             ' (default: %(default)s)')
+    parser.add_argument('-n', '--repeat', metavar='N', type=int, default=10,
+                        help='runs of each command (default: %(default)s)')
+    parser.add_argument('--scale', metavar='FACTOR', type=float, default=1.0,
+                        help='allow FACTOR times the budgeted milliseconds,'
+                             ' e.g. on a slow host (default: %(default)s)')
+    parser.add_argument('--importtime', action='store_true',
+                        help='print the imports of each command as'
+                             ' python -X importtime')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the report to FILE instead of stdout')
+    args = parser.parse_args()
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    work = mkdtemp(prefix='qdk2-startup.')
+    startup = Startup(args.qdk2, budget, args.repeat, args.scale)
+    try:
+        results = startup.run(work)
+    except subprocess.CalledProcessError as e:
+        log(str(e))
+        return 1
+    finally:
+        rmtree(work, ignore_errors=True)
+
+    if args.importtime:
+        for name in sorted(results):
+            log('{}:'.format(name))
+            for line in importtime(results[name]['imports']):
+                log(line)
+    report = {'qdk2': pdirname(pdirname(pabspath(args.qdk2))),
+              'python': sys.version.split()[0],
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    for name in sorted(results):
+        log('{:<16} {:>8.1f} ms'.format(name, results[name]['median']))
+    for failure in startup.failures:
+        log('FAIL ' + failure)
+    return 1 if startup.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from os import makedirs, chmod
+from os.path import (join as pjoin,
+                     exists as pexists,
+                     )
+from time import gmtime, strftime
+import json
+import math
+import random
+import sys
+
+
+# 2014-10-15, the date of the demo sample
+BASE_EPOCH = 1413356253
+SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+RULES = '''#!/usr/bin/make -f
+
+build:
+
+binary:
+
+clean:
+'''
+
+
+def parse_size(value):
+    """'4096', '64k' or '2M' as bytes
+    """
+    value = value.strip().lower()
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+class SizeDistribution(object):
+    """File sizes: fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA
+    """
+    KINDS = ('fixed', 'uniform', 'lognormal')
+
+    def __init__(self, spec):
+        fields = spec.split(':')
+        self.kind = fields[0]
+        arity = {'fixed': 2, 'uniform': 3, 'lognormal': 3}
+        if self.kind not in self.KINDS or len(fields) != arity[self.kind]:
+            raise ValueError('{}: expected fixed:SIZE, uniform:MIN:MAX or'
+                             ' lognormal:MEDIAN:SIGMA'.format(spec))
+        if self.kind == 'lognormal':
+            self.params = (parse_size(fields[1]), float(fields[2]))
+        else:
+            self.params = tuple(parse_size(f) for f in fields[1:])
+        self.spec = spec
+
+    def sample(self, rand):
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rand.randint(*self.params)
+        median, sigma = self.params
+        return int(rand.lognormvariate(math.log(max(median, 1)), sigma))
+
+
+class SyntheticTree(object):
+    """A QDK2 source tree of the given shape, the same for the same seed
+
+    Every package installs files_per_package files from install_lines
+    directories (one line of QNAP/<package>.install each), plus one
+    configuration file per level of an etc/ tree etc_depth deep. File
+    contents are text drawn from a 64 KiB pool, so they compress about as
+    well as sources and scripts do.
+    """
+    def __init__(self, packages=4, install_lines=8, files_per_package=200,
+                 sizes='lognormal:8k:1.5', etc_depth=3,
+                 changelog_entries=50, seed=0):
+        self.packages = packages
+        self.install_lines = max(1, install_lines)
+        self.files_per_package = files_per_package
+        self.sizes = SizeDistribution(sizes)
+        self.etc_depth = etc_depth
+        self.changelog_entries = max(1, changelog_entries)
+        self.seed = seed
+
+    @property
+    def shape(self):
+        return {'packages': self.packages,
+                'install_lines': self.install_lines,
+                'files_per_package': self.files_per_package,
+                'sizes': self.sizes.spec,
+                'etc_depth': self.etc_depth,
+                'changelog_entries': self.changelog_entries,
+                'seed': self.seed,
+                }
+
+    def package_names(self):
+        return ['bench-p{:03d}'.format(i) for i in xrange(self.packages)]
+
+    def generate(self, dest):
+        """Write the tree to dest; return its total size in bytes
+        """
+        self._rand = random.Random(self.seed)
+        self._pool = ''.join(self._rand.choice('abcdefghij klmnop\n')
+                             for _ in xrange(1 << 16))
+        self._bytes = 0
+        self._mkdir(pjoin(dest, 'QNAP'))
+        self._write_control(dest)
+        self._write_changelog(dest)
+        with open(pjoin(dest, 'QNAP', 'rules'), 'w') as f:
+            f.write(RULES)
+        chmod(pjoin(dest, 'QNAP', 'rules'), 0755)
+        for name in self.package_names():
+            self._write_package(dest, name)
+        return self._bytes
+
+    def _write_control(self, dest):
+        sections = ['Source: bench\n'
+                    'Maintainer: Developer <developer@qnap.com>\n']
+        for name in self.package_names():
+            sections.append('Package: {0}\n'
+                            'Architecture: all\n'
+                            'Q-AppName: {0}\n'
+                            'Description: Synthetic package {0}\n'
+                            ' Generated by benchmarks/synthetic.py.\n'
+                            .format(name))
+        with open(pjoin(dest, 'QNAP', 'control'), 'w') as f:
+            f.write('\n'.join(sections))
+
+    def _write_changelog(self, dest):
+        with open(pjoin(dest, 'QNAP', 'changelog'), 'w') as f:
+            for i in xrange(self.changelog_entries, 0, -1):
+                date = gmtime(BASE_EPOCH - (self.changelog_entries - i) *
+                              86400)
+                f.write('bench (1.{})\n\n'
+                        '  * Change {}\n\n'
+                        ' -- Developer <developer@qnap.com>  {}\n\n'
+                        .format(i, i, strftime('%a, %d %b %Y %H:%M:%S +0000',
+                                               date)))
+
+    def _write_package(self, dest, name):
+        lines = []
+        for i in xrange(self.install_lines):
+            src = pjoin('data', name, 'd{:03d}'.format(i))
+            self._mkdir(pjoin(dest, src))
+            lines.append('{} usr/share/{}/'.format(src, name))
+        for i in xrange(self.files_per_package):
+            self._write_file(pjoin(dest, 'data', name,
+                                   'd{:03d}'.format(i % self.install_lines),
+                                   'f{:05d}.txt'.format(i)))
+        if self.etc_depth > 0:
+            src = pjoin('conf', name)
+            path = pjoin(dest, src, name)
+            for level in xrange(self.etc_depth):
+                path = pjoin(path, 'l{}'.format(level))
+                self._mkdir(path)
+                self._write_file(pjoin(path, 'app.conf'))
+            lines.append('{}/{} etc/'.format(src, name))
+        with open(pjoin(dest, 'QNAP', name + '.install'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _write_file(self, path):
+        size = self.sizes.sample(self._rand)
+        offset = self._rand.randrange(len(self._pool))
+        with open(path, 'w') as f:
+            left = size
+            while left > 0:
+                chunk = self._pool[offset:offset + left]
+                f.write(chunk)
+                left -= len(chunk)
+                offset = 0
+        self._bytes += size
+
+    def _mkdir(self, path):
+        if not pexists(path):
+            makedirs(path)
+
+
+def build_argparse(parser):
+    """Arguments of the tree shape, shared with run.py
+    """
+    group = parser.add_argument_group('tree shape')
+    group.add_argument('--packages', metavar='N', type=int, default=4,
+                       help='packages in QNAP/control (default: %(default)s)')
+    group.add_argument('--install-lines', metavar='N', type=int, default=8,
+                       help='lines of each QNAP/<package>.install'
+                            ' (default: %(default)s)')
+    group.add_argument('--files', metavar='N', type=int, default=200,
+                       dest='files_per_package',
+                       help='files installed by each package'
+                            ' (default: %(default)s)')
+    group.add_argument('--sizes', metavar='SPEC',
+                       default='lognormal:8k:1.5',
+                       help='file sizes: fixed:SIZE, uniform:MIN:MAX or'
+                            ' lognormal:MEDIAN:SIGMA (default: %(default)s)')
+    group.add_argument('--etc-depth', metavar='N', type=int, default=3,
+                       help='depth of the etc/ tree of each package'
+                            ' (default: %(default)s)')
+    group.add_argument('--changelog', metavar='N', type=int, default=50,
+                       dest='changelog_entries',
+                       help='entries in QNAP/changelog'
+                            ' (default: %(default)s)')
+    group.add_argument('--seed', type=int, default=0,
+                       help='random seed (default: %(default)s)')
+
+
+def from_args(args):
+    return SyntheticTree(args.packages, args.install_lines,
+                         args.files_per_package, args.sizes, args.etc_depth,
+                         args.changelog_entries, args.seed)
+
+
+def main():
+    parser = ArgumentParser(description='Generate a synthetic QDK2 source'
+                                        ' tree')
+    parser.add_argument('dest', metavar='DIR',
+                        help='folder of the tree; must not exist')
+    build_argparse(parser)
+    args = parser.parse_args()
+    if pexists(args.dest):
+        parser.error('{} exists'.format(args.dest))
+    try:
+        tree = from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+    size = tree.generate(args.dest)
+    shape = tree.shape
+    shape['bytes'] = size
+    json.dump(shape, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
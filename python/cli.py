@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from importlib import import_module
+import logging
+import sys
+
+from log import LoggingConfiguration
+from settings import Settings
+
+
+# key, module and class of the commands, in the order of the help; only
+# the module of the command given is imported
+Commands = (('import', 'qdk2.imports', 'CommandImport'),
+            ('create', 'qdk2.create', 'CommandCreate'),
+            ('build', 'qdk2.build', 'CommandBuild'),
+            # ('clean', 'qdk2.clean', 'CommandClean'),
+            ('info', 'qdk2.info', 'CommandInfo'),
+            ('edit', 'qdk2.edit', 'CommandEdit'),
+            ('changelog', 'qdk2.changelog', 'CommandChangelog'),
+            ('extract', 'qdk2.extract', 'CommandExtract'),
+            ('index', 'qdk2.index', 'CommandIndex'),
+            ('verify', 'qdk2.verify', 'CommandVerify'),
+            # ('doctor', 'qdk2.doctor', 'CommandDoctor'),
+            ('version', 'qdk2.version', 'CommandVersion'),
+            ('serve', 'qdk2.serve', 'CommandServe'),
+            # ('lint', 'lint', 'CommandLint'),
+            )
+KEYS = tuple(key for key, _, _ in Commands)
+
+
+def load(key):
+    """The command class of key
+    """
+    for k, module, name in Commands:
+        if k == key:
+            return getattr(import_module(module), name)
+    raise KeyError(key)
+
+
+def command_key(argv):
+    """The command key in argv, or None when there is none or it is unknown
+    """
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg if arg in KEYS else None
+    return None
+
+
+class MyArgumentParser(object):
+    """Command-line argument parser
+    """
+    def __init__(self, keys=KEYS):
+        """Create parser object for the commands of keys
+        """
+        description = ('Assist to create and build QPKG'
+                       '')
+        epilog = ('',
+                  '',)
+        parser = ArgumentParser(description=description,
+                                epilog='\n'.join(epilog),
+                                formatter_class=RawTextHelpFormatter)
+        parser.add_argument('-v', '--verbose', action='store_true',
+                            default=False, help='verbose')
+        subparsers = parser.add_subparsers(help='')
+
+        self.commands = [load(key) for key in keys]
+        for c in self.commands:
+            c.build_argparse(subparsers)
+
+        self.parser = parser
+
+    def parse(self, argv=None):
+        """Parse command-line arguments
+        """
+        args, extra_args = self.parser.parse_known_args(argv)
+
+        return args, extra_args
+
+
+_parsers = {}
+
+
+def parser(key=None):
+    """The parser with the subparser of command key only, or with all of
+    them for None, e.g. for the help; made once. A parser with all of them,
+    as made by qdk2 serve before forking workers, serves any command.
+    """
+    if None in _parsers:
+        return _parsers[None]
+    if key not in _parsers:
+        _parsers[key] = MyArgumentParser(KEYS if key is None else (key,))
+    return _parsers[key]
+
+
+def main(argv=None):
+    LoggingConfiguration.set(logging.DEBUG if Settings.DEBUG else
+                             logging.INFO)
+    if argv is None:
+        argv = sys.argv[1:]
+    p = parser(command_key(argv))
+    args, extra_args = p.parse(argv)
+    for c in p.commands:
+        if c.key in args:
+            # the exit status of qdk2
+            return c(args, extra_args).run()
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
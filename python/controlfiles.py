@@ -7,6 +7,7 @@ from settings import Settings
 from exception import ControlFileSyntaxError, ChangelogFileSyntaxError
 from textwrap import TextWrapper
 from time import gmtime, strftime
+from email.utils import parsedate_tz, mktime_tz
 import re
 # from log import info
 
@@ -253,7 +254,8 @@ class ChangelogFile(File):
             for message in kargs['messages']:
                 messages.append(wrapper.fill(message))
             messages = '\n'.join(messages)
-        kargs['time'] = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+        kargs['time'] = strftime("%a, %d %b %Y %H:%M:%S +0000",
+                                 gmtime(Settings.SOURCE_DATE_EPOCH))
         tailer = ' -- {author} <{email}>  {time}'.format(**kargs)
         return title + '\n\n' + messages + '\n\n' + tailer + '\n\n'
 
@@ -275,6 +277,21 @@ class ChangelogFile(File):
                                            'Changlog can\'t be empty')
         return self._logs[0]['version']
 
+    @property
+    def timestamp(self):
+        """Time of the latest entry, in seconds since the epoch
+        """
+        self.parse()
+        if len(self._logs) == 0:
+            raise ChangelogFileSyntaxError(self._filename, self._lineno,
+                                           'Changlog can\'t be empty')
+        parsed = parsedate_tz(self._logs[0]['time'])
+        if parsed is None:
+            raise ChangelogFileSyntaxError(self._filename, self._lineno,
+                                           'Invalid time: ' +
+                                           self._logs[0]['time'])
+        return mktime_tz(parsed)
+
     @property
     def filename(self):
         return self._filename
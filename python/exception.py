@@ -11,6 +11,17 @@ class BaseStringException(Exception):
     def __str__(self):
         return self._msg
 
+    def __reduce__(self):
+        # subclasses take other arguments, if any; rebuild from the state so
+        # the exception can come back from a worker of qdk2 build --jobs
+        return _rebuild, (self.__class__, self.__dict__)
+
+
+def _rebuild(cls, state):
+    e = cls.__new__(cls)
+    e.__dict__.update(state)
+    return e
+
 
 class UserExit(BaseStringException):
     pass
@@ -50,4 +61,8 @@ class ContainerUnsupported(BaseStringException):
     pass
 
 
+class QpkgFormatError(BaseStringException):
+    pass
+
+
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
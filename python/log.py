@@ -36,6 +36,25 @@ class ColoredFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
+class NewFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating file handler starting a new file on its first record, so
+    that a command logging nothing leaves the files alone
+    """
+    def __init__(self, filename, mode='a', backupCount=0):
+        logging.handlers.RotatingFileHandler.__init__(
+            self, filename, mode=mode, backupCount=backupCount, delay=True)
+        self._rollover = True
+
+    def emit(self, record):
+        if self._rollover:
+            self._rollover = False
+            try:
+                self.doRollover()
+            except (IOError, OSError):
+                self.handleError(record)
+        logging.handlers.RotatingFileHandler.emit(self, record)
+
+
 class LoggingConfiguration(object):
     COLOR_FORMAT = "[" + BOLD_SEQ + "%(asctime)s" + RESET_SEQ + \
                    "][%(levelname)s] %(message)s"
@@ -50,6 +69,9 @@ class LoggingConfiguration(object):
         """
         logger = logging.getLogger()
         logger.setLevel(logging.DEBUG)
+        # a worker of qdk2 serve inherits the handlers of the daemon
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
 
         # Log to sys.stderr using log level passed through command line
         if log_level != logging.NOTSET:
@@ -62,20 +84,21 @@ class LoggingConfiguration(object):
             log_handler.setLevel(log_level)
             logger.addHandler(log_handler)
 
-        # Log to rotating file using DEBUG log level
-        log_handler = logging.handlers.RotatingFileHandler(log_filename,
-                                                           mode='a+',
-                                                           backupCount=3)
+        # Log to rotating file using DEBUG log level; the file is opened,
+        # and rolled over, on the first record
+        if append:
+            log_handler = logging.handlers.RotatingFileHandler(
+                log_filename, mode='a+', backupCount=3, delay=True)
+        else:
+            # Create a new log file on every new
+            # (i.e. not scheduled) invocation
+            log_handler = NewFileHandler(log_filename, mode='a+',
+                                         backupCount=3)
         formatter = logging.Formatter(cls.FILE_FORMAT)
         log_handler.setFormatter(formatter)
         log_handler.setLevel(logging.DEBUG)
         logger.addHandler(log_handler)
 
-        if not append:
-            # Create a new log file on every new
-            # (i.e. not scheduled) invocation
-            log_handler.doRollover()
-
 
 info = logging.info
 debug = logging.debug
@@ -3,19 +3,77 @@
 from os.path import (exists as pexists,
                      join as pjoin,
                      realpath as prealpath,
+                     isdir,
+                     islink,
+                     relpath,
                      )
-from os import makedirs, chdir, getcwd, listdir
-from shutil import rmtree, copytree
+from os import makedirs, chdir, getcwd, listdir, walk, lstat, unlink
+from glob import glob
+from shutil import rmtree
 from controlfiles import ControlFile, ChangelogFile
 from contextlib import contextmanager
+from multiprocessing import Pool, Lock
 import subprocess
 import os
 
 from settings import Settings
-from log import info
+from log import debug, info, warning
 from qbuild.rules import Rules
 from qbuild.cook import Cook
+from qbuild.cache import (RecipeCache, ArtifactCache, install_sources,
+                          tree_digest)
+from qbuild.snapshot import Snapshot
+from qbuild.install import Installer
+from qbuild.digest import DigestCache
+from qbuild.qpkg import QpkgWriter
+from qbuild.jobserver import Jobserver
 from exception import BuildingError
+from tracing import tracer, span
+
+
+# Serialize QNAP/rules among the workers of a parallel build; every package
+# shares the same build-area copy of the source tree.
+_rules_lock = None
+# Marks a successful `QNAP/rules build` for an architecture in the build-area
+# copy of the source tree, as debian/rules does with its stamp files
+BUILD_STAMP = 'stamp-build-{}'
+# Cook recipes, in order
+RECIPES = ('dirs',
+           'install',
+           'links',
+           'controls',
+           'icons',
+           'package_routines',
+           'qpkg_cfg',
+           'list',
+           'conffiles',
+           'fixperms',
+           'signature',
+           'md5sums',
+           )
+# Recipes to run again when only the contents of installed files changed
+CONTENT_RECIPES = ('install', 'fixperms', 'md5sums')
+# Source files whose change needs every package built again
+SOURCE_FILES = ('control', 'changelog', 'rules')
+
+
+def _init_worker(lock):
+    global _rules_lock
+    _rules_lock = lock
+
+
+def _build_worker(task):
+    transformer, package, args = task
+    return transformer._build_one(package, args)
+
+
+@contextmanager
+def _rules_serialized():
+    if _rules_lock is None:
+        yield None
+    else:
+        with _rules_lock:
+            yield None
 
 
 class QbuildToQpkg(object):
@@ -23,6 +81,16 @@ class QbuildToQpkg(object):
         self._path = path
 
     def build(self, args):
+        if getattr(args, 'packager', 'qbuild') == 'python':
+            writer = QpkgWriter(self._path, args._extra_args,
+                                getattr(args, 'source_date_epoch', None))
+            reason = writer.unsupported()
+            if reason is None:
+                return writer.build()
+            info('Build {} with qbuild: {}'.format(self._path, reason))
+        if getattr(args, 'source_date_epoch', None) is not None:
+            warning('{} is not reproducible when built with qbuild'
+                    .format(self._path))
         cwd = getcwd()
         chdir(self._path)
         try:
@@ -34,7 +102,9 @@ class QbuildToQpkg(object):
             for extra in args._extra_args:
                 cmd.append(extra)
             info(cmd)
-            subprocess.check_call(cmd)
+            with span('qbuild', 'qpkg', path=self._path):
+                subprocess.check_call(cmd,
+                                      env=tracer.environ(os.environ.copy()))
         finally:
             chdir(cwd)
         for fname in listdir(pjoin(self._path, 'build')):
@@ -47,6 +117,12 @@ class Qdk2ToQbuild(object):
     def __init__(self, data):
         self.build_dir = data.build_dir
         self.qpkg_dir = data.qpkg_dir
+        self.jobs = getattr(data, 'jobs', 1)
+        self.use_cache = getattr(data, 'use_cache', False)
+        self.use_recipe_cache = getattr(data, 'use_recipe_cache', False)
+        self.snapshot_mode = getattr(data, 'snapshot_mode', 'copy')
+        self.snapshot_excludes = getattr(data, 'snapshot_excludes', [])
+        self.hardlink = getattr(data, 'hardlink', False)
 
     def transform(self):
         cfile = ControlFile(self.qpkg_dir)
@@ -56,65 +132,264 @@ class Qdk2ToQbuild(object):
                 result.append(self._transform_one(cfile.packages[k]))
         return result
 
+    def build(self, args):
+        """Transform and pack every package; return [(qbuild_dir, qpkg)]
+
+        With jobs > 1 the packages are cooked and packed in a process pool.
+        The result keeps the order of the control file either way.
+        """
+        cfile = ControlFile(self.qpkg_dir)
+        with self._setup_all(cfile):
+            packages = [cfile.packages[k] for k in cfile.packages]
+            tasks = [(self, package, args) for package in packages]
+            jobs = min(self.jobs, len(tasks))
+            if jobs <= 1:
+                return [_build_worker(task) for task in tasks]
+            if self.use_cache:
+                # once, before the workers run QNAP/rules in the tree
+                self._source_digest()
+            info('Building {} packages with {} jobs'.format(len(tasks), jobs))
+            pool = Pool(jobs, _init_worker, (Lock(),))
+            try:
+                return pool.map(_build_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
     def _transform_one(self, package):
-        with self._setup(package):
-            rules = Rules(self._env, self.qpkg_dir)
-            rules.build()
-            rules.binary()
-
-            recipes = ('dirs',
-                       'install',
-                       'links',
-                       'controls',
-                       'icons',
-                       'package_routines',
-                       'qpkg_cfg',
-                       'list',
-                       'conffiles',
-                       'fixperms',
-                       'signature',
-                       'md5sums',
-                       )
-
-            cook = Cook(package, self._env)
+        with self._setup(package) as env:
+            self._rules(env)
+            self._cook(package, env)
+            return env['QPKG_DEST_CONTROL']
+
+    def _build_one(self, package, args):
+        """Transform and pack package; return (qbuild_dir, qpkg)
+
+        The package is restored from the artifact cache when none of its
+        inputs changed since it was built, without running QNAP/rules.
+        """
+        name = '{0[package]}_{0[architecture]}'.format(package)
+        with self._setup(package) as env, span(name, 'package'):
+            qbuild_format = env['QPKG_DEST_CONTROL']
+            artifacts = None
+            if self.use_cache:
+                options = [args._extra_args,
+                           getattr(args, 'packager', 'qbuild'),
+                           getattr(args, 'source_date_epoch', None)]
+                with span('artifact_cache', 'cache') as trace_args:
+                    artifacts = ArtifactCache(package, env,
+                                              self._source_digest(), options)
+                    qpkg = artifacts.restore(pjoin(qbuild_format, 'build'))
+                    trace_args['hit'] = qpkg is not None
+                if qpkg is not None:
+                    return qbuild_format, qpkg
+            self._rules(env)
+            self._cook(package, env)
+            qpkg = QbuildToQpkg(qbuild_format).build(args)
+            if artifacts is not None:
+                with span('artifact_store', 'cache'):
+                    artifacts.store(qpkg)
+            return qbuild_format, qpkg
+
+    def _source_digest(self):
+        """tree_digest() of the build-area copy of the source tree, without
+        the staging trees and stamps of the build; once per _setup_all()
+        """
+        if self._tree is None:
+            excludes = [pjoin(Settings.CONTROL_PATH, BUILD_STAMP.format('*'))]
+            excludes.extend(pjoin(Settings.CONTROL_PATH,
+                                  '{0[package]}_{0[architecture]}'.format(p))
+                            for p in self._packages)
+            digest_cache = DigestCache()
+            try:
+                with span('source_digest', 'cache'):
+                    self._tree = tree_digest('.', excludes, digest_cache)
+            finally:
+                digest_cache.close()
+        return self._tree
+
+    def _rules(self, env):
+        """Run `QNAP/rules build` once per architecture, `binary` per package
+
+        The packages of an architecture share the tree built for the first
+        of them, in whatever order the workers get there.
+        """
+        stamp = pjoin(Settings.CONTROL_PATH,
+                      BUILD_STAMP.format(env['QPKG_ARCHITECTURE']))
+        with _rules_serialized():
+            rules = Rules(self.jobserver.environ(env.copy()), self.qpkg_dir,
+                          self.snapshot.wrapper)
+            with span('rules build', 'rules') as args:
+                args['stamp'] = pexists(stamp)
+                if args['stamp']:
+                    debug('{} exists, skip rules build'.format(stamp))
+                else:
+                    args['ret'] = rules.build()
+                    if args['ret'] == 0:
+                        open(stamp, 'w').close()
+            with span('rules binary', 'rules') as args:
+                args['ret'] = rules.binary()
+
+    def update(self, paths, args):
+        """Build again what changed paths of qpkg_dir affect
+
+        A change of QNAP/control, changelog or rules builds everything
+        again, a change of QNAP/<package>.* that package. Any other change
+        runs QNAP/rules again, then packages whose installed files were
+        added or removed are built again, and those whose installed files
+        only changed run the install, fixperms and md5sums recipes on their
+        previous staging tree. Return [(qbuild_dir, qpkg)] as build().
+        """
+        rels = set(relpath(p, prealpath(self.qpkg_dir)) for p in paths)
+        control = set(pjoin(Settings.CONTROL_PATH, f) for f in SOURCE_FILES)
+        if '.' in rels or Settings.CONTROL_PATH in rels or rels & control:
+            return self.build(args)
+
+        cfile = ControlFile(self.qpkg_dir)
+        packages = [cfile.packages[k] for k in cfile.packages]
+        with self._setup_all(cfile, fresh=False):
+            before = [self._install_state(p) for p in packages]
+            rels = self.snapshot.update(rels)
+            rebuild = set()
+            sources = False
+            for rel in rels:
+                names = [i for i, p in enumerate(packages)
+                         if rel.startswith(pjoin(Settings.CONTROL_PATH,
+                                                 p['package'] + '.'))]
+                rebuild.update(names)
+                sources = sources or not names
+            if sources:
+                for stamp in glob(pjoin(Settings.CONTROL_PATH,
+                                        BUILD_STAMP.format('*'))):
+                    unlink(stamp)
+                for package in packages:
+                    with self._setup(package, clean=False) as env:
+                        self._rules(env)
+            result = []
+            for i, package in enumerate(packages):
+                if i in rebuild:
+                    result.append(self._build_one(package, args))
+                    continue
+                after = self._install_state(package)
+                if after == before[i]:
+                    continue
+                if set(after) != set(before[i]):
+                    result.append(self._build_one(package, args))
+                else:
+                    result.append(self._repack_one(package, args))
+            return result
+
+    def _repack_one(self, package, args):
+        """Install files again into the staging tree of package and pack it
+
+        A package restored from the artifact cache has no staging tree to
+        start from; it is built in full instead.
+        """
+        with self._setup(package, clean=False) as env:
+            cooked = pexists(pjoin(env['QPKG_DEST_CONTROL'], 'qpkg.cfg'))
+        if not cooked:
+            return self._build_one(package, args)
+        name = '{0[package]}_{0[architecture]}'.format(package)
+        with self._setup(package, clean=False) as env, span(name, 'package'):
+            self._cook(package, env, CONTENT_RECIPES, recipe_cache=False)
+            qbuild_format = env['QPKG_DEST_CONTROL']
+            return qbuild_format, QbuildToQpkg(qbuild_format).build(args)
+
+    def _install_state(self, package):
+        """{path: (mode, size, mtime)} of the sources of QNAP/<package>.install
+        """
+        state = {}
+        for src in install_sources(package):
+            tops = [src]
+            if isdir(src) and not islink(src):
+                tops = []
+                for root, dirs, files in walk(src):
+                    tops.extend(pjoin(root, name) for name in dirs + files)
+            for path in tops:
+                st = lstat(path)
+                state[path] = (st.st_mode, st.st_size, st.st_mtime)
+        return state
+
+    def _cook(self, package, env, recipes=RECIPES, recipe_cache=True):
+        digest_cache = DigestCache() if self.use_cache else None
+        cook = Cook(package, env, installer=Installer(self.hardlink),
+                    digest_cache=digest_cache)
+        # the keys of RecipeCache chain every recipe in order
+        cache = RecipeCache(package, env, digest_cache=digest_cache) \
+            if self.use_recipe_cache and recipe_cache else None
+        try:
             for recipe in recipes:
                 # TODO: handle cook status
-                getattr(cook, recipe)()
-            return self._env['QPKG_DEST_CONTROL']
+                with span(recipe, 'cook') as args:
+                    if cache is not None:
+                        args['ret'] = cache.cook(cook, recipe)
+                    else:
+                        args['ret'] = getattr(cook, recipe)()
+            if cache is not None:
+                with span('recipe_evict', 'cache'):
+                    cache.evict()
+        finally:
+            if digest_cache is not None:
+                digest_cache.close()
 
     @contextmanager
-    def _setup_all(self, control):
+    def _setup_all(self, control, fresh=True):
+        """Work in the build-area copy of the source tree
+
+        The copy is made again unless fresh is False, which reuses the copy
+        of the previous build.
+        """
         cwd = getcwd()
         dest = prealpath(pjoin(self.build_dir, control.source['source']))
-        if pexists(dest):
-            rmtree(dest)
-        if not pexists(self.build_dir):
-            makedirs(self.build_dir)
-        # if dest in qpkg_dir
-        copytree(self.qpkg_dir, dest, True)
+        if fresh:
+            with span('setup_all', 'setup', snapshot=self.snapshot_mode):
+                if pexists(dest):
+                    rmtree(dest)
+                if not pexists(self.build_dir):
+                    makedirs(self.build_dir)
+                self.snapshot = Snapshot(self.qpkg_dir, dest,
+                                         self.snapshot_mode,
+                                         self.snapshot_excludes)
+                self.snapshot.create()
+            # auto is resolved by create(); the copy is updated the same way
+            self.snapshot_mode = self.snapshot.mode
+        else:
+            self.snapshot = Snapshot(self.qpkg_dir, dest, self.snapshot_mode,
+                                     self.snapshot_excludes)
         self.source = control.source
+        self._packages = control.packages.values()
+        self._tree = None
+        self.jobserver = Jobserver(self.jobs, os.environ.get('MAKEFLAGS', ''))
         chdir(dest)
 
         yield None
 
         chdir(cwd)
+        self.jobserver.close()
+        del self.jobserver
         del self.source
+        del self._packages
+        del self._tree
+        del self.snapshot
 
     @contextmanager
-    def _setup(self, package):
-        def prepare_dest():
+    def _setup(self, package, clean=True):
+        # The environment is private to each package so that packages can
+        # be transformed concurrently
+        def prepare_dest(myenv):
             dest = prealpath(pjoin(
                 '.', Settings.CONTROL_PATH,
                 package['package'] + '_' + package['architecture']))
-            if pexists(dest):
+            if clean and pexists(dest):
                 rmtree(dest)
-            self._env['QPKG_DEST_CONTROL'] = dest
-            self._env['QPKG_DEST_DATA'] = pjoin(dest, 'shared')
-            makedirs(self._env['QPKG_DEST_DATA'])
+            myenv['QPKG_DEST_CONTROL'] = dest
+            myenv['QPKG_DEST_DATA'] = pjoin(dest, 'shared')
+            if not pexists(myenv['QPKG_DEST_DATA']):
+                makedirs(myenv['QPKG_DEST_DATA'])
 
         def prepare_env():
             myenv = os.environ.copy()
-            for k, v in self.package.iteritems():
+            for k, v in package.iteritems():
                 myenv['QPKG_' + k.upper().replace('-', '_')] = v
             for k, v in self.source.iteritems():
                 myenv['QPKG_' + k.upper().replace('-', '_')] = v
@@ -122,16 +397,12 @@ class Qdk2ToQbuild(object):
             if pexists(pjoin(Settings.CONTROL_PATH,
                              package['package'] + '.init')):
                 myenv['QPKG_INIT'] = package['package'] + '.init'
-            self._env = myenv
+            return myenv
 
-        self.package = package
-        prepare_env()
-        prepare_dest()
-
-        yield None
+        env = prepare_env()
+        prepare_dest(env)
 
-        del self._env
-        del self.package
+        yield env
 
 
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
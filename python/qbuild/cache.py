@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+
+from os import (makedirs, walk, lstat, unlink, rename, readlink, fdopen,
+                chmod, utime, close, environ,
+                )
+from os.path import (exists as pexists,
+                     lexists as plexists,
+                     join as pjoin,
+                     dirname as pdirname,
+                     basename as pbasename,
+                     realpath as prealpath,
+                     isdir,
+                     islink,
+                     relpath,
+                     )
+from shutil import rmtree, copyfile
+from glob import glob
+from fnmatch import fnmatch
+from distutils.spawn import find_executable
+import hashlib
+import json
+import stat
+import tarfile
+import tempfile
+
+from log import debug, info
+from settings import Settings, VERSION
+from qbuild.digest import Digester
+import qbuild.cook as cook_module
+import qbuild.install as install_module
+import qbuild.manifest as manifest_module
+import template as template_module
+
+
+def install_sources(package):
+    src_install = pjoin(Settings.CONTROL_PATH,
+                        package['package'] + '.install')
+    if not pexists(src_install):
+        return []
+    sources = []
+    with open(src_install) as fin:
+        for line in fin:
+            fields = line.strip().split(' ', 1)
+            if fields[0]:
+                sources.extend(sorted(glob(fields[0])))
+    return sources
+
+
+def _update_content(h, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+
+
+def _update_path(h, path):
+    h.update(path + '\0')
+    try:
+        st = lstat(path)
+    except OSError:
+        h.update('-')
+        return
+    h.update(str(st.st_mode))
+    if stat.S_ISLNK(st.st_mode):
+        h.update(readlink(path))
+    elif stat.S_ISREG(st.st_mode):
+        _update_content(h, path)
+    elif stat.S_ISDIR(st.st_mode):
+        for root, dirs, files in walk(path):
+            dirs.sort()
+            h.update(root + '\0' + str(lstat(root).st_mode))
+            for name in sorted(files) + \
+                    [d for d in dirs if islink(pjoin(root, d))]:
+                _update_path(h, pjoin(root, name))
+
+
+def tree_digest(root, excludes=(), digest_cache=None):
+    """sha1 of the tree at root: the path, mode and link target or md5 of
+    every entry, the md5 through digest_cache. Paths relative to root
+    matching a pattern of excludes are left out, with what is below them.
+    """
+    entries = []
+    for top, dirs, files in walk(root):
+        rel = relpath(top, root)
+        kept = []
+        for name in sorted(dirs + files):
+            path = name if rel == '.' else pjoin(rel, name)
+            if any(fnmatch(path, pattern) for pattern in excludes):
+                continue
+            st = lstat(pjoin(top, name))
+            entries.append((path, st.st_mode))
+            if name in dirs and not stat.S_ISLNK(st.st_mode):
+                kept.append(name)
+        dirs[:] = kept
+    files = [path for path, mode in entries if stat.S_ISREG(mode)]
+    digests = dict(zip(files, Digester('md5', cache=digest_cache).hexdigests(
+        [pjoin(root, path) for path in files])))
+    h = hashlib.sha1()
+    for path, mode in entries:
+        h.update('{}\0{}\0'.format(path, mode))
+        if stat.S_ISREG(mode):
+            h.update(digests[path])
+        elif stat.S_ISLNK(mode):
+            h.update(readlink(pjoin(root, path)))
+    return h.hexdigest()
+
+
+def _source(module):
+    # the .py file, not the .pyc that changes on every compile
+    return module.__file__[:-1] if module.__file__.endswith(('.pyc', '.pyo')) \
+        else module.__file__
+
+
+class RecipeCache(object):
+    """Persistent cache of the output of Cook recipes, opt-in
+
+    A recipe is keyed by the hash of its inputs chained with the key of the
+    previous recipe, so a change in one recipe invalidates every later one.
+    Recipes reading QPKG_DEST_DATA also hash the staging tree as it is
+    before they run, from the manifest of Cook and the digests of its
+    files. On a hit the files the recipe wrote, as Cook.output() recorded
+    them, are restored instead of running the recipe again.
+
+    The recipes filling QPKG_DEST_DATA from the sources are always run:
+    restoring the payload would cost as much as installing it, and store
+    a copy of it. Least recently used entries beyond max_size bytes are
+    evicted.
+    """
+    # control files read by each recipe (suffix of QNAP/<package>)
+    CONTROL_FILES = {
+        'controls': ('.conf', '.conffiles', '.mime', '.service',
+                     '.init', '.preinst', '.postinst', '.prerm', '.postrm'),
+        'icons': ('.icon.64', '.icon.80', '.icon.gray'),
+    }
+    # recipes reading the QPKG_* environment
+    ENV_RECIPES = ('controls', 'package_routines', 'qpkg_cfg')
+    # recipes run anyway; what they do to the tree is seen by TREE_RECIPES
+    UNCACHED = ('dirs', 'install', 'links', 'fixperms')
+    # recipes writing QPKG_DEST_DATA; the others only touch control files
+    DATA_RECIPES = ('dirs', 'install', 'links', 'controls', 'fixperms')
+    # recipes reading QPKG_DEST_DATA, which QNAP/rules binary writes too
+    TREE_RECIPES = ('conffiles', 'md5sums')
+    # the code of the recipes; an edited one misses
+    MODULES = (cook_module, install_module, manifest_module, template_module)
+
+    def __init__(self, package, env, path=None, digest_cache=None,
+                 max_size=None):
+        self._package = package
+        self._env = env
+        self._digest_cache = digest_cache
+        self._path = pjoin(path or Settings.CACHE_PATH, 'recipes')
+        self._max_size = max_size or Settings.RECIPE_CACHE_SIZE
+        self._root = env['QPKG_DEST_CONTROL']
+        h = hashlib.sha1(json.dumps(
+            [VERSION, Settings.QPKG_VERSION, sorted(package.items())]))
+        for module in self.MODULES:
+            _update_path(h, _source(module))
+        self._key = h.hexdigest()
+
+    def cook(self, cook, recipe):
+        """Run the recipe of cook, or restore its output from the cache
+        """
+        if recipe in self.UNCACHED:
+            return getattr(cook, recipe)()
+        self._key = self._recipe_key(recipe, cook)
+        entry = pjoin(self._path, self._key[:2], self._key)
+        if pexists(entry + '.json'):
+            debug('[{0[package]}_{0[architecture]}] {1}: cache hit {2}'
+                  .format(self._package, recipe, self._key))
+            try:
+                self._restore(entry)
+                # the mtime of the entry orders the eviction
+                utime(entry + '.json', None)
+            except (IOError, OSError, ValueError, tarfile.TarError) as e:
+                # evicted by a concurrent build
+                debug('recipe cache: {}: {}'.format(self._key, e))
+            else:
+                if recipe in self.DATA_RECIPES:
+                    cook.invalidate()
+                return 0
+
+        cook.written = []
+        ret = getattr(cook, recipe)()
+        if ret is None or ret == 0:
+            self._store(entry, cook.written)
+        return ret
+
+    def evict(self):
+        """Drop the least recently used entries beyond max_size bytes
+        """
+        entries = []
+        for path in glob(pjoin(self._path, '*', '*.json')):
+            tar = path[:-len('.json')] + '.tar'
+            try:
+                size = lstat(path).st_size
+                mtime = lstat(path).st_mtime
+                if pexists(tar):
+                    size += lstat(tar).st_size
+            except OSError:
+                continue
+            entries.append((mtime, path, tar, size))
+        total = sum(size for _, _, _, size in entries)
+        entries.sort()
+        while entries and total > self._max_size:
+            _, path, tar, size = entries.pop(0)
+            # the json first: it marks the entry as complete
+            for p in (path, tar):
+                try:
+                    unlink(p)
+                except OSError:
+                    pass
+            total -= size
+        debug('recipe cache: {} bytes in {} entries'.format(total,
+                                                            len(entries)))
+
+    def _recipe_key(self, recipe, cook):
+        h = hashlib.sha1(self._key)
+        h.update(recipe)
+        for suffix in self.CONTROL_FILES.get(recipe, ()):
+            _update_path(h, pjoin(Settings.CONTROL_PATH,
+                                  self._package['package'] + suffix))
+        if recipe in self.ENV_RECIPES:
+            h.update(json.dumps(sorted(
+                (k, v) for k, v in self._env.iteritems()
+                if k.startswith('QPKG_') and not k.startswith('QPKG_DEST_'))))
+        if recipe in self.TREE_RECIPES:
+            self._update_tree(h, cook.manifest)
+        return h.hexdigest()
+
+    def _update_tree(self, h, manifest):
+        files = [e.path for e in manifest if e.type == 'f']
+        digests = dict(zip(files, Digester('md5', cache=self._digest_cache)
+                           .hexdigests([pjoin(manifest.root, p)
+                                        for p in files])))
+        for e in manifest:
+            h.update('{}\0{}\0{}\0'.format(e.path, e.type, e.mode))
+            if e.type == 'f':
+                h.update(digests[e.path])
+            elif e.type == 'l':
+                h.update(readlink(pjoin(manifest.root, e.path)))
+
+    def _store(self, entry, written):
+        # paths relative to QPKG_DEST_CONTROL; directories come before
+        # their files, as the recipe made them
+        changed = [relpath(p, self._root) for p in written if plexists(p)]
+        removed = [relpath(p, self._root) for p in written
+                   if not plexists(p)]
+        if not pexists(pdirname(entry)):
+            try:
+                makedirs(pdirname(entry))
+            except OSError:
+                # created by a concurrent build
+                pass
+        # write to temporary files and rename them; the json is written last
+        # and marks the entry as complete
+        if changed:
+            fd, tmp = tempfile.mkstemp(dir=pdirname(entry))
+            with fdopen(fd, 'wb') as f, \
+                    tarfile.open(fileobj=f, mode='w') as tar:
+                for path in changed:
+                    tar.add(pjoin(self._root, path), arcname=path,
+                            recursive=False)
+            rename(tmp, entry + '.tar')
+        fd, tmp = tempfile.mkstemp(dir=pdirname(entry))
+        with fdopen(fd, 'w') as f:
+            json.dump({'changed': len(changed), 'removed': removed}, f)
+        rename(tmp, entry + '.json')
+
+    def _restore(self, entry):
+        with open(entry + '.json') as f:
+            meta = json.load(f)
+        for path in meta['removed']:
+            path = pjoin(self._root, path)
+            if isdir(path):
+                rmtree(path)
+            elif pexists(path):
+                unlink(path)
+        if meta['changed']:
+            with tarfile.open(entry + '.tar') as tar:
+                tar.extractall(self._root)
+
+
+class ArtifactCache(object):
+    """Persistent cache of finished packages
+
+    A package is keyed by a hash of everything it is built from, all known
+    before QNAP/rules runs, so that a hit skips it: the package fields, the
+    QPKG_* environment, the source tree as given by tree_digest(), the
+    build options, qdk2 and qbuild themselves and the programs QNAP/rules
+    and qbuild run, as found in PATH. The key refers to the .qpkg,
+    .qpkg.md5 and .qpkg.codesigning files, stored once by content in
+    objects/. Least recently used keys beyond max_size bytes of objects are
+    evicted.
+    """
+    SIDECARS = ('.md5', '.codesigning')
+    # qbuild reads these from the environment
+    ENV_PREFIXES = ('QDK_', 'QNAP_CODE_SIGNING', 'SOURCE_DATE_EPOCH')
+    # programs run by QNAP/rules and qbuild; whether and which one is found
+    # is an input
+    TOOLS = ('make', 'cc', 'c++', 'qpkg_encrypt', 'pv', 'tar', 'gzip',
+             'bzip2', 'xz', 'md5sum', 'gpg', 'openssl', 'python2')
+
+    def __init__(self, package, env, tree, options=(), path=None,
+                 max_size=None):
+        self._package = package
+        self._path = pjoin(path or Settings.CACHE_PATH, 'artifacts')
+        self._max_size = max_size or Settings.ARTIFACT_CACHE_SIZE
+        self._key = self._artifact_key(package, env, tree, options)
+        self._entry = pjoin(self._path, 'keys', self._key[:2],
+                            self._key + '.json')
+
+    def restore(self, build_dir):
+        """Copy the cached package into build_dir; return its path or None
+        """
+        if not pexists(self._entry):
+            return None
+        try:
+            with open(self._entry) as f:
+                meta = json.load(f)
+            if not pexists(build_dir):
+                makedirs(build_dir)
+            qpkg = pjoin(build_dir, meta['qpkg'])
+            for suffix, (digest, mode) in meta['files'].iteritems():
+                copyfile(self._object(digest), qpkg + suffix)
+                chmod(qpkg + suffix, mode)
+            # the mtime of the key orders the eviction
+            utime(self._entry, None)
+        except (IOError, OSError, ValueError) as e:
+            # evicted by a concurrent build
+            debug('artifact cache: {}: {}'.format(self._key, e))
+            return None
+        info('[{0[package]}_{0[architecture]}] unchanged, reuse {1}'
+             .format(self._package, meta['qpkg']))
+        return qpkg
+
+    def store(self, qpkg):
+        files = {}
+        for suffix in ('',) + self.SIDECARS:
+            if not pexists(qpkg + suffix):
+                continue
+            digest = self._store_object(qpkg + suffix)
+            mode = stat.S_IMODE(lstat(qpkg + suffix).st_mode)
+            files[suffix] = (digest, mode)
+
+        def write_entry(tmp):
+            with open(tmp, 'w') as f:
+                json.dump({'qpkg': pbasename(qpkg), 'files': files}, f)
+        # written last; marks the entry as complete
+        self._write(self._entry, write_entry)
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used keys beyond max_size bytes
+        """
+        keys = []
+        for path in glob(pjoin(self._path, 'keys', '*', '*.json')):
+            try:
+                with open(path) as f:
+                    digests = [d for d, _ in json.load(f)['files'].values()]
+                keys.append((lstat(path).st_mtime, path, digests))
+            except (IOError, OSError, ValueError):
+                continue
+        sizes = {}
+        for path in glob(pjoin(self._path, 'objects', '*', '*')):
+            sizes[pbasename(path)] = lstat(path).st_size
+        total = sum(sizes.values())
+        if total <= self._max_size:
+            return
+        keys.sort()
+        while keys and total > self._max_size:
+            _, path, digests = keys.pop(0)
+            unlink(path)
+            used = set(d for _, _, ds in keys for d in ds)
+            for digest in digests:
+                if digest not in used and digest in sizes:
+                    unlink(self._object(digest))
+                    total -= sizes.pop(digest)
+        debug('artifact cache: {} bytes in {} packages'.format(total,
+                                                               len(keys)))
+
+    def _artifact_key(self, package, env, tree, options):
+        h = hashlib.sha1(json.dumps([
+            VERSION, Settings.QPKG_VERSION, sorted(package.items()),
+            sorted((k, v) for k, v in env.iteritems()
+                   if k.startswith('QPKG_') and not k.startswith('QPKG_DEST_')),
+            sorted((k, v) for k, v in environ.iteritems()
+                   if k.startswith(self.ENV_PREFIXES)),
+            list(options)]))
+        # qdk2 and qbuild; .pyc files would change the key on every compile
+        python = pdirname(pdirname(cook_module.__file__))
+        tools = [Settings.QBUILD, pjoin(pdirname(pdirname(Settings.QBUILD)),
+                                        'scripts')]
+        tools.extend(sorted(glob(pjoin(python, '*.py'))))
+        tools.extend(sorted(glob(pjoin(python, 'qbuild', '*.py'))))
+        for path in tools + [Settings.QDK_USER_CONFIG,
+                             '/etc/config/qdk.conf']:
+            _update_path(h, path)
+        for name in self.TOOLS:
+            path = find_executable(name, env.get('PATH', ''))
+            if path is None:
+                h.update(name + '\0-')
+            else:
+                st = lstat(prealpath(path))
+                h.update('{}\0{}\0{}\0{}'.format(name, prealpath(path),
+                                                   st.st_size, st.st_mtime))
+        h.update(tree)
+        return h.hexdigest()
+
+    def _store_object(self, path):
+        """Copy path into objects/ and return its digest, read once
+        """
+        objects = pjoin(self._path, 'objects')
+        if not pexists(objects):
+            try:
+                makedirs(objects)
+            except OSError:
+                # created by a concurrent build
+                pass
+        h = hashlib.sha1()
+        fd, tmp = tempfile.mkstemp(dir=objects)
+        try:
+            with open(path, 'rb') as fin, fdopen(fd, 'wb') as fout:
+                for chunk in iter(lambda: fin.read(1 << 20), ''):
+                    h.update(chunk)
+                    fout.write(chunk)
+            digest = h.hexdigest()
+            dest = self._object(digest)
+            if pexists(dest):
+                unlink(tmp)
+            else:
+                if not pexists(pdirname(dest)):
+                    try:
+                        makedirs(pdirname(dest))
+                    except OSError:
+                        pass
+                rename(tmp, dest)
+        except:
+            if pexists(tmp):
+                unlink(tmp)
+            raise
+        return digest
+
+    def _object(self, digest):
+        return pjoin(self._path, 'objects', digest[:2], digest)
+
+    def _write(self, dest, write):
+        # write to a temporary file renamed to dest
+        if not pexists(pdirname(dest)):
+            try:
+                makedirs(pdirname(dest))
+            except OSError:
+                # created by a concurrent build
+                pass
+        fd, tmp = tempfile.mkstemp(dir=pdirname(dest))
+        try:
+            close(fd)
+            write(tmp)
+            rename(tmp, dest)
+        except:
+            unlink(tmp)
+            raise
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -1,34 +1,60 @@
 #!/usr/bin/env python
 
-from os import symlink, makedirs, chmod, walk, unlink
+from os import symlink, makedirs, chmod, unlink, lstat
 from os.path import (exists as pexists,
                      join as pjoin,
                      basename as pbasename,
                      dirname as pdirname,
-                     isfile,
-                     islink,
                      )
 from shutil import copy
 from collections import defaultdict
-from glob import glob
 import subprocess as sp
-import os
 import stat
-import hashlib
 
 from log import debug, warning
 from settings import Settings
 from exception import FileSyntaxError, BuildingError
+from template import Template
+from tracing import span
+from qbuild.install import Installer
+from qbuild.manifest import Manifest
+from qbuild.digest import Digester
 
 
 class Cook(object):
-    def __init__(self, package, env=None, qpkg_dir='./'):
+    def __init__(self, package, env=None, qpkg_dir='./', installer=None,
+                 digest_cache=None):
         self._package = package
         self._env = env
+        self._installer = installer if installer is not None else Installer()
+        self._digest_cache = digest_cache
+        # paths written by the recipes, see output()
+        self.written = []
         self._label = '[{}: {}_{}] '.format(env['QPKG_SOURCE'],
                                             env['QPKG_PACKAGE'],
                                             env['QPKG_ARCHITECTURE'])
 
+    @property
+    def manifest(self):
+        """Manifest of QPKG_DEST_DATA, scanned on first use
+        """
+        if not hasattr(self, '_manifest'):
+            self._manifest = Manifest(self._env['QPKG_DEST_DATA'])
+        return self._manifest
+
+    def output(self, path):
+        """path, recorded as written by the recipe running; RecipeCache
+        stores what each recipe wrote
+        """
+        self.written.append(path)
+        return path
+
+    def invalidate(self):
+        """Forget the manifest after QPKG_DEST_DATA changed behind Cook
+        """
+        if hasattr(self, '_manifest'):
+            del self._manifest
+
     # https://www.debian.org/doc/manuals/maint-guide/dother.en.html#dirs
     def dirs(self):
         debug(self._label + 'create directories')
@@ -45,8 +71,7 @@ class Cook(object):
                     if line.startswith('/'):
                         raise FileSyntaxError(src_install, lineno, line)
                     dst = pjoin(self._env['QPKG_DEST_DATA'], line)
-                    if not pexists(dst):
-                        makedirs(dst)
+                    self._installer.makedirs(dst)
         except ValueError:
             raise FileSyntaxError(src_install, lineno, line)
 
@@ -58,6 +83,8 @@ class Cook(object):
         if not pexists(src_install):
             warning('Missing: ' + src_install)
             return
+        entries = []
+        linenos = []
         try:
             lineno = 0
             with open(src_install) as fin:
@@ -67,23 +94,23 @@ class Cook(object):
                     dst = dst.strip()
                     if dst.startswith('/'):
                         dst = '.' + dst
-                    dst = pjoin(self._env['QPKG_DEST_DATA'], dst)
-                    if not pexists(dst):
-                        makedirs(dst)
-                    src_files = glob(src)
-                    if not src_files:
-                        raise FileSyntaxError(src_install,
-                                              lineno,
-                                              '`{}` not found'.format(src))
-                    for fn in glob(src):
-                        try:
-                            sp.check_call(['cp', '-a', fn, dst])
-                        except sp.CalledProcessError as e:
-                            warning('Error in copy files: {}'.format(e))
-                            return -1
+                    entries.append(
+                        (src, pjoin(self._env['QPKG_DEST_DATA'], dst)))
+                    linenos.append(lineno)
         except ValueError:
             raise FileSyntaxError(src_install, lineno, line)
 
+        pairs, missing = self._installer.expand(entries)
+        if missing is not None:
+            raise FileSyntaxError(src_install, linenos[missing],
+                                  '`{}` not found'.format(entries[missing][0]))
+        try:
+            self._installer.install(pairs)
+        except (IOError, OSError) as e:
+            warning('Error in copy files: {}'.format(e))
+            return -1
+        debug(self._label + 'installed ' + self._installer.report())
+
     # https://www.debian.org/doc/manuals/maint-guide/dother.en.html#links
     def links(self):
         debug(self._label + 'create additional symlinks')
@@ -102,12 +129,10 @@ class Cook(object):
                         dst = '.' + dst
                     dst = pjoin(self._env['QPKG_DEST_DATA'], dst)
                     if dst.endswith('/'):
-                        if not pexists(dst):
-                            makedirs(dst)
+                        self._installer.makedirs(dst.rstrip('/'))
                         dst = pjoin(dst, pbasename(src))
                     else:
-                        if not pexists(pdirname(dst)):
-                            makedirs(pdirname(dst))
+                        self._installer.makedirs(pdirname(dst))
                     symlink(src, dst)
         except ValueError:
             raise FileSyntaxError(src_install, lineno, line)
@@ -118,7 +143,9 @@ class Cook(object):
         suffix_normal = ['.conf', '.conffiles', '.mime', '.service']
         suffix_script = ['.init', '.preinst', '.postinst', '.prerm', '.postrm']
         dest_base = pjoin(self._env['QPKG_DEST_DATA'], '.qdk2')
-        makedirs(dest_base)
+        makedirs(self.output(dest_base))
+        tpl_vars = dict((k, v) for k, v in self._env.iteritems()
+                        if k.startswith('QPKG_'))
         for suffix in suffix_normal + suffix_script:
             src = pjoin(Settings.CONTROL_PATH, package['package'] + suffix)
             dest = pjoin(dest_base, package['package'] + suffix)
@@ -129,13 +156,7 @@ class Cook(object):
                              package['package'] + suffix)
 
             # copy to destination and replace template variables
-            tpl_vars = [('%' + k + '%', v) for k, v in self._env.iteritems()
-                        if k.startswith('QPKG_')]
-            with open(src, 'r') as fin, open(dest, 'w+') as fout:
-                for line in fin:
-                    for k, v in tpl_vars:
-                        line = line.replace(k, v)
-                    fout.write(line)
+            Template(src).render_file(tpl_vars, self.output(dest))
             if suffix in suffix_script:
                 chmod(dest, 0755)
             else:
@@ -144,14 +165,14 @@ class Cook(object):
     def icons(self):
         debug(self._label + 'icon files')
         dest_base = pjoin(self._env['QPKG_DEST_CONTROL'], 'icons')
-        makedirs(dest_base)
+        makedirs(self.output(dest_base))
         package_name = self._package['package']
         icons = (('.icon.64', '.gif'), ('.icon.80', '_80.gif'),
                  ('.icon.gray', '_gray.gif'),
                  )
         for suffix, rsuffix in icons:
             src = pjoin(Settings.CONTROL_PATH, package_name + suffix)
-            dest = pjoin(dest_base, package_name + rsuffix)
+            dest = self.output(pjoin(dest_base, package_name + rsuffix))
             if not pexists(src):
                 warning('Missing: ' + src)
                 copy(pjoin(Settings.TEMPLATE_PATH, Settings.CONTROL_PATH,
@@ -219,8 +240,8 @@ class Cook(object):
             r'}',
         )
 
-        with open(pjoin(self._env['QPKG_DEST_CONTROL'],
-                        'package_routines'), 'w+') as f:
+        with open(self.output(pjoin(self._env['QPKG_DEST_CONTROL'],
+                                    'package_routines')), 'w+') as f:
             f.write('\n'.join(content))
 
     def qpkg_cfg(self):
@@ -259,28 +280,21 @@ class Cook(object):
         for k, v in self._env.iteritems():
             if k.startswith('QPKG_'):
                 env[k] = v
-        with open(pjoin(self._env['QPKG_DEST_CONTROL'],
-                        'qpkg.cfg'), 'w+') as f:
+        with open(self.output(pjoin(self._env['QPKG_DEST_CONTROL'],
+                                    'qpkg.cfg')), 'w+') as f:
             f.write(('\n'.join(content)).format(env))
 
     def list(self):
-        debug(self._label + 'list')
-        # list
-        #   links
-        #   dirs
-        pass
+        # every path of the package, kept in memory for the later recipes;
+        # no packager reads a list file
+        debug(self._label + 'list: {} paths'.format(len(self.manifest)))
 
     def conffiles(self):
         debug(self._label + 'conffiles')
-        etc_path = pjoin(self._env['QPKG_DEST_DATA'], 'etc')
-        conffiles = pjoin(self._env['QPKG_DEST_CONTROL'], 'conffiles')
+        conffiles = self.output(pjoin(self._env['QPKG_DEST_CONTROL'],
+                                      'conffiles'))
+        conf_list = ['/' + e.path for e in self.manifest.under('etc', 'f')]
         with open(conffiles, 'w+') as fout:
-            conf_list = []
-            for root, dirs, files in walk(etc_path):
-                for f in files:
-                    if isfile(pjoin(root, f)) and not islink(pjoin(root, f)):
-                        conf_list.append(
-                            pjoin(root[len(self._env['QPKG_DEST_DATA']):], f))
             fout.writelines('\n'.join(conf_list))
             filesize = fout.tell()
         if filesize == 0:
@@ -291,46 +305,54 @@ class Cook(object):
         data_root = self._env['QPKG_DEST_DATA']
         bin_path = ['bin', 'sbin', 'usr/bin', 'usr/sbin',
                     'usr/local/bin', 'usr/local/sbin', 'etc/init.d']
-        for root, dirs, files in walk(data_root):
-            fixperm = False
-            if root in [pjoin(data_root, d) for d in bin_path]:
-                chmod(root, 0755)
-                fixperm = True
-            for f in files:
-                if isfile(pjoin(root, f)):
-                    # check setuid/setgid bits permissions
-                    fstat = os.stat(pjoin(root, f))
-                    if fstat.st_mode & stat.S_ISUID:
-                        warning('{} has setuid attribute'
-                                .format(pjoin(root[len(data_root):], f)))
-                    if fstat.st_mode & stat.S_ISGID:
-                        warning('{} has setgid attribute'
-                                .format(pjoin(root[len(data_root):], f)))
-                    if fixperm:
-                        chmod(pjoin(root, f), fstat.st_mode | 755)
+        for d in bin_path:
+            if d in self.manifest and self.manifest.get(d).type == 'd':
+                chmod(pjoin(data_root, d), 0755)
+                self.manifest.update(d, mode=stat.S_IFDIR | 0755)
+        for e in self.manifest:
+            if e.type != 'f':
+                continue
+            # check setuid/setgid bits permissions
+            if e.mode & stat.S_ISUID:
+                warning('/{} has setuid attribute'.format(e.path))
+            if e.mode & stat.S_ISGID:
+                warning('/{} has setgid attribute'.format(e.path))
+            if pdirname(e.path) in bin_path:
+                path = pjoin(data_root, e.path)
+                # don't change the mode of a file shared with the build area
+                # (see Installer)
+                if e.nlink > 1:
+                    self._installer.unshare(path)
+                    self.manifest.update(e.path, inode=lstat(path).st_ino,
+                                         nlink=1)
+                chmod(path, e.mode | 755)
+                self.manifest.update(e.path, mode=e.mode | 755)
 
     def signature(self):
         debug(self._label + 'signature')
         # TODO: add gpg
-        with open(pjoin(self._env['QPKG_DEST_CONTROL'], 'qpkg-version'),
-                  'w') as f:
+        with open(self.output(pjoin(self._env['QPKG_DEST_CONTROL'],
+                                    'qpkg-version')), 'w') as f:
             f.write(Settings.QPKG_VERSION)
         pass
 
     def md5sums(self):
         debug(self._label + 'md5sum')
         data_root = self._env['QPKG_DEST_DATA']
-        md5sums = pjoin(self._env['QPKG_DEST_CONTROL'], 'md5sums')
-        md5_list = []
-        for root, dirs, files in walk(data_root):
-            if root.startswith(pjoin(data_root, 'etc')):
-                continue
-            for f in files:
-                fpath = pjoin(root, f)
-                if isfile(fpath) and not islink(fpath):
-                    md5_list.append('{}  {}'.format(
-                        hashlib.md5(open(fpath).read()).hexdigest(),
-                        fpath[len(data_root) + 1:]))
+        md5sums = self.output(pjoin(self._env['QPKG_DEST_CONTROL'],
+                                    'md5sums'))
+        paths = [e.path for e in self.manifest if e.type == 'f' and
+                 not pdirname(e.path).startswith('etc')]
+        digester = Digester('md5', cache=self._digest_cache)
+        with span('hash', 'cook') as args:
+            md5_list = ['{}  {}'.format(digest, path) for digest, path in zip(
+                digester.hexdigests([pjoin(data_root, p) for p in paths]),
+                paths)]
+            args.update(files=digester.files, bytes=digester.bytes,
+                        cached=digester.hits)
+        if self._digest_cache is not None:
+            self._digest_cache.flush()
+        debug(self._label + 'md5sum ' + digester.report())
 
         with open(md5sums, 'w+') as fout:
             fout.writelines('\n'.join(md5_list))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+from os import stat as os_stat, makedirs, unlink
+from os.path import (exists as pexists,
+                     join as pjoin,
+                     dirname as pdirname,
+                     abspath as pabspath,
+                     )
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
+import hashlib
+import sqlite3
+import time
+
+from settings import Settings
+
+
+class Digester(object):
+    """Hash files on a pool of threads
+
+    Files are read bufsize bytes at a time into a buffer owned by the
+    thread, so memory stays bounded by workers * bufsize whatever the size
+    of the files. hashlib releases the GIL while hashing large buffers and
+    reads release it too, so the threads run in parallel. With a
+    DigestCache, only the files missing from the cache are read.
+    """
+    def __init__(self, algorithm='md5', workers=None, bufsize=None,
+                 cache=None):
+        self._algorithm = algorithm
+        self._workers = max(1, workers or Settings.HASH_WORKERS)
+        self._bufsize = bufsize or Settings.HASH_BUFSIZE
+        self._cache = cache
+        self._lock = Lock()
+        self._local = local()
+        self.hits = 0
+        self.files = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def hexdigests(self, paths):
+        """Return the hex digests of paths, in the same order
+        """
+        start = time.time()
+        if self._cache is not None:
+            stats = [os_stat(path) for path in paths]
+            result = [self._cache.lookup(self._algorithm, path, st)
+                      for path, st in zip(paths, stats)]
+            misses = [i for i, digest in enumerate(result) if digest is None]
+            self.hits += len(paths) - len(misses)
+        else:
+            result = [None] * len(paths)
+            misses = range(len(paths))
+
+        digests = self._map([paths[i] for i in misses])
+        for i, digest in zip(misses, digests):
+            result[i] = digest
+            if self._cache is not None:
+                self._cache.store(self._algorithm, paths[i], stats[i], digest)
+        self.elapsed += time.time() - start
+        return result
+
+    def _map(self, paths):
+        workers = min(self._workers, len(paths))
+        if workers <= 1:
+            return [self.hexdigest(path) for path in paths]
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(self.hexdigest, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def hexdigest(self, path):
+        h = hashlib.new(self._algorithm)
+        if not hasattr(self._local, 'buf'):
+            self._local.buf = bytearray(self._bufsize)
+        buf = self._local.buf
+        view = memoryview(buf)
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+                size += n
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+        return h.hexdigest()
+
+    def report(self):
+        elapsed = self.elapsed or 1e-9
+        return '{} cached, {} files, {} bytes hashed in {:.2f}s' \
+            ' with {} threads ({:.1f} MB/s)' \
+            .format(self.hits, self.files, self.bytes, self.elapsed,
+                    self._workers, self.bytes / elapsed / (1 << 20))
+
+
+class DigestCache(object):
+    """Persistent digests of files, shared by every build
+
+    A digest is found by the path of the file, its size and its mtime; the
+    build area is recreated on every build, and copies into it keep the
+    mtime. The inode alone is no identity: the inodes of the files removed
+    with the build area are reused for others. Otherwise the content is
+    hashed again.
+
+    Files modified within RACY_SECONDS of being hashed are not stored; a
+    second write in the same timestamp granule would go unnoticed. Least
+    recently used entries beyond max_entries are evicted by flush().
+    """
+    FILENAME = 'digests-v1.sqlite'
+    RACY_SECONDS = 2
+
+    def __init__(self, path=None, max_entries=None):
+        self._path = pjoin(path or Settings.CACHE_PATH, self.FILENAME)
+        self._max_entries = max_entries or Settings.DIGEST_CACHE_ENTRIES
+        self._used = []
+
+    @property
+    def db(self):
+        # connected on first use, i.e. in the process that uses it
+        if not hasattr(self, '_db'):
+            if not pexists(pdirname(self._path)):
+                try:
+                    makedirs(pdirname(self._path))
+                except OSError:
+                    # created by a concurrent build
+                    pass
+            self._db = sqlite3.connect(self._path, timeout=60)
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS digests (
+                    algorithm TEXT, path TEXT, dev INTEGER, ino INTEGER,
+                    size INTEGER, mtime_ns INTEGER, digest TEXT,
+                    used INTEGER,
+                    PRIMARY KEY (algorithm, path));
+                DROP INDEX IF EXISTS by_inode;
+                ''')
+        return self._db
+
+    def lookup(self, algorithm, path, st):
+        row = self.db.execute(
+            'SELECT rowid, digest FROM digests WHERE algorithm = ?'
+            ' AND path = ? AND size = ? AND mtime_ns = ?',
+            (algorithm, pabspath(path), st.st_size, self._mtime_ns(st))
+        ).fetchone()
+        if row is None:
+            return None
+        self._used.append(row[0])
+        return row[1]
+
+    def store(self, algorithm, path, st, digest):
+        if st.st_mtime >= time.time() - self.RACY_SECONDS:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (algorithm, pabspath(path), st.st_dev, st.st_ino, st.st_size,
+             self._mtime_ns(st), digest, int(time.time())))
+
+    def flush(self):
+        """Commit the new digests and evict the least recently used
+        """
+        if not hasattr(self, '_db'):
+            return
+        now = int(time.time())
+        self._db.executemany('UPDATE digests SET used = ? WHERE rowid = ?',
+                             ((now, rowid) for rowid in self._used))
+        self._used = []
+        count = self._db.execute('SELECT count(*) FROM digests').fetchone()[0]
+        if count > self._max_entries:
+            self._db.execute(
+                'DELETE FROM digests WHERE rowid IN (SELECT rowid FROM'
+                ' digests ORDER BY used LIMIT ?)', (count - self._max_entries,))
+        self._db.commit()
+
+    def close(self):
+        if hasattr(self, '_db'):
+            self.flush()
+            self._db.close()
+            del self._db
+
+    def clear(self):
+        """Drop every digest
+        """
+        self.close()
+        if pexists(self._path):
+            unlink(self._path)
+
+    def _mtime_ns(self, st):
+        return int(round(st.st_mtime * 1e9))
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
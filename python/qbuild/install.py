@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+from os import (makedirs, listdir, lstat, symlink, readlink, link, unlink,
+                rename, chmod, utime, lchown, mknod, close,
+                )
+from os.path import (join as pjoin,
+                     basename as pbasename,
+                     dirname as pdirname,
+                     normpath as pnormpath,
+                     )
+from shutil import copyfileobj, copy2
+from glob import glob
+import ctypes
+import ctypes.util
+import errno
+import stat
+import tempfile
+import time
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None, None
+    copy_file_range = getattr(libc, 'copy_file_range', None)
+    if copy_file_range is not None:
+        copy_file_range.restype = ctypes.c_ssize_t
+        copy_file_range.argtypes = (ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_size_t, ctypes.c_uint)
+    sendfile = getattr(libc, 'sendfile', None)
+    if sendfile is not None:
+        sendfile.restype = ctypes.c_ssize_t
+        sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                             ctypes.c_void_p, ctypes.c_size_t)
+    return copy_file_range, sendfile
+
+
+_copy_file_range, _sendfile = _load_libc()
+# errors meaning "not for these files", the next method is tried
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.EBADF)
+_CHUNK = 1 << 30
+
+
+class Installer(object):
+    """In-process `cp -a` for Cook recipes
+
+    Copies files, directories and symlinks with their modes, times,
+    ownership and extended attributes (when the xattr module is available).
+    File data is moved by copy_file_range(2) or sendfile(2) without passing
+    through Python, or hardlinked when hardlink is set and the staging tree
+    is on the same filesystem. Created directories are remembered so that
+    dirs, install and links share one directory-creation cache.
+    """
+    def __init__(self, hardlink=False):
+        self._hardlink = hardlink
+        self._dirs = set()
+        self._inodes = {}
+        self.files = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def makedirs(self, path):
+        path = pnormpath(path)
+        if path in self._dirs:
+            return
+        try:
+            makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        while path and path not in self._dirs and path != '/':
+            self._dirs.add(path)
+            path = pdirname(path)
+
+    def expand(self, entries):
+        """Expand [(pattern, dst)] to [(src, dst)]
+
+        Return the pairs and the index of the first pattern without any
+        match, or None.
+        """
+        result = []
+        for i, (pattern, dst) in enumerate(entries):
+            srcs = sorted(glob(pattern))
+            if not srcs:
+                return result, i
+            result.extend((src, dst) for src in srcs)
+        return result, None
+
+    def install(self, pairs):
+        """Copy each src into the directory dst, as `cp -a src dst/`
+        """
+        start = time.time()
+        for dst in sorted(set(dst for src, dst in pairs)):
+            self.makedirs(dst)
+        for src, dst in pairs:
+            self.copy(src, pjoin(dst, pbasename(src.rstrip('/'))))
+        self.elapsed += time.time() - start
+
+    def copy(self, src, dst):
+        st = lstat(src)
+        if stat.S_ISDIR(st.st_mode):
+            self.makedirs(dst)
+            for name in listdir(src):
+                self.copy(pjoin(src, name), pjoin(dst, name))
+        elif stat.S_ISLNK(st.st_mode):
+            if self._exists(dst):
+                unlink(dst)
+            symlink(readlink(src), dst)
+        elif stat.S_ISREG(st.st_mode):
+            if not self._link(src, dst, st):
+                self._copy_file(src, dst)
+                self.bytes += st.st_size
+            self.files += 1
+        else:
+            if self._exists(dst):
+                unlink(dst)
+            mknod(dst, st.st_mode, st.st_rdev)
+        self._copy_metadata(src, dst, st)
+
+    def unshare(self, path):
+        """Replace a hardlinked file by a private copy before modifying it
+        """
+        fd, tmp = tempfile.mkstemp(dir=pdirname(path))
+        close(fd)
+        copy2(path, tmp)
+        st = lstat(path)
+        self._copy_metadata(path, tmp, st)
+        rename(tmp, path)
+
+    def report(self):
+        elapsed = self.elapsed or 1e-9
+        return '{} files, {} bytes in {:.2f}s ({:.0f} files/s, {:.1f} MB/s)' \
+            .format(self.files, self.bytes, self.elapsed,
+                    self.files / elapsed, self.bytes / elapsed / (1 << 20))
+
+    def _exists(self, path):
+        try:
+            lstat(path)
+        except OSError:
+            return False
+        return True
+
+    def _link(self, src, dst, st):
+        # keep hardlinks among the copied files, like cp -a
+        key = (st.st_dev, st.st_ino)
+        target = src if self._hardlink else self._inodes.get(key)
+        if target is None:
+            if st.st_nlink > 1:
+                self._inodes[key] = dst
+            return False
+        if self._exists(dst):
+            unlink(dst)
+        try:
+            link(target, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            self._hardlink = False
+            return False
+        return True
+
+    def _copy_file(self, src, dst):
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            for syscall in (self._copy_file_range, self._sendfile):
+                if syscall(fin.fileno(), fout.fileno()):
+                    return
+            # unsupported here; go on from the current offsets
+            copyfileobj(fin, fout, 1 << 20)
+
+    def _copy_file_range(self, fin, fout):
+        if _copy_file_range is None:
+            return False
+        return self._syscall_loop(
+            lambda: _copy_file_range(fin, None, fout, None, _CHUNK, 0))
+
+    def _sendfile(self, fin, fout):
+        if _sendfile is None:
+            return False
+        return self._syscall_loop(lambda: _sendfile(fout, fin, None, _CHUNK))
+
+    def _syscall_loop(self, call):
+        while True:
+            n = call()
+            if n == 0:
+                return True
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in _UNSUPPORTED:
+                    return False
+                raise OSError(err, 'copy: ' + errno.errorcode.get(err, ''))
+
+    def _copy_metadata(self, src, dst, st):
+        try:
+            lchown(dst, st.st_uid, st.st_gid)
+        except OSError:
+            # not privileged; cp -a silently keeps our own ownership too
+            pass
+        if stat.S_ISLNK(st.st_mode):
+            return
+        chmod(dst, stat.S_IMODE(st.st_mode))
+        if xattr is not None:
+            try:
+                for name in xattr.listxattr(src):
+                    xattr.setxattr(dst, name, xattr.getxattr(src, name))
+            except (IOError, OSError):
+                pass
+        utime(dst, (st.st_atime, st.st_mtime))
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+from os import pipe, write, close, fstat, open as os_open, O_RDWR
+import re
+
+from log import debug
+
+
+class Jobserver(object):
+    """GNU make jobserver shared by every QNAP/rules of a build
+
+    The pipe holds jobs - 1 tokens; every make started by QNAP/rules, and
+    every make they start in turn, takes a token per job beyond its first
+    one. The workers of a parallel build each have an implicit slot, as
+    make has for its first job, in which they cook and pack; tokens only
+    bound the extra jobs of make. When qdk2 itself runs under make -jN,
+    the jobserver of that make is joined instead of creating one.
+    """
+    AUTH_REOBJ = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+
+    def __init__(self, jobs, makeflags=''):
+        self._jobs = jobs
+        self._owner = False
+        self._fifo = None
+        self._fds = self._inherited(makeflags)
+        if self._fds is None and jobs > 1:
+            self._fds = pipe()
+            self._owner = True
+            write(self._fds[1], '+' * (jobs - 1))
+        if self._fds is not None:
+            debug('jobserver {} fds {},{}'.format(
+                'with {} jobs'.format(jobs) if self._owner else 'of make',
+                *self._fds))
+
+    @property
+    def enabled(self):
+        return self._fds is not None
+
+    def environ(self, env):
+        """env for a QNAP/rules sharing the jobserver
+        """
+        if not self.enabled:
+            return env
+        if self._owner:
+            flags = [f for f in env.get('MAKEFLAGS', '').split()
+                     if not f.startswith(('-j', '--jobserver-'))]
+            # --jobserver-fds is understood by make 3.8x and 4.x alike
+            env['MAKEFLAGS'] = ' '.join(
+                ['-j', '--jobserver-fds={},{}'.format(*self._fds)] + flags)
+        options = [o for o in env.get('DEB_BUILD_OPTIONS', '').split()
+                   if not o.startswith('parallel=')]
+        if self._jobs > 1:
+            options.append('parallel={}'.format(self._jobs))
+        env['DEB_BUILD_OPTIONS'] = ' '.join(options)
+        return env
+
+    def close(self):
+        if self._owner:
+            close(self._fds[0])
+            close(self._fds[1])
+        elif self._fifo is not None:
+            close(self._fifo)
+        self._fds = None
+
+    def _inherited(self, makeflags):
+        reobj = self.AUTH_REOBJ.search(makeflags)
+        if reobj is None:
+            return None
+        auth = reobj.group(1)
+        try:
+            if auth.startswith('fifo:'):
+                # make >= 4.4
+                self._fifo = os_open(auth[len('fifo:'):], O_RDWR)
+                return self._fifo, self._fifo
+            fds = tuple(int(fd) for fd in auth.split(','))
+            for fd in fds:
+                fstat(fd)
+            return fds
+        except (ValueError, OSError):
+            # make did not pass the pipe to qdk2, e.g. the rule lacks a '+'
+            debug('jobserver of make unusable: ' + auth)
+            return None
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
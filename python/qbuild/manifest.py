@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+from os import listdir, lstat
+from os.path import join as pjoin
+from collections import namedtuple
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# path is relative to the root of the manifest; type is one of
+# 'f' (regular file), 'd' (directory), 'l' (symlink) or 'o' (other)
+Entry = namedtuple('Entry', 'path type mode size inode nlink mtime')
+
+
+def _type(mode):
+    if stat.S_ISREG(mode):
+        return 'f'
+    if stat.S_ISDIR(mode):
+        return 'd'
+    if stat.S_ISLNK(mode):
+        return 'l'
+    return 'o'
+
+
+class Manifest(object):
+    """Typed listing of a staging tree, scanned once
+
+    Every entry is lstat'ed exactly once; recipes walking QPKG_DEST_DATA
+    share the result instead of calling os.walk and os.stat themselves.
+    Entries are in the order of os.walk: those of a directory, in listdir
+    order, before those of its subdirectories. md5sums and conffiles are
+    written in this order, as they were with os.walk.
+    """
+    def __init__(self, root):
+        self._root = root
+        self._entries = []
+        self._scan('')
+        self._index = dict((e.path, i) for i, e in enumerate(self._entries))
+
+    @property
+    def root(self):
+        return self._root
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._index
+
+    def get(self, path):
+        return self._entries[self._index[path]]
+
+    def update(self, path, **fields):
+        i = self._index[path]
+        self._entries[i] = self._entries[i]._replace(**fields)
+
+    def under(self, directory, types=None):
+        """Entries below directory (relative path), optionally by type
+        """
+        prefix = directory.rstrip('/') + '/'
+        return [e for e in self._entries if e.path.startswith(prefix)
+                and (types is None or e.type in types)]
+
+    def _scan(self, rel):
+        subdirs = []
+        for name, st in self._list(rel):
+            path = pjoin(rel, name) if rel else name
+            entry = Entry(path, _type(st.st_mode), st.st_mode, st.st_size,
+                          st.st_ino, st.st_nlink, st.st_mtime)
+            self._entries.append(entry)
+            if entry.type == 'd':
+                subdirs.append(path)
+        for path in subdirs:
+            self._scan(path)
+
+    def _list(self, rel):
+        directory = pjoin(self._root, rel)
+        if scandir is not None:
+            for e in scandir(directory):
+                yield e.name, e.stat(follow_symlinks=False)
+        else:
+            for name in listdir(directory):
+                yield name, lstat(pjoin(directory, name))
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
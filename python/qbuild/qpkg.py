@@ -0,0 +1,881 @@
+#!/usr/bin/env python
+
+from os import (walk, listdir, lstat, getuid, getgid, getenv, umask, chmod,
+                rename, unlink, fdopen, makedirs,
+                )
+from os.path import (exists as pexists,
+                     join as pjoin,
+                     basename as pbasename,
+                     dirname as pdirname,
+                     isdir,
+                     isfile,
+                     relpath,
+                     )
+from cStringIO import StringIO
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import bz2
+import grp
+import hashlib
+import pwd
+import struct
+import subprocess
+import tarfile
+import tempfile
+import time
+import zlib
+
+from log import debug, warning
+from settings import Settings
+from exception import BuildingError
+from tracing import span
+from qpkgfile import TAIL_LEN, TAIL_FLAG, parse_cfg
+
+
+# see qpkg_encrypt.c
+ENCRYPT_KEY = 3589
+ENCRYPT_OFFSET = 60
+
+# gzip member header as written by GNU gzip reading a pipe: no file name,
+# no time, OS Unix
+GZIP_HEADER = '\037\213\010\000\000\000\000\000\000\003'
+
+# The lengths of the data and extra packages in the header are padded with
+# spaces to this width, so that they can be written once the packages are.
+LENGTH_WIDTH = 15
+
+# the header script written by add_qpkg_header, in %-format
+HEADER_FIND_BASE = r'''#!/bin/sh
+find_base(){
+HDD_MOUNT=`/sbin/getcfg Public path -f /etc/config/smb.conf`
+local log_tool="/sbin/log_tool -t2 -uSystem -p127.0.0.1 -mlocalhost -a"
+
+if [ -e "$HDD_MOUNT" ]; then
+if [ -z "$QINSTALL_PATH" ]; then
+BASE_GROUP="/share/HDA_DATA /share/HDB_DATA /share/HDC_DATA /share/HDD_DATA /share/HDE_DATA /share/HDF_DATA /share/HDG_DATA /share/HDH_DATA /share/HDI_DATA /share/HDJ_DATA /share/HDK_DATA /share/HDL_DATA /share/MD0_DATA /share/MD1_DATA /share/MD2_DATA /share/MD3_DATA"
+publicdir=`/sbin/getcfg Public path -f /etc/config/smb.conf`
+if [ ! -z $publicdir ] && [ -d $publicdir ];then
+publicdirp1=`/bin/echo $publicdir | /bin/cut -d "/" -f 2`
+publicdirp2=`/bin/echo $publicdir | /bin/cut -d "/" -f 3`
+publicdirp3=`/bin/echo $publicdir | /bin/cut -d "/" -f 4`
+if [ ! -z $publicdirp1 ] && [ ! -z $publicdirp2 ] && [ ! -z $publicdirp3 ]; then
+[ -d "/${publicdirp1}/${publicdirp2}/Public" ] && QPKG_BASE="/${publicdirp1}/${publicdirp2}"
+fi
+fi
+
+# Determine BASE installation location by checking where the Public folder is.
+if [ -z $QPKG_BASE ]; then
+for datadirtest in $BASE_GROUP; do
+[ -d $datadirtest/Public ] && QPKG_BASE="/${publicdirp1}/${publicdirp2}"
+done
+fi
+if [ -z $QPKG_BASE ] ; then
+echo "The Public share not found."
+return 1
+fi
+QPKG_INSTALL_PATH="${QPKG_BASE}/.qpkg"
+QPKG_DIR="${QPKG_INSTALL_PATH}/${QPKG_NAME}"
+else
+if [ -e "$QINSTALL_PATH" ]; then
+QPKG_INSTALL_PATH="${QINSTALL_PATH}"
+QPKG_DIR="${QINSTALL_PATH}/${QPKG_NAME}"
+else
+if [ -x "/usr/local/sbin/notify" ]; then
+/usr/local/sbin/notify send -A A039 -C C001 -M 50 -l error -t 3 "[{0}] {1} install failed due to QTS application install volume not found." "%(prefix)s" "%(display_name)s"
+echo -1 > /tmp/update_process && exit 1
+else
+%(log_tool)s "[%(prefix)s] Failed to install %(display_name)s. The selected installation volume is missing."
+fi
+echo -1 > /tmp/update_process && exit 1
+fi
+fi
+return 0
+else
+if [ %(allow_no_volume)d = 1 ] && [ -d "/mnt/HDA_ROOT/update_pkg" ]; then
+QPKG_INSTALL_PATH="/mnt/HDA_ROOT/update_pkg"
+QPKG_DIR="${QPKG_INSTALL_PATH}/%(name)s"
+_EXTRACT_DIR="/tmp/%(name)s"
+else
+if [ -x "/usr/local/sbin/notify" ]; then
+/usr/local/sbin/notify send -A A039 -C C001 -M 50 -l error -t 3 "[{0}] {1} install failed due to QTS application install volume not found." "%(prefix)s" "%(display_name)s"
+echo -1 > /tmp/update_process && exit 1
+else
+%(log_tool)s "[%(prefix)s] Failed to install %(display_name)s. The selected installation volume is missing."
+fi
+echo -1 > /tmp/update_process && exit 1
+fi
+fi
+}
+'''
+HEADER_ARCH = r'''wrong_arch(){
+if [ -x "/usr/local/sbin/notify" ]; then
+/usr/local/sbin/notify send -A A039 -C C001 -M 51 -l error -t 3 "[{0}] {1} {2} install failed due to the platform is incompatible. Please use correct package for installation." "%(prefix)s" "%(display_name)s" "%(version)s"
+echo -1 > /tmp/update_process && exit 1
+else
+local wrong_arch_msg="[%(prefix)s] Failed to install %(display_name)s %(version)s. Installation package is incompatible. Use the correct package."
+echo "Installation Abort." && echo "$wrong_arch_msg"
+%(log_tool)s "[%(prefix)s] Failed to install %(display_name)s %(version)s. Installation package is incompatible. Use the correct package."
+echo -1 > /tmp/update_process && exit 1
+fi
+}
+arch_ok(){
+local cpu_arch=$(/bin/uname -m)
+local reject_platform=$(/sbin/getcfg "" Platform -f /etc/platform.conf)
+if [ $(/usr/bin/expr match "$reject_platform" "%(reject_platform)s") == 0 ]; then
+[ $(/usr/bin/expr match "$cpu_arch" "%(cpu_arch)s") -ne 0 ] || return 1
+else
+return 1
+fi
+}
+'''
+HEADER_INSTALL = r'''/bin/echo "Install QNAP package on TS-NAS..."
+/bin/grep "/mnt/HDA_ROOT" /proc/mounts >/dev/null 2>&1 || exit 1
+'''
+HEADER_EXTRACT = r'''find_base
+_EXTRACT_DIR="$QPKG_INSTALL_PATH/.tmp"
+/bin/mkdir -p $_EXTRACT_DIR || exit 1
+script_len=%(script_len)s
+/bin/dd if="${0}" bs=$script_len skip=1 | /bin/tar -xO | /bin/tar -xzv -C $_EXTRACT_DIR || exit 1
+offset=$(/usr/bin/expr $script_len + %(ctrl_len)d)
+/bin/dd if="${0}" bs=$offset skip=1 | /bin/cat | /bin/dd bs=1024 count=%(data_blocks)s of=$_EXTRACT_DIR/%(data_file)s || exit 1
+[ -f /usr/local/bin/python ] && /usr/local/bin/python -c "with open('$_EXTRACT_DIR/%(data_file)s', 'rw+') as f: f.seek(%(data_len)s); f.truncate()"
+offset=$(/usr/bin/expr $offset + %(data_len)s)
+'''
+HEADER_EXTRA = r'''/bin/dd if=${0} bs=$offset skip=1 | /bin/tar -xv -C $_EXTRACT_DIR || exit 1
+offset=$(/usr/bin/expr $offset + %(extra_len)s)
+'''
+HEADER_END = r'''( cd $_EXTRACT_DIR && /bin/sh %(install_script)s || echo "Installation Abort." )
+/bin/rm -fr $_EXTRACT_DIR && exit %(retval)d
+exit 1
+'''
+
+
+def gzip_member(data, level=6):
+    """data compressed into a complete gzip member
+    """
+    compress = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zlib.DEF_MEM_LEVEL, 0)
+    return ''.join((GZIP_HEADER, compress.compress(data), compress.flush(),
+                    struct.pack('<LL', zlib.crc32(data) & 0xffffffff,
+                                len(data) & 0xffffffff)))
+
+
+class GzipWriter(object):
+    """gzip stream as written by `gzip` reading a pipe
+
+    The header has neither file name nor time, like GNU gzip, so that the
+    output is the same for the same input.
+    """
+    def __init__(self, fileobj, level=6, workers=1):
+        self._fileobj = fileobj
+        self._compress = zlib.compressobj(level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                          0)
+        self._crc = zlib.crc32('') & 0xffffffff
+        self._size = 0
+        self._fileobj.write(GZIP_HEADER)
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc) & 0xffffffff
+        self._size += len(data)
+        self._fileobj.write(self._compress.compress(data))
+
+    def close(self):
+        self._fileobj.write(self._compress.flush())
+        self._fileobj.write(struct.pack('<LL', self._crc,
+                                        self._size & 0xffffffff))
+
+
+class ParallelGzipWriter(object):
+    """Multi-member gzip stream compressed on a pool of threads
+
+    The input is cut into blocks of BLOCK_SIZE bytes and every block is
+    compressed into a gzip member of its own; members are written in input
+    order. GNU gzip and `tar -xz` read concatenated members as one stream;
+    QpkgWriter only writes it when QDK_COMPRESS_METHOD asks for threads.
+    zlib releases the GIL while compressing, so the threads use all
+    the cores; at most two blocks per thread are in memory. The output does
+    not depend on the number of threads.
+    """
+    BLOCK_SIZE = 1 << 22
+
+    def __init__(self, fileobj, level=6, workers=None, block_size=None):
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = block_size or self.BLOCK_SIZE
+        self._workers = max(1, workers or cpu_count())
+        self._pool = ThreadPool(self._workers)
+        self._pending = deque()
+        self._buf = []
+        self._buffered = 0
+        self._members = 0
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            data = ''.join(self._buf)
+            end = len(data) - len(data) % self._block_size
+            for i in xrange(0, end, self._block_size):
+                self._submit(data[i:i + self._block_size])
+            self._buf = [data[end:]]
+            self._buffered = len(data) - end
+
+    def close(self):
+        try:
+            if self._buffered or not self._members:
+                # an empty input is still a gzip stream
+                self._submit(''.join(self._buf))
+            self._buf = []
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().get())
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+
+    def _submit(self, block):
+        self._pending.append(self._pool.apply_async(gzip_member,
+                                                    (block, self._level)))
+        self._members += 1
+        while len(self._pending) > 2 * self._workers:
+            self._fileobj.write(self._pending.popleft().get())
+
+
+class Bzip2Writer(object):
+    def __init__(self, fileobj, level=9, workers=1):
+        self._fileobj = fileobj
+        self._compress = bz2.BZ2Compressor(level)
+
+    def write(self, data):
+        self._fileobj.write(self._compress.compress(data))
+
+    def close(self):
+        self._fileobj.write(self._compress.flush())
+
+
+class XzWriter(object):
+    """Pipe through xz(1); Python 2 has no lzma module
+
+    With more than one thread xz splits the stream into independent blocks
+    compressed in parallel; any xz can decompress it. Given block_size, the
+    blocks and so the output do not depend on the number of threads.
+    """
+    BLOCK_SIZE = 3 << 23
+
+    def __init__(self, fileobj, level=6, workers=1, block_size=None):
+        cmd = ['xz', '-{}'.format(level),
+               '-T{}'.format(workers or cpu_count()), '-c']
+        if block_size:
+            cmd.append('--block-size={}'.format(block_size))
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                      stdout=fileobj)
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def close(self):
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+            raise BuildingError('xz failed: {}'.format(self._proc.returncode))
+
+
+def parse_compress_method(value):
+    """(method, level, threads) of a QDK_COMPRESS_METHOD value
+
+    The value is METHOD[:LEVEL[:THREADS]], e.g. "gzip", "xz:9" or
+    "gzip:6:4". Level and threads are None when not given; 0 threads means
+    one per core. ValueError is raised for anything else.
+    """
+    fields = value.split(':')
+    if len(fields) > 3 or not fields[0]:
+        raise ValueError(value)
+    fields += [''] * (3 - len(fields))
+    level, threads = [int(f) if f else None for f in fields[1:]]
+    if threads is not None and threads < 0:
+        raise ValueError(value)
+    return fields[0], level, threads
+
+
+def parse_qpkg_cfg(path):
+    """Return the assignments of a qpkg.cfg as a dict
+
+    Only plain NAME="value" assignments are understood; ValueError is raised
+    for anything that needs a shell to be evaluated.
+    """
+    with open(path) as f:
+        return parse_cfg(f)
+
+
+class QpkgWriter(object):
+    """Pure-Python replacement of `qbuild` for the QDK2 control folders
+
+    Builds the same .qpkg as `qbuild` run in path: header script,
+    control.tar (holding control.tar.gz), data.tar.{gz,bz2,xz}, optional
+    extra.tar and the 100-byte tail with the qpkg_encrypt checksum. The data
+    is streamed from the shared folder straight into the package, without
+    any intermediate copy. Archives list their members in sorted order.
+
+    Given source_date_epoch, the package is reproducible: owners are root,
+    times are clamped to source_date_epoch, modes do not depend on the
+    umask of the builder and the compressed data does not depend on the
+    number of cores. The same inputs then give the same bytes.
+
+    Packages needing code signing, a gpg signature, architecture folders or
+    any QDK_* hook in qpkg.cfg are left to `qbuild`; see unsupported().
+    """
+    PREFIX = 'App Center'
+    LOG_TOOL = '/sbin/log_tool -t2 -uSystem -p127.0.0.1 -mlocalhost -a'
+    # method -> (data file, writer, default level, levels)
+    COMPRESSORS = {
+        'gzip': ('data.tar.gz', GzipWriter, 6, range(1, 10)),
+        'bzip2': ('data.tar.bz2', Bzip2Writer, 9, range(1, 10)),
+        'xz': ('data.tar.xz', XzWriter, 6, range(0, 10)),
+    }
+    # add_qpkg_header: architecture -> (cpu_arch, reject_platform)
+    ARCHITECTURES = {
+        'arm-x09': ('armv5tejl', ''),
+        'arm-x19': ('armv5tel', ''),
+        'arm-x31': ('armv7l', 'ARM_AL'),
+        'arm-x41': ('armv7l', 'ARM_MS'),
+        'arm_64': ('aarch64', ''),
+        'x86': (r'i.86\|x86_64', 'X86_EVANSPORT'),
+        'x86_ce53xx': ('i686', r'X86_LAKEPORT\|X86_ATOM'),
+        'x86_64': ('x86_64', ''),
+    }
+    ARCH_DIRS = ('arm-x09', 'arm-x19', 'arm-x31', 'arm-x41', 'arm_64', 'x86',
+                 'x86_64', 'x86_ce53xx')
+    # qbuild options understood here; the others need qbuild itself
+    OPTIONS = ('-q', '--quiet', '-v', '--verbose', '--gzip', '--bzip2',
+               '--xz', '--allow-no-volume', '--force-config', '--build-dir',
+               '--build-model', '--build-number', '--build-version')
+
+    def __init__(self, path, args=(), source_date_epoch=None):
+        self._path = path
+        self._source_date_epoch = source_date_epoch
+        self._qdk_path = pdirname(pdirname(Settings.QBUILD))
+        self._compress = getenv('QDK_COMPRESS_METHOD') or 'gzip'
+        self._xz_arch = getenv('QDK_XZ_ARCH', '')
+        self._allow_no_volume = False
+        self._force_config = False
+        self._build_dir = 'build'
+        self._model = ''
+        self._release = None
+        self._version = None
+        self._unsupported = self._parse_args(list(args))
+
+    def unsupported(self):
+        """Reason why qbuild is needed for this package, or None
+        """
+        if self._unsupported:
+            return self._unsupported
+        if pexists(Settings.QDK_USER_CONFIG) or \
+                pexists('/etc/config/qdk.conf'):
+            return 'QDK configuration file'
+        cfg_file = pjoin(self._path, 'qpkg.cfg')
+        try:
+            cfg = parse_qpkg_cfg(cfg_file)
+        except (IOError, ValueError) as e:
+            return 'qpkg.cfg: {}'.format(e)
+        for k in cfg:
+            if k.startswith('QDK_') and \
+                    k not in ('QDK_EXTRA_FILE', 'QDK_EXTRA_SRC_FILE',
+                              'QDK_COMPRESS_METHOD'):
+                return 'qpkg.cfg: ' + k
+        if getenv('QNAP_CODE_SIGNING') == '1' or getenv('QDK_SIGN') or \
+                any(pexists(pjoin(self._path, f)) for f in
+                    ('private_key', 'certificate', 'certificate_hsm')):
+            return 'signing'
+        if any(self._nonempty(pjoin(self._path, d)) for d in self.ARCH_DIRS):
+            return 'architecture folders'
+        method = self._compression(cfg)[0]
+        if method not in self.COMPRESSORS:
+            return 'compression ' + method
+        return None
+
+    def build(self):
+        """Write the package into <path>/build; return its path
+        """
+        start = time.time()
+        cfg = self._config()
+        name = cfg['QPKG_NAME']
+        release = self._release or cfg.get('QPKG_RELEASE', '')
+        filename = '{}_{}{}{}.qpkg'.format(
+            name, cfg['QPKG_VER'], '-' + release if release else '',
+            '_' + self._model if self._model else '')
+        data_file = self.COMPRESSORS[self._compression(cfg)[0]][0]
+
+        build_dir = pjoin(self._path, self._build_dir)
+        if not isdir(build_dir):
+            makedirs(build_dir, 0755)
+        with span('config', 'qpkg'):
+            md5sum, conf_tar = self._config_data(cfg)
+        with span('control', 'qpkg') as args:
+            control = self._control_package(cfg, md5sum, conf_tar).getvalue()
+            args['bytes'] = len(control)
+        extra_files = self._extra_files(cfg)
+
+        # The data and extra packages are streamed from the shared folder
+        # into the package; their lengths are patched into the header once
+        # known.
+        dest = pjoin(build_dir, filename)
+        fd, tmp = tempfile.mkstemp(dir=build_dir)
+        try:
+            with fdopen(fd, 'w+b') as f:
+                header = self._header(cfg, len(control), 0, data_file,
+                                      0 if extra_files else None)
+                f.write(header)
+                f.write(control)
+                start_data = f.tell()
+                with span('data', 'qpkg', file=data_file) as args:
+                    args['files'], args['tar_bytes'] = \
+                        self._data_package(f, cfg)
+                    data_len = f.tell() - start_data
+                    args['bytes'] = data_len
+                extra_len = None
+                if extra_files:
+                    with span('extra', 'qpkg') as args:
+                        self._extra_package(f, extra_files)
+                        extra_len = f.tell() - start_data - data_len
+                        args['bytes'] = extra_len
+                with span('header', 'qpkg'):
+                    patched = self._header(cfg, len(control), data_len,
+                                           data_file, extra_len)
+                    assert len(patched) == len(header)
+                    f.seek(0)
+                    f.write(patched)
+                    f.seek(0, 2)
+                    size = f.tell() + TAIL_LEN
+                    f.write(self._tail(cfg, size))
+            rename(tmp, dest)
+        except:
+            unlink(tmp)
+            raise
+        chmod(dest, 0644)
+        with span('md5', 'qpkg', bytes=size):
+            with open(dest + '.md5', 'w') as f:
+                f.write('{}  {}\n'.format(self._md5(dest),
+                                          pjoin(self._build_dir, filename)))
+        debug('QpkgWriter: {} ({} bytes) in {:.2f}s'.format(
+            dest, size, time.time() - start))
+        return dest
+
+    def _compression(self, cfg):
+        # qpkg.cfg is sourced by qbuild after the options are parsed
+        value = cfg.get('QDK_COMPRESS_METHOD') or self._compress
+        try:
+            return parse_compress_method(value)
+        except ValueError:
+            raise BuildingError('QDK_COMPRESS_METHOD: {}: expected'
+                                ' METHOD[:LEVEL[:THREADS]]'.format(value))
+
+    def _compressor(self, cfg, fileobj):
+        method, level, threads = self._compression(cfg)
+        writer, default_level, levels = self.COMPRESSORS[method][1:]
+        if level is None:
+            level = default_level
+        elif level not in levels:
+            raise BuildingError('QDK_COMPRESS_METHOD: {} level must be {}-{}'
+                                .format(method, levels[0], levels[-1]))
+        if method == 'gzip':
+            # multi-member gzip only when asked for: the installer of the
+            # firmware extracts the data with its own tar and gzip
+            if threads is None:
+                debug('QpkgWriter: gzip -{}'.format(level))
+                return GzipWriter(fileobj, level)
+            threads = threads or cpu_count()
+            debug('QpkgWriter: gzip -{} with {} threads'.format(level,
+                                                               threads))
+            # the same members whatever the number of threads
+            return ParallelGzipWriter(fileobj, level, threads)
+        threads = threads or cpu_count()
+        debug('QpkgWriter: {} -{} with {} threads'.format(method, level,
+                                                          threads))
+        if self._source_date_epoch is not None and method == 'xz':
+            # the same blocks whatever the number of threads; xz only splits
+            # in blocks with several threads
+            return XzWriter(fileobj, level, max(2, threads),
+                            XzWriter.BLOCK_SIZE)
+        return writer(fileobj, level, threads)
+
+    def _parse_args(self, args):
+        while args:
+            arg = args.pop(0)
+            if arg not in self.OPTIONS:
+                return 'qbuild option ' + arg
+            if arg in ('--gzip', '--bzip2'):
+                self._compress = arg[2:]
+            elif arg == '--xz':
+                self._compress = 'xz'
+                self._xz_arch = args.pop(0) if args else ''
+            elif arg == '--allow-no-volume':
+                self._allow_no_volume = True
+            elif arg == '--force-config':
+                self._force_config = True
+            elif arg in ('--build-dir', '--build-model', '--build-number',
+                         '--build-version'):
+                if not args:
+                    return arg + ': no value'
+                value = args.pop(0)
+                if arg == '--build-dir':
+                    self._build_dir = value
+                elif arg == '--build-model':
+                    self._model = value
+                elif arg == '--build-number':
+                    self._release = value
+                else:
+                    self._version = value
+        return None
+
+    def _config(self):
+        cfg_file = pjoin(self._path, 'qpkg.cfg')
+        cfg = parse_qpkg_cfg(cfg_file)
+        # the same checks and edits as qbuild
+        for field in ('QPKG_AUTHOR', 'QPKG_NAME', 'QPKG_VER'):
+            if not cfg.get(field):
+                raise BuildingError('{}: {} must be assigned a value'
+                                    .format(cfg_file, field))
+        if self._version:
+            self._edit_config(cfg, 'QPKG_VER', self._version)
+        if self._release:
+            self._edit_config(cfg, 'QPKG_RELEASE', self._release)
+        for field, length in (('QPKG_NAME', 40), ('QPKG_VER', 10)):
+            value = cfg[field].split(' ')[0][:length]
+            if value != cfg[field]:
+                warning('{}: the value {} is truncated'.format(field,
+                                                               cfg[field]))
+                self._edit_config(cfg, field, value)
+        return cfg
+
+    def _edit_config(self, cfg, field, value):
+        cfg_file = pjoin(self._path, 'qpkg.cfg')
+        with open(cfg_file) as f:
+            lines = f.read().split('\n')
+        line = '{}="{}"'.format(field, value)
+        for i, l in enumerate(lines):
+            if l.startswith(field + '='):
+                lines[i] = line
+                break
+        else:
+            lines.append(line)
+        with open(cfg_file, 'w') as f:
+            f.write('\n'.join(lines))
+        cfg[field] = value
+
+    def _config_data(self, cfg):
+        """md5sum lines and conf.tar.gz of the QPKG_CONFIG files
+        """
+        config_dir = pjoin(self._path, 'config')
+        lines = []
+        conf_tar = None
+        for path in cfg.get('QPKG_CONFIG', '').split():
+            if not path.startswith('/'):
+                src = pjoin(config_dir, path)
+                if not isfile(src):
+                    src = pjoin(self._path, 'shared', path)
+            else:
+                src = pjoin(config_dir, path[1:])
+            if isfile(src):
+                lines.append('{} = {}'.format(path, self._md5(src)))
+                if path.startswith('/'):
+                    if conf_tar is None:
+                        conf_tar = StringIO()
+                        tar = tarfile.open(fileobj=conf_tar, mode='w',
+                                           format=tarfile.GNU_FORMAT)
+                    tar.add(src, './' + path[1:], recursive=False,
+                            filter=self._normalize)
+            elif self._force_config:
+                lines.append('{} = 0'.format(path))
+            else:
+                raise BuildingError('{}: no such file; check your QPKG_CONFIG'
+                                    ' settings'.format(path))
+        if conf_tar is not None:
+            tar.close()
+            gz = StringIO()
+            writer = GzipWriter(gz, 9)
+            writer.write(conf_tar.getvalue())
+            writer.close()
+            conf_tar = gz.getvalue()
+        md5sum = ''.join(line + '\n' for line in lines) if lines else None
+        return md5sum, conf_tar
+
+    def _data_members(self, cfg):
+        """[(arcname, source)] of the data package, in tar order
+        """
+        members = {}
+        shared = pjoin(self._path, 'shared')
+        if self._nonempty(shared):
+            for root, dirs, files in walk(shared):
+                dirs[:] = [d for d in dirs
+                           if d not in ('.svn', '.qcodesigning')]
+                rel = relpath(root, shared)
+                members['.' if rel == '.' else './' + rel] = root
+                for name in dirs + files:
+                    if name != '.svn':
+                        path = pjoin(root, name)
+                        members['./' + relpath(path, shared)] = path
+        for name, icon in self._icons(cfg['QPKG_NAME']):
+            members['./' + name] = icon
+        for path in cfg.get('QPKG_CONFIG', '').split():
+            src = pjoin(self._path, 'config', path)
+            if not path.startswith('/') and isfile(src):
+                members['./' + path] = src
+        return sorted(members.items())
+
+    def _data_package(self, fileobj, cfg):
+        """Write the compressed data package; return the number of members
+        and the size of the tar archive
+        """
+        members = self._data_members(cfg)
+        # xz(1) writes to the file descriptor behind fileobj
+        fileobj.flush()
+        stream = self._compressor(cfg, fileobj)
+        tar = tarfile.open(fileobj=stream, mode='w|',
+                           format=tarfile.GNU_FORMAT)
+        if not members or members[0][0] != '.':
+            # qbuild's `mkdir -m 755 build.$$`
+            tar.addfile(self._tarinfo('.', tarfile.DIRTYPE, 0755))
+        for arcname, path in members:
+            tar.add(path, arcname, recursive=False, filter=self._normalize)
+        tar.close()
+        stream.close()
+        fileobj.seek(0, 2)
+        return len(members), tar.offset
+
+    def _control_package(self, cfg, md5sum, conf_tar):
+        # arcname -> file or generated content
+        files = {}
+        generated = {}
+        if self._source_date_epoch is None:
+            built = time.localtime()
+        else:
+            built = time.gmtime(self._source_date_epoch)
+        generated['./built_info'] = 'time = {}\n'.format(
+            time.strftime('%Y%m%d', built))
+        files['./' + pbasename(self._install_script())] = \
+            self._install_script()
+        files['./package_routines'] = pjoin(self._path, 'package_routines')
+        files['./qpkg.cfg'] = pjoin(self._path, 'qpkg.cfg')
+        nc = pjoin(self._path, 'shared', '.nc')
+        if isdir(nc):
+            for root, dirs, names in walk(nc):
+                files['./.nc/' + relpath(root, nc) if root != nc
+                      else './.nc'] = root
+                for name in dirs + names:
+                    files['./.nc/' + relpath(pjoin(root, name), nc)] = \
+                        pjoin(root, name)
+            for name, icon in self._icons(cfg['QPKG_NAME']):
+                files['./' + name] = icon
+        if self._compression(cfg)[0] == 'xz':
+            xz = pjoin(self._qdk_path,
+                       'xz_1404_{}.tgz'.format(self._xz_arch))
+            if pexists(xz):
+                files['./xz.tgz'] = xz
+            else:
+                warning(xz + ': no such file')
+        if md5sum is not None:
+            generated['./md5sum'] = md5sum
+        if conf_tar is not None:
+            generated['./conf.tar.gz'] = conf_tar
+
+        inner = StringIO()
+        stream = GzipWriter(inner)
+        tar = tarfile.open(fileobj=stream, mode='w|',
+                           format=tarfile.GNU_FORMAT)
+        tar.addfile(self._tarinfo('.', tarfile.DIRTYPE, 0755))
+        mode = self._file_mode()
+        for arcname in sorted(set(files) | set(generated)):
+            if arcname in files:
+                tar.add(files[arcname], arcname, recursive=False,
+                        filter=self._normalize)
+            else:
+                info = self._tarinfo(arcname, tarfile.REGTYPE, mode)
+                info.size = len(generated[arcname])
+                tar.addfile(info, StringIO(generated[arcname]))
+        tar.close()
+        stream.close()
+
+        control = StringIO()
+        tar = tarfile.open(fileobj=control, mode='w',
+                           format=tarfile.GNU_FORMAT)
+        info = self._tarinfo('control.tar.gz', tarfile.REGTYPE, mode)
+        info.size = len(inner.getvalue())
+        inner.seek(0)
+        tar.addfile(info, inner)
+        tar.close()
+        return control
+
+    def _extra_files(self, cfg):
+        files = []
+        for k in ('QDK_EXTRA_SRC_FILE', 'QDK_EXTRA_FILE'):
+            for path in cfg.get(k, '').split():
+                if not path.startswith('/'):
+                    path = pjoin(self._path, path)
+                if not isfile(path):
+                    raise BuildingError(path + ': no such file')
+                files.append(path)
+        return files
+
+    def _extra_package(self, fileobj, files):
+        tar = tarfile.open(fileobj=fileobj, mode='w',
+                           format=tarfile.GNU_FORMAT)
+        packages = []
+        for path in files:
+            tar.add(path, './' + pbasename(path), filter=self._normalize)
+            if path.endswith(('.ipk', '.opk')):
+                packages.append(self._packages_entry(path))
+        if packages:
+            gz = StringIO()
+            writer = GzipWriter(gz)
+            writer.write(''.join(packages))
+            writer.close()
+            info = self._tarinfo('./Packages.gz', tarfile.REGTYPE,
+                                 self._file_mode())
+            info.size = len(gz.getvalue())
+            gz.seek(0)
+            tar.addfile(info, gz)
+        tar.close()
+
+    def _packages_entry(self, path):
+        # create_packages_file: the control of an Optware package
+        with tarfile.open(path) as ipk:
+            with tarfile.open(fileobj=ipk.extractfile('./control.tar.gz')) \
+                    as control:
+                fields = control.extractfile('./control').read()
+        lines = [l for l in fields.split('\n')
+                 if l and 'Priority' not in l and not l.endswith(': ')]
+        lines.append('Filename: {} '.format(pbasename(path)))
+        lines.append('MD5Sum: ' + self._md5(path))
+        lines.append('Size: {}'.format(lstat(path).st_size))
+        return '\n'.join(lines) + '\n\n\n'
+
+    def _header(self, cfg, ctrl_len, data_len, data_file, extra_len):
+        values = {
+            'prefix': self.PREFIX,
+            'log_tool': self.LOG_TOOL,
+            'name': cfg['QPKG_NAME'],
+            'display_name': cfg.get('QPKG_DISPLAY_NAME') or cfg['QPKG_NAME'],
+            'version': cfg['QPKG_VER'],
+            'allow_no_volume': 1 if self._allow_no_volume else 0,
+            'ctrl_len': ctrl_len,
+            'data_len': self._length(data_len),
+            'data_blocks': self._length((data_len + 1023) / 1024),
+            'data_file': data_file,
+            'extra_len': self._length(extra_len or 0),
+            'install_script': pbasename(self._install_script()),
+            # keep the package after installation with 0
+            'retval': 10,
+            'script_len': 'SCRIPT_LEN',
+        }
+        parts = [HEADER_FIND_BASE]
+        arch = self._model if self._model in self.ARCHITECTURES else None
+        if arch is not None:
+            values['cpu_arch'], values['reject_platform'] = \
+                self.ARCHITECTURES[arch]
+            parts.append(HEADER_ARCH)
+        parts.append(HEADER_INSTALL)
+        if arch is not None:
+            parts.append('arch_ok || wrong_arch\n')
+        parts.append(HEADER_EXTRACT)
+        if extra_len is not None:
+            parts.append(HEADER_EXTRA)
+        parts.append(HEADER_END)
+        header = ''.join(parts) % values
+
+        # the header holds its own length
+        script_len = len(header) - len('SCRIPT_LEN')
+        digits = len(str(script_len))
+        script_len += len(str(script_len))
+        if digits < len(str(script_len)):
+            script_len += 1
+        return header.replace('SCRIPT_LEN', str(script_len), 1)
+
+    def _length(self, n):
+        return '{:<{}}'.format(n, LENGTH_WIDTH)
+
+    def _tail(self, cfg, size):
+        # [MODEL(10)|RESERVED(40)|FW_VERSION(10)|NAME(20)|VERSION(10)|FLAG(10)]
+        name = cfg['QPKG_NAME']
+        if len(name) > 20:
+            warning('QPKG_NAME: {} is truncated to 20 characters in the'
+                    ' tail'.format(name))
+        for value, length in ((self._model, 10), (cfg['QPKG_VER'], 10)):
+            if len(value) > length:
+                raise BuildingError('the length of {} must be less than or'
+                                    ' equal to {}'.format(value, length))
+        tail = '{:<10}{}{:<20}{:<10}{}'.format(self._model, ' ' * 50,
+                                               name[:20], cfg['QPKG_VER'],
+                                               TAIL_FLAG)
+        # qpkg_encrypt: the size scrambled into the reserved field
+        encrypt = str(size * ENCRYPT_KEY + 1000000000)[:10]
+        pos = TAIL_LEN - ENCRYPT_OFFSET
+        return tail[:pos] + encrypt + tail[pos + len(encrypt):]
+
+    def _icons(self, name):
+        icons_dir = pjoin(self._path, 'icons')
+        icons = {}
+        for suffix, dest in (('.gif', '.qpkg_icon.gif'),
+                             ('_80.gif', '.qpkg_icon_80.gif'),
+                             ('_gray.gif', '.qpkg_icon_gray.gif'),
+                             ('.png', '.qpkg_icon.gif'),
+                             ('_80.png', '.qpkg_icon_80.gif'),
+                             ('_gray.png', '.qpkg_icon_gray.gif')):
+            src = pjoin(icons_dir, name + suffix)
+            if isfile(src):
+                icons[dest] = src
+        return sorted(icons.items())
+
+    def _install_script(self):
+        return pjoin(self._qdk_path, 'scripts', 'qinstall.sh')
+
+    def _tarinfo(self, name, type, mode):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode
+        info.mtime = int(time.time())
+        info.uid, info.gid = getuid(), getgid()
+        try:
+            info.uname = pwd.getpwuid(info.uid).pw_name
+            info.gname = grp.getgrgid(info.gid).gr_name
+        except KeyError:
+            pass
+        return self._normalize(info)
+
+    def _normalize(self, info):
+        # tarfile filter of the reproducible mode
+        if self._source_date_epoch is not None:
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            info.mtime = min(info.mtime, self._source_date_epoch)
+            # Cook and QNAP/rules create files with the umask of the
+            # builder: u+rw,go=rX as `tar --mode` of reproducible builds
+            if info.isdir() or info.isreg():
+                x = 0111 if info.isdir() or info.mode & 0111 else 0
+                info.mode = info.mode & 07100 | 0644 | x
+        return info
+
+    def _file_mode(self):
+        # of the generated files, as if written with the umask
+        if self._source_date_epoch is not None:
+            return 0644
+        return 0666 & ~self._umask()
+
+    def _nonempty(self, path):
+        # is_empty_dir in qbuild
+        return isdir(path) and any(not name.startswith('.svn')
+                                   for name in listdir(path))
+
+    def _md5(self, path):
+        h = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _umask(self):
+        mask = umask(0)
+        umask(mask)
+        return mask
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
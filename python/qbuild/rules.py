@@ -13,8 +13,9 @@ from exception import BuildingError
 class Rules(object):
     SUPPORT_CMDS = ['build', 'binary', 'clean']
 
-    def __init__(self, env=None, qpkg_dir='./'):
+    def __init__(self, env=None, qpkg_dir='./', wrapper=None):
         self.env = env
+        self.wrapper = wrapper or []
         self.rules = pjoin(qpkg_dir, Settings.CONTROL_PATH, 'rules')
         if not pexists(self.rules):
             raise BuildingError('Missing: {}'
@@ -22,7 +23,7 @@ class Rules(object):
 
     def __getattr__(self, name):
         if name in self.SUPPORT_CMDS:
-            return lambda: self.__exec([self.rules, name])
+            return lambda: self.__exec(self.wrapper + [self.rules, name])
 
         raise AttributeError("'{}' object has no attribute '{}'"
                              .format(self.__class__.__name__, name))
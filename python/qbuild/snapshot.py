@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+from os import (makedirs, walk, lstat, link, symlink, readlink, fdopen,
+                unlink,
+                open as os_open, O_WRONLY, O_CREAT, O_EXCL,
+                )
+from os.path import (join as pjoin,
+                     basename as pbasename,
+                     dirname as pdirname,
+                     realpath as prealpath,
+                     lexists as plexists,
+                     isdir,
+                     islink,
+                     relpath,
+                     )
+from shutil import copy2, copystat, rmtree
+from fnmatch import fnmatch
+from distutils.spawn import find_executable
+import errno
+import fcntl
+import stat
+
+from log import debug, warning
+
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class Snapshot(object):
+    """Copy of the source tree in the build area
+
+    copy     duplicate every file, as shutil.copytree does
+    reflink  share the data blocks with the source (btrfs, xfs); files are
+             copied where the filesystem refuses
+    link     hardlink farm; QNAP/rules is run under cow-shell(1), which
+             breaks the link of any file opened for writing
+    auto     reflink, otherwise link if cow-shell is installed, otherwise copy
+    """
+    MODES = ('auto', 'reflink', 'link', 'copy')
+    COW_SHELL = 'cow-shell'
+
+    def __init__(self, src, dest, mode='auto', excludes=()):
+        self._src = prealpath(src)
+        self._dest = prealpath(dest)
+        self._mode = mode
+        self._excludes = list(excludes)
+        self._stats = {'reflink': 0, 'link': 0, 'copy': 0, 'bytes': 0}
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def wrapper(self):
+        """Command prefix for programs writing into the snapshot
+        """
+        return [self.COW_SHELL] if self._mode == 'link' else []
+
+    def create(self):
+        if self._mode == 'link' and not find_executable(self.COW_SHELL):
+            warning('{} not found; fall back to copy'.format(self.COW_SHELL))
+            self._mode = 'copy'
+
+        self._add_tree(self._src)
+        debug('Snapshot {} ({}): {} reflinked, {} linked, {} copied,'
+              ' {} bytes'.format(self._dest, self._mode,
+                                 self._stats['reflink'], self._stats['link'],
+                                 self._stats['copy'], self._stats['bytes']))
+
+    def update(self, paths):
+        """Bring paths of the source tree, relative to it, up to date
+
+        Return the paths that are not excluded.
+        """
+        updated = []
+        for rel in sorted(paths):
+            src = pjoin(self._src, rel)
+            if self.excluded(src):
+                continue
+            updated.append(rel)
+            dest = pjoin(self._dest, rel)
+            if plexists(dest):
+                if isdir(dest) and not islink(dest):
+                    rmtree(dest)
+                else:
+                    unlink(dest)
+            if not plexists(src):
+                continue
+            if isdir(src) and not islink(src):
+                self._add_tree(src)
+                continue
+            if not isdir(pdirname(dest)):
+                makedirs(pdirname(dest))
+            self._add(src, dest)
+        return updated
+
+    def excluded(self, path):
+        if path == self._dest or path.startswith(self._dest + '/'):
+            return True
+        rel = relpath(path, self._src)
+        for pattern in self._excludes:
+            if fnmatch(pbasename(path), pattern) or fnmatch(rel, pattern):
+                return True
+        return False
+
+    def _add_tree(self, top):
+        created = []
+        for root, dirs, files in walk(top):
+            rel = relpath(root, self._src)
+            target = pjoin(self._dest, rel)
+            makedirs(target)
+            created.append((root, target))
+            for name in sorted(files + dirs):
+                path = pjoin(root, name)
+                if self.excluded(path):
+                    if name in dirs:
+                        dirs.remove(name)
+                    continue
+                # symlinks to directories are listed in dirs too
+                if name in dirs and stat.S_ISLNK(lstat(path).st_mode):
+                    dirs.remove(name)
+                    symlink(readlink(path), pjoin(target, name))
+                elif name in files:
+                    self._add(path, pjoin(target, name))
+        # the times of the directories changed while they were filled
+        for root, target in reversed(created):
+            copystat(root, target)
+
+    def _add(self, src, dest):
+        st = lstat(src)
+        if stat.S_ISLNK(st.st_mode):
+            symlink(readlink(src), dest)
+            return
+        if not stat.S_ISREG(st.st_mode):
+            copy2(src, dest)
+            return
+        self._stats['bytes'] += st.st_size
+        if self._mode in ('auto', 'reflink') and self._reflink(src, dest):
+            self._stats['reflink'] += 1
+            return
+        if self._mode == 'auto':
+            # the filesystem can't reflink; decide once for the whole tree
+            self._mode = 'link' if find_executable(self.COW_SHELL) \
+                else 'copy'
+            debug('Snapshot: reflink unsupported, use ' + self._mode)
+        if self._mode == 'link':
+            try:
+                link(src, dest)
+                self._stats['link'] += 1
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                self._mode = 'copy'
+        copy2(src, dest)
+        self._stats['copy'] += 1
+
+    def _reflink(self, src, dest):
+        # on failure dest is removed: link(2) of the fallback must create it
+        fd = os_open(dest, O_WRONLY | O_CREAT | O_EXCL, 0600)
+        try:
+            with fdopen(fd, 'wb') as fout, open(src, 'rb') as fin:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except IOError as e:
+            unlink(dest)
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV,
+                               errno.EINVAL, errno.ENOTTY):
+                raise
+            return False
+        except:
+            unlink(dest)
+            raise
+        copystat(src, dest)
+        return True
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+from os import walk, lstat, read, close
+from os.path import (join as pjoin,
+                     realpath as prealpath,
+                     )
+from select import select, error as select_error
+from subprocess import CalledProcessError
+import ctypes
+import ctypes.util
+import errno
+import struct
+import time
+
+from log import info, error, debug, warning
+from exception import BaseStringException
+from controlfiles import ControlFile
+from qbuild.snapshot import Snapshot
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32)
+    return libc
+
+
+_libc = _load_libc()
+
+# sys/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+EVENT = struct.Struct('iIII')
+
+
+class Monitor(object):
+    """Changed paths under root; paths for which ignore() is true and the
+    trees below them are left out
+    """
+    def __init__(self, root, ignore):
+        self._root = root
+        self._ignore = ignore
+        self.first_change = None
+
+    def changes(self, delay):
+        """Wait for changes; return their paths once none came for delay
+        seconds. Changes the monitor lost are reported as root.
+        """
+        paths = set()
+        while True:
+            got = self.read(delay if paths else None)
+            if not got and paths:
+                return paths
+            if got and not paths:
+                self.first_change = time.time()
+            paths.update(got)
+
+    def read(self, timeout):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _walk(self, top):
+        for root, dirs, files in walk(top):
+            dirs[:] = [d for d in dirs if not self._ignore(pjoin(root, d))]
+            yield root, dirs, [f for f in files
+                               if not self._ignore(pjoin(root, f))]
+
+
+class Inotify(Monitor):
+    """Monitor on inotify(7), one watch per directory
+    """
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, root, ignore):
+        super(Inotify, self).__init__(root, ignore)
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self._dirs = {}
+        try:
+            self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout):
+        try:
+            ready, _, _ = select([self._fd], [], [], timeout)
+        except select_error as e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not ready:
+            return set()
+        data = read(self._fd, 1 << 16)
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                paths.add(self._root)
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if wd not in self._dirs or not name:
+                continue
+            path = pjoin(self._dirs[wd], name)
+            if self._ignore(path):
+                continue
+            if mask & IN_ISDIR and not mask & (IN_CREATE | IN_MOVED_TO |
+                                               IN_MOVED_FROM | IN_DELETE):
+                continue
+            paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # files written before the watch was added raise no event
+                for root, dirs, files in self._add_tree(path):
+                    paths.update(pjoin(root, name) for name in dirs + files)
+        return paths
+
+    def close(self):
+        if self._fd >= 0:
+            close(self._fd)
+            self._fd = -1
+
+    def _add_tree(self, top):
+        tree = list(self._walk(top))
+        for root, _, _ in tree:
+            wd = _libc.inotify_add_watch(self._fd, root, self.MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    # gone already; its removal is reported by the parent
+                    continue
+                raise OSError(err, 'inotify_add_watch: ' + root)
+            self._dirs[wd] = root
+        return tree
+
+
+class Poller(Monitor):
+    """Monitor comparing the stat of every path each interval seconds
+    """
+    def __init__(self, root, ignore, interval=1.0):
+        super(Poller, self).__init__(root, ignore)
+        self._interval = interval
+        self._state = self._scan()
+
+    def read(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self._interval if deadline is None else
+                       max(0, min(self._interval, deadline - time.time())))
+            state = self._scan()
+            paths = set(p for p in set(state) | set(self._state)
+                        if state.get(p) != self._state.get(p))
+            self._state = state
+            if paths or (deadline is not None and time.time() >= deadline):
+                return paths
+
+    def _scan(self):
+        state = {}
+        for root, dirs, files in self._walk(self._root):
+            for name in dirs + files:
+                path = pjoin(root, name)
+                try:
+                    st = lstat(path)
+                except OSError:
+                    continue
+                state[path] = (st.st_mode, st.st_size, st.st_mtime,
+                               st.st_ino)
+        return state
+
+
+class Watcher(object):
+    """Build again whenever the source tree changes
+
+    deliver(qbuild_dir, qpkg) is called for every package built again.
+    """
+    # seconds without changes before building, e.g. while an editor saves
+    DELAY = 0.2
+
+    def __init__(self, transformer, args, deliver):
+        self._transformer = transformer
+        self._args = args
+        self._deliver = deliver
+
+    def run(self):
+        root = prealpath(self._transformer.qpkg_dir)
+        build_dir = prealpath(self._transformer.build_dir)
+        # what the build-area copy leaves out, as --snapshot-exclude .git
+        snapshot = Snapshot(root, pjoin(build_dir,
+                                        ControlFile(root).source['source']),
+                            excludes=self._transformer.snapshot_excludes)
+
+        def ignore(path):
+            return path == build_dir or path.startswith(build_dir + '/') or \
+                snapshot.excluded(path)
+        try:
+            monitor = Inotify(root, ignore)
+        except OSError as e:
+            warning('inotify: {}; poll for changes instead'.format(e))
+            monitor = Poller(root, ignore)
+        info('Watching {} for changes (Ctrl-C to stop)'.format(root))
+        try:
+            while True:
+                paths = monitor.changes(self.DELAY)
+                debug('changed: {}'.format(' '.join(sorted(paths))))
+                start = time.time()
+                try:
+                    results = self._transformer.update(paths, self._args)
+                    for q, result in results:
+                        self._deliver(q, result)
+                except (BaseStringException, CalledProcessError) as e:
+                    error(str(e))
+                    continue
+                end = time.time()
+                if results:
+                    info('Rebuilt {} package(s) in {:.2f}s, {:.2f}s after'
+                         ' the first change'.format(len(results), end - start,
+                                                   end - monitor.first_change))
+                else:
+                    info('No package affected')
+        finally:
+            monitor.close()
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
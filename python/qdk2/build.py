@@ -6,15 +6,20 @@ from os.path import (join as pjoin,
                      abspath as pabspath,
                      exists as pexists,
                      )
-from shutil import move
+from shutil import move, rmtree
+from tempfile import mkstemp
 import os
 
 from basecommand import BaseCommand
 from settings import Settings
 from qbuild import Qdk2ToQbuild, QbuildToQpkg
+from qbuild.snapshot import Snapshot
+from qbuild.watch import Watcher
+from controlfiles import ChangelogFile
 from log import info, error, debug
 # from lint import CommandLint
-from exception import BaseStringException
+from exception import BaseStringException, BuildingError
+from tracing import tracer, span
 
 
 class CommandBuild(BaseCommand):
@@ -34,6 +39,60 @@ class CommandBuild(BaseCommand):
         parser.add_argument('--qdk1', action='store_true',
                             default=False,
                             help='source package is QDK 1 format')
+        parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                            default=1,
+                            help='run N jobs at once: packages built in'
+                                 ' parallel and the make jobs of QNAP/rules,'
+                                 ' which share a jobserver'
+                                 ' (default: %(default)s)')
+        parser.add_argument('--no-cache', action='store_true',
+                            default=False,
+                            help='do not reuse packages and file digests of'
+                                 ' previous builds')
+        parser.add_argument('--recipe-cache', action='store_true',
+                            default=False,
+                            help='also reuse the control files cooked by'
+                                 ' previous builds, up to'
+                                 ' $QDK2_RECIPE_CACHE_SIZE bytes')
+        parser.add_argument('--clear-cache', action='store_true',
+                            default=False,
+                            help='drop the cache in {} before building'
+                                 .format(Settings.CACHE_PATH))
+        parser.add_argument('--snapshot', metavar='MODE',
+                            dest='snapshot_mode',
+                            choices=Snapshot.MODES, default='auto',
+                            help='how the source tree is copied to the'
+                                 ' build folder: {} (default: %(default)s)'
+                                 .format(', '.join(Snapshot.MODES)))
+        parser.add_argument('--snapshot-exclude', metavar='PATTERN',
+                            dest='snapshot_excludes',
+                            action='append', default=[],
+                            help='do not copy matching files to the build'
+                                 ' folder, e.g. .git; may be repeated')
+        parser.add_argument('--packager', choices=('python', 'qbuild'),
+                            help='write the .qpkg in Python or with the'
+                                 ' qbuild script; qbuild is used anyway for'
+                                 ' what only it supports, e.g. signing'
+                                 ' (default: python for reproducible builds,'
+                                 ' qbuild otherwise)')
+        parser.add_argument('--reproducible', action='store_true',
+                            default=False,
+                            help='build the same bytes from the same source:'
+                                 ' root owners and times clamped to'
+                                 ' SOURCE_DATE_EPOCH or to the latest'
+                                 ' changelog entry (default when'
+                                 ' SOURCE_DATE_EPOCH is set)')
+        parser.add_argument('--hardlink', action='store_true',
+                            default=False,
+                            help='hardlink installed files instead of copying'
+                                 ' them')
+        parser.add_argument('--trace', metavar='FILE',
+                            help='write the time and memory of each build'
+                                 ' phase to FILE, in the Chrome trace format')
+        parser.add_argument('--watch', action='store_true',
+                            default=False,
+                            help='keep running and build again what each'
+                                 ' change of the source package affects')
 
     @property
     def qpkg_dir(self):
@@ -53,6 +112,55 @@ class CommandBuild(BaseCommand):
             self._build_dir = self._args.build_dir
         return self._build_dir
 
+    @property
+    def jobs(self):
+        if not hasattr(self, '_jobs'):
+            self._jobs = max(1, self._args.jobs)
+        return self._jobs
+
+    @property
+    def use_cache(self):
+        return not self._args.no_cache
+
+    @property
+    def use_recipe_cache(self):
+        return self._args.recipe_cache and not self._args.no_cache
+
+    @property
+    def snapshot_mode(self):
+        return self._args.snapshot_mode
+
+    @property
+    def snapshot_excludes(self):
+        return self._args.snapshot_excludes
+
+    @property
+    def packager(self):
+        # qbuild stays the default until the output of the Python writer
+        # is checked against it; qbuild builds are not reproducible
+        if self._args.packager is None:
+            return 'python' if self.source_date_epoch is not None \
+                else 'qbuild'
+        return self._args.packager
+
+    @property
+    def hardlink(self):
+        return self._args.hardlink
+
+    @property
+    def source_date_epoch(self):
+        """Time of the reproducible mode, None otherwise
+        """
+        if not hasattr(self, '_source_date_epoch'):
+            epoch = Settings.SOURCE_DATE_EPOCH
+            if epoch is None and self._args.reproducible:
+                if self.qpkg_dir is None:
+                    raise BuildingError('--reproducible needs'
+                                        ' SOURCE_DATE_EPOCH')
+                epoch = ChangelogFile(self.qpkg_dir).timestamp
+            self._source_date_epoch = epoch
+        return self._source_date_epoch
+
     def run(self, **kargs):
         # Act as QDK1
         if self._args.qdk1:
@@ -67,21 +175,42 @@ class CommandBuild(BaseCommand):
             error('Are you in the source code tree?')
             return -1
 
+        if self._args.clear_cache and pexists(Settings.CACHE_PATH):
+            info('Clear cache ' + Settings.CACHE_PATH)
+            rmtree(Settings.CACHE_PATH)
+
         # Act as QDK2
+        if self._args.trace:
+            tracer.open(pabspath(self._args.trace))
         try:
-            qbuild_formats = Qdk2ToQbuild(self).transform()
-            for q in qbuild_formats:
-                debug(q)
-                result = QbuildToQpkg(q).build(self)
-                arch = q[q.rfind('_'):]
-                dest = pjoin(self.build_dir,
-                             pbasename(result)[:-5] + arch + '.qpkg')
-                move(result, dest)
-                info('Package is ready: ' + dest)
+            transformer = Qdk2ToQbuild(self)
+            with span('build', jobs=self.jobs):
+                if self.source_date_epoch is not None:
+                    info('Reproducible build at SOURCE_DATE_EPOCH={}'
+                         .format(self.source_date_epoch))
+                for q, result in transformer.build(self):
+                    self._deliver(q, result)
+            if self._args.watch:
+                Watcher(transformer, self, self._deliver).run()
         except BaseStringException as e:
             error(str(e))
             return -1
+        finally:
+            if self._args.trace:
+                tracer.close()
+                info('Trace is ready: ' + tracer.path)
         return 0
 
+    def _deliver(self, q, result):
+        debug(q)
+        arch = q[q.rfind('_'):]
+        dest = pjoin(self.build_dir, pbasename(result)[:-5] + arch + '.qpkg')
+        # replace the previous package at once, even across filesystems
+        fd, tmp = mkstemp(dir=self.build_dir, suffix='.qpkg')
+        os.close(fd)
+        move(result, tmp)
+        os.rename(tmp, dest)
+        info('Package is ready: ' + dest)
+
 
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
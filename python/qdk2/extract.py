@@ -17,6 +17,7 @@ from subprocess import CalledProcessError
 from log import error, debug, info, warning
 from basecommand import BaseCommand
 from settings import Settings
+from exception import QpkgFormatError
 
 
 @contextmanager
@@ -50,12 +51,83 @@ class CommandExtract(BaseCommand):
                             default='./',
                             help='extract file to specific directory'
                                  ' (default: %(default)s)')
+        parser.add_argument('--member', metavar='PATH', action='append',
+                            help='extract only PATH of the qpkg, e.g.'
+                                 ' qpkg.cfg or bin/foo, without'
+                                 ' decompressing the rest; repeatable')
         parser.add_argument('file', metavar='file',
                             help='such as TS-870_20140502-4.1.0.img'
                                  ' or photostation.qpkg')
 
-    # FIXME: couldn't extract every qpkg and would return error(tar extract)
     def extract_qpkg(self, package, to):
+        """Extract the control and extra files to to, and the data files to
+        to/shared, streamed from the package
+        """
+        # tarfile is only needed here; keep it out of the start of qdk2
+        import tarfile
+        from qpkgfile import QpkgReader
+        try:
+            qpkg = QpkgReader(package)
+        except QpkgFormatError as e:
+            debug('{}; extract with qbuild'.format(e))
+            self.extract_qpkg_qbuild(package, to)
+            return
+        try:
+            with qpkg:
+                self._extract(qpkg.open_control(), to)
+                extra = qpkg.open_extra()
+                if extra is not None:
+                    self._extract(extra, to)
+                if not pexists(pjoin(to, 'shared')):
+                    makedirs(pjoin(to, 'shared'))
+                self._extract(qpkg.open_data(), pjoin(to, 'shared'))
+        except (tarfile.TarError, QpkgFormatError, IOError) as e:
+            warning('Error in extracting: {}'.format(e))
+
+    def extract_members(self, package, names, to):
+        """Extract the members names of the package as extract_qpkg does,
+        through the member index of the data package
+        """
+        import tarfile
+        from qpkgfile import QpkgReader, normalize
+        from qpkgindex import MemberIndex
+        status = 0
+        try:
+            with QpkgReader(package) as qpkg:
+                control = qpkg.open_control()
+                controls = dict((normalize(m.name), m) for m in control)
+                index = None
+                for name in names:
+                    if normalize(name) in controls:
+                        control.extract(controls[normalize(name)], to)
+                        continue
+                    if index is None:
+                        index = MemberIndex(qpkg)
+                    if name not in index:
+                        error('{}: not found in {}'.format(name, package))
+                        status = -1
+                        continue
+                    debug(name)
+                    index.extract(name, pjoin(to, 'shared'))
+        except (tarfile.TarError, QpkgFormatError, IOError, OSError) as e:
+            error('Error in extracting: {}'.format(e))
+            return -1
+        return status
+
+    def _extract(self, tar, to):
+        def members():
+            for member in tar:
+                parts = member.name.split('/')
+                if member.name.startswith('/') or '..' in parts:
+                    warning('{}: skipped, outside of {}'.format(member.name,
+                                                                to))
+                    continue
+                debug(member.name)
+                yield member
+        tar.extractall(to, members())
+
+    # FIXME: couldn't extract every qpkg and would return error(tar extract)
+    def extract_qpkg_qbuild(self, package, to):
         extractor = Settings.QBUILD
         check_call([extractor, '--extract', package, to])
         if not pexists(pjoin(to, 'shared')):
@@ -91,6 +163,16 @@ class CommandExtract(BaseCommand):
             return -1
         if not pexists(directory):
             makedirs(directory)
+        if self._args.member:
+            if self._args.as_image or self._args.file.endswith('.img'):
+                error('--member is for qpkg only')
+                return -1
+            for name in self._args.member:
+                if '..' in name.split('/'):
+                    error('{}: outside of {}'.format(name, directory))
+                    return -1
+            return self.extract_members(self._args.file, self._args.member,
+                                        directory)
         if self._args.as_qpkg:
             self.extract_qpkg(self._args.file, directory)
         elif self._args.as_image:
@@ -22,6 +22,7 @@ from archive import Archive
 from versioncontrol import VersionControl
 from log import info, error
 from exception import ContainerUnsupported
+from template import Template
 
 
 class CommandImport(BaseCommand):
@@ -51,10 +52,11 @@ class CommandImport(BaseCommand):
                             nargs=2, metavar=('CTYPE', 'CID'),
                             help='linux container ({})'
                                  .format('/'.join(Container.SUPPORT_TYPES)))
+        samples = cls.get_sample_list()
         mgroup.add_argument('-s', '--sample', metavar='NAME',
-                            choices=cls.get_sample_list(),
+                            choices=samples,
                             help='built-in samples: {}'
-                            .format(', '.join(cls.get_sample_list())))
+                            .format(', '.join(samples)))
 
     @classmethod
     def get_sample_list(self):
@@ -123,16 +125,12 @@ class CommandImport(BaseCommand):
             raise ContainerUnsupported(str(self._args.container))
 
         # cook container.json
-        tpl_vars = [('@@IMAGE_ID@@', cid),
-                    ('@@NAME@@', self._args.project),
-                    ('@@TYPE@@', ctype)]
+        tpl_vars = {'IMAGE_ID': cid,
+                    'NAME': self._args.project,
+                    'TYPE': ctype}
         src = pjoin(Settings.TEMPLATE_PATH, 'container', 'container.json')
         dst = pjoin(self.directory, 'container.json')
-        with open(src, 'r') as fin, open(dst, 'w') as fout:
-            for line in fin:
-                for k, v in tpl_vars:
-                    line = line.replace(k, v)
-                fout.write(line)
+        Template(src, Template.AT).render_file(tpl_vars, dst)
         # cook QNAP control files
         makedirs(pjoin(self._directory, Settings.CONTROL_PATH))
         tpl_files = glob(pjoin(Settings.TEMPLATE_PATH, 'container',
@@ -144,12 +142,10 @@ class CommandImport(BaseCommand):
             else:
                 dst = pjoin(self._directory, Settings.CONTROL_PATH,
                             self._args.project + fn[fn.index('.'):])
-            with open(tpl, 'r') as fin, open(dst, 'w') as fout:
-                for line in fin:
-                    line = line.replace('@@PACKAGE@@', self._args.project)
-                    fout.write(line)
-                if pbasename(dst) != 'control':
-                    chmod(dst, 0755)
+            Template(tpl, Template.AT).render_file(
+                {'PACKAGE': self._args.project}, dst)
+            if pbasename(dst) != 'control':
+                chmod(dst, 0755)
         return 0
 
     def _import_sample(self, name, directory):
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+from argparse import SUPPRESS
+from os import (listdir, stat as os_stat, rename, unlink, fdopen, chmod,
+                umask, makedirs)
+from os.path import (join as pjoin,
+                     isdir as pisdir,
+                     isfile as pisfile,
+                     exists as pexists,
+                     )
+import json
+import tempfile
+
+from basecommand import BaseCommand
+from log import error, info, warning
+from settings import cpu_count
+from exception import QpkgFormatError
+
+
+# the ar(1) archive of Debian-style .ipk files
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_LEN = 60
+
+
+def _ipk_control_tar(path, f):
+    """TarFile of control.tar.gz of the .ipk f, either a tar (as OpenWrt
+    builds them) or an ar archive
+    """
+    import tarfile
+    from qpkgfile import Section, normalize
+    if f.read(len(AR_MAGIC)) == AR_MAGIC:
+        while True:
+            header = f.read(AR_HEADER_LEN)
+            if len(header) < AR_HEADER_LEN:
+                break
+            name = header[:16].strip().rstrip('/')
+            size = int(header[48:58])
+            if name == 'control.tar.gz':
+                return tarfile.open(fileobj=Section(f, f.tell(), size),
+                                    mode='r|gz')
+            f.seek(size + size % 2, 1)
+    else:
+        f.seek(0)
+        outer = tarfile.open(fileobj=f, mode='r:*')
+        for member in outer:
+            if normalize(member.name) == 'control.tar.gz':
+                return tarfile.open(fileobj=outer.extractfile(member),
+                                    mode='r|gz')
+    raise QpkgFormatError('{}: no control.tar.gz'.format(path))
+
+
+def ipk_control(path):
+    """The control file of the .ipk path, without Priority and empty fields
+    as create_packages_file of qbuild writes it to Packages
+    """
+    from qpkgfile import normalize
+    with open(path, 'rb') as f:
+        tar = _ipk_control_tar(path, f)
+        for member in tar:
+            if normalize(member.name) == 'control' and member.isfile():
+                lines = tar.extractfile(member).read().splitlines()
+                break
+        else:
+            raise QpkgFormatError('{}: missing control file'.format(path))
+    return '\n'.join(line for line in lines
+                     if 'Priority' not in line and not line.endswith(': ')
+                     ).decode('utf-8', 'replace')
+
+
+def qpkg_control(info):
+    """Packages fields of a .qpkg, from package_info()
+    """
+    fields = (('Package', info['name']),
+              ('Version', info['version']),
+              ('Maintainer', info['packager']),
+              ('License', info['config'].get('QPKG_LICENSE', '')),
+              ('Description', info['summary']))
+    return '\n'.join('{}: {}'.format(k, v) for k, v in fields if v
+                     ).decode('utf-8', 'replace')
+
+
+def _read_package(path):
+    """(path, entry, error) of a package, in a worker of the pool
+    """
+    from qdk2.info import package_info
+    import tarfile
+    try:
+        if path.endswith('.qpkg'):
+            pinfo = package_info(path)
+            del pinfo['file']
+            return path, {'type': 'qpkg', 'control': qpkg_control(pinfo),
+                          'info': pinfo}, None
+        return path, {'type': 'ipk', 'control': ipk_control(path)}, None
+    except (QpkgFormatError, tarfile.TarError, IOError, ValueError) as e:
+        return path, None, str(e)
+
+
+class PackageIndex(object):
+    """Packages, Packages.gz and Packages.json of a directory of .qpkg and
+    .ipk files
+
+    Packages.json keeps the entry of every package with the identity of
+    its file, i.e. (inode, size, mtime); only new or changed files are read
+    again. Their metadata comes from partial reads, in a process pool; their
+    digests from the DigestCache shared with builds.
+    """
+    FILENAME = 'Packages'
+    VERSION = 1
+    SUFFIXES = ('.qpkg', '.ipk')
+
+    def __init__(self, directory, output=None, jobs=None, rebuild=False):
+        self._directory = directory
+        self._output = output or directory
+        self._jobs = max(1, jobs or cpu_count())
+        self._rebuild = rebuild
+        self.added = self.removed = self.failed = 0
+
+    def _path(self, suffix=''):
+        return pjoin(self._output, self.FILENAME + suffix)
+
+    @staticmethod
+    def _identity(st):
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def _load(self):
+        if self._rebuild:
+            return {}
+        try:
+            with open(self._path('.json')) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if index.get('version') != self.VERSION:
+            return {}
+        return index['packages']
+
+    def update(self):
+        """Index the new or changed files and write the index; return the
+        number of packages in it
+        """
+        old = self._load()
+        names = sorted(n for n in listdir(self._directory)
+                       if n.endswith(self.SUFFIXES) and
+                       pisfile(pjoin(self._directory, n)))
+        packages = {}
+        changed = []
+        for name in names:
+            identity = self._identity(os_stat(pjoin(self._directory, name)))
+            entry = old.get(name)
+            if entry is not None and entry['identity'] == identity:
+                packages[name] = entry
+            else:
+                changed.append((name, identity))
+        self.removed = len(set(old) - set(names))
+        if changed:
+            packages.update(self._read([name for name, _ in changed],
+                                       dict(changed)))
+        if changed or self.removed or not pexists(self._path('.gz')):
+            self._write(packages)
+        return len(packages)
+
+    def _read(self, names, identities):
+        from qbuild.digest import Digester, DigestCache
+        paths = [pjoin(self._directory, name) for name in names]
+        jobs = min(self._jobs, len(paths))
+        pool = None
+        if jobs > 1:
+            from multiprocessing import Pool
+            pool = Pool(jobs)
+            pending = pool.map_async(_read_package, paths, chunksize=8)
+        cache = DigestCache()
+        try:
+            # hashed here while the pool reads the metadata
+            digests = Digester('md5', cache=cache).hexdigests(paths)
+            results = pending.get() if pool is not None else \
+                [_read_package(path) for path in paths]
+        finally:
+            cache.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+        entries = {}
+        for name, digest, (path, entry, err) in zip(names, digests, results):
+            if entry is None:
+                warning('{}: skipped, {}'.format(name, err))
+                self.failed += 1
+                continue
+            entry.update({'identity': identities[name], 'md5sum': digest})
+            entries[name] = entry
+            self.added += 1
+        return entries
+
+    def _stanzas(self, packages):
+        for name in sorted(packages):
+            entry = packages[name]
+            control = entry['control'].encode('utf-8')
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            yield '{}{}Filename: {}\nMD5Sum: {}\nSize: {}\n\n'.format(
+                control, '\n' if control else '', name,
+                entry['md5sum'], entry['identity'][1])
+
+    def _write(self, packages):
+        import gzip
+        text = ''.join(self._stanzas(packages))
+
+        def write_gzip(f):
+            # mtime 0: the same Packages give the same bytes
+            with gzip.GzipFile('', 'wb', 9, f, 0) as gz:
+                gz.write(text)
+        index = {'version': self.VERSION, 'packages': packages}
+        mask = umask(0)
+        umask(mask)
+        for suffix, write in (
+                ('', lambda f: f.write(text)),
+                ('.gz', write_gzip),
+                ('.json', lambda f: json.dump(index, f, sort_keys=True))):
+            fd, tmp = tempfile.mkstemp(dir=self._output)
+            try:
+                with fdopen(fd, 'wb') as f:
+                    write(f)
+                # served as is by the mirror, unlike the private mkstemp
+                chmod(tmp, 0666 & ~mask)
+                rename(tmp, self._path(suffix))
+            except:
+                unlink(tmp)
+                raise
+
+
+class CommandIndex(BaseCommand):
+    key = 'index'
+
+    @classmethod
+    def build_argparse(cls, subparser):
+        parser = subparser.add_parser(cls.key, help='write the Packages index'
+                                                    ' of a directory of .qpkg'
+                                                    ' and .ipk files')
+        parser.add_argument('--' + cls.key, help=SUPPRESS)
+        parser.add_argument('-o', '--output', metavar='PATH',
+                            help='write Packages, Packages.gz and'
+                                 ' Packages.json to PATH'
+                                 ' (default: DIRECTORY)')
+        parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                            help='read N packages at once'
+                                 ' (default: number of CPUs)')
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                            help='read every package again, not only the new'
+                                 ' or changed ones')
+        parser.add_argument('directory', metavar='DIRECTORY',
+                            help='directory of the packages')
+
+    def run(self):
+        directory = self._args.directory
+        output = self._args.output or directory
+        for d in (directory, output):
+            if pexists(d) and not pisdir(d):
+                error('{} is not directory'.format(d))
+                return -1
+        if not pexists(directory):
+            error('{}: no such directory'.format(directory))
+            return -1
+        if not pexists(output):
+            makedirs(output)
+        index = PackageIndex(directory, output, self._args.jobs,
+                             self._args.rebuild)
+        total = index.update()
+        info('{}: {} packages, {} new or changed, {} removed'.format(
+            pjoin(output, PackageIndex.FILENAME), total, index.added,
+            index.removed))
+        return 1 if index.failed else 0
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
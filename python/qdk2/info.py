@@ -5,14 +5,48 @@ from os.path import (join as pjoin,
                      exists as pexists,
                      abspath as pabspath,
                      )
+import json
 import os
 
 from basecommand import BaseCommand
 from log import error
 from settings import Settings
+from exception import QpkgFormatError
 from controlfiles import ControlFile, ChangelogFile
 
 
+# the fields of qbuild --query info: label, qpkg.cfg variable
+PACKAGE_FIELDS = (('Name', 'QPKG_NAME'),
+                  ('Version', 'QPKG_VER'),
+                  ('Packager', 'QPKG_AUTHOR'),
+                  ('License', 'QPKG_LICENSE'),
+                  ('Summary', 'QPKG_SUMMARY'))
+
+
+def package_info(path):
+    """Information of the .qpkg path as a dict, from its tail and the
+    qpkg.cfg of its control package; the data package is not read
+    """
+    from qpkgfile import QpkgReader, parse_cfg
+    with QpkgReader(path) as qpkg:
+        cfg = qpkg.read_control('qpkg.cfg').get('qpkg.cfg', '')
+        config = dict((k, v) for k, v in
+                      parse_cfg(cfg.splitlines(), strict=False).iteritems()
+                      if k.startswith(('QPKG_', 'QDK_')))
+        info = dict((label.lower(), config.get(var, ''))
+                    for label, var in PACKAGE_FIELDS)
+        info['license'] = info['license'] or 'Unknown'
+        info.update({'file': path,
+                     'size': qpkg.size,
+                     'model': qpkg.model,
+                     'fw_version': qpkg.fw_version,
+                     'data_compression': qpkg.data_compression,
+                     'signature': qpkg.signature is not None,
+                     'code_signing': qpkg.code_signing is not None,
+                     'config': config})
+    return info
+
+
 class CommandInfo(BaseCommand):
     key = 'info'
 
@@ -23,6 +57,12 @@ class CommandInfo(BaseCommand):
         parser.add_argument('--show-env', action='store_true',
                             default=False,
                             help='print environment')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print in JSON')
+        parser.add_argument('package', metavar='PACKAGE', nargs='?',
+                            help='show the information of a .qpkg file'
+                                 ' rather than of the source package;'
+                                 ' only its control package is read')
 
     @property
     def qpkg_dir(self):
@@ -84,7 +124,26 @@ class CommandInfo(BaseCommand):
             for k in sorted(os.environ):
                 self._klen = self._klen if self._klen > len(k) else len(k)
 
+    def print_package_file(self, package):
+        import tarfile
+        try:
+            info = package_info(package)
+        except (QpkgFormatError, IOError) as e:
+            error(str(e))
+            return -1
+        except tarfile.TarError as e:
+            error('{}: {}'.format(package, e))
+            return -1
+        if self._args.json:
+            print json.dumps(info, indent=2, sort_keys=True)
+            return 0
+        for label, _ in PACKAGE_FIELDS:
+            print '%-8s : %s' % (label, info[label.lower()])
+        return 0
+
     def run(self):
+        if self._args.package:
+            return self.print_package_file(self._args.package)
         if self.qpkg_dir is None:
             error('Cannot find QNAP/control anywhere!')
             error('Are you in the source code tree?')
@@ -95,6 +154,11 @@ class CommandInfo(BaseCommand):
 
         self._prepare()
 
+        if self._args.json:
+            print json.dumps({'source': self.cfile.source,
+                              'packages': self.cfile.packages},
+                             indent=2, sort_keys=True)
+            return 0
         self.print_source()
         self.print_all_packages()
         self.print_env()
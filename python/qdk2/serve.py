@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+from argparse import SUPPRESS
+from os.path import (join as pjoin,
+                     dirname as pdirname,
+                     realpath as prealpath,
+                     exists as pexists,
+                     )
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+
+from basecommand import BaseCommand
+from log import info, error
+from server import (STDOUT, STDERR, EXIT, REFUSED, ENCODING,
+                    socket_path, send, peer_uid)
+import settings
+
+
+def _run(argv):
+    # in a worker, with the environment of the client
+    from cli import main
+    settings.refresh()
+    return main(argv)
+
+
+class Server(object):
+    """Unix socket server forking a worker per command
+
+    The commands and their parser are imported once, before listening.
+    Every connection is handled by a fork, which forks the worker running
+    the command with the working directory, environment and umask of the
+    client, and relays the output of the worker and its exit status. The
+    daemon stops when the files of qdk2 change, so that a stale daemon
+    never runs a command, and after idle_timeout seconds without any.
+    """
+    def __init__(self, path, run, idle_timeout=None):
+        self._path = path
+        self._run = run
+        self._idle_timeout = idle_timeout
+        self._qdk2 = prealpath(sys.argv[0])
+        self._sources = self._scan_sources()
+
+    def serve(self):
+        listener = self._listen()
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        # remove the socket on kill too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            while True:
+                ready, _, _ = select.select([listener], [], [],
+                                            self._idle_timeout)
+                if not ready:
+                    return 0
+                try:
+                    conn, _ = listener.accept()
+                except socket.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                stale = self._scan_sources() != self._sources
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    self._handle(conn, stale)
+                conn.close()
+                if stale:
+                    return 0
+        finally:
+            listener.close()
+            if pexists(self._path):
+                os.unlink(self._path)
+
+    def _listen(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.connect(self._path)
+        except socket.error:
+            # left by a daemon which did not stop cleanly
+            if pexists(self._path):
+                os.unlink(self._path)
+        else:
+            raise OSError(errno.EADDRINUSE,
+                          'qdk2 serve already runs on ' + self._path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)
+        try:
+            listener.bind(self._path)
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        return listener
+
+    def _scan_sources(self):
+        python = pdirname(pdirname(prealpath(__file__)))
+        mtimes = [os.stat(self._qdk2).st_mtime]
+        for root, dirs, files in os.walk(python):
+            mtimes.extend(os.stat(pjoin(root, f)).st_mtime
+                          for f in files if f.endswith('.py'))
+        return max(mtimes)
+
+    def _handle(self, conn, stale):
+        # in the fork of a connection; never returns
+        code = 0
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            uid = peer_uid(conn)
+            request = json.loads(conn.makefile().readline())
+            if stale or uid != os.getuid() or \
+                    request['qdk2'].encode(ENCODING) != self._qdk2:
+                send(conn, REFUSED)
+            else:
+                send(conn, EXIT, str(self._relay(conn, request)))
+        except Exception:
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _relay(self, conn, request):
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            os.close(out_r)
+            os.close(err_r)
+            self._work(request, out_w, err_w)
+        try:
+            # as the worker does, in case it has not yet
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        os.close(out_w)
+        os.close(err_w)
+        channels = {out_r: STDOUT, err_r: STDERR}
+        while channels:
+            ready, _, _ = select.select(list(channels) + [conn], [], [])
+            if conn in ready and not conn.recv(1):
+                # the client is gone, e.g. Ctrl-C
+                os.killpg(pid, signal.SIGINT)
+                for fd in channels:
+                    os.close(fd)
+                break
+            for fd in ready:
+                if fd not in channels:
+                    continue
+                data = os.read(fd, 1 << 16)
+                if data:
+                    send(conn, channels[fd], data)
+                else:
+                    os.close(fd)
+                    del channels[fd]
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            return 128 + os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def _work(self, request, out_w, err_w):
+        # in the worker; never returns
+        code = 0
+        try:
+            os.setpgid(0, 0)
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            os.dup2(out_w, 1)
+            os.dup2(err_w, 2)
+            for fd in (null, out_w, err_w):
+                os.close(fd)
+            os.chdir(request['cwd'].encode(ENCODING))
+            os.umask(request['umask'])
+            # json gives unicode; commands expect str as from the command line
+            argv = [a.encode(ENCODING) for a in request['argv']]
+            os.environ.clear()
+            os.environ.update((k.encode(ENCODING), v.encode(ENCODING))
+                              for k, v in request['env'].iteritems())
+            sys.argv = sys.argv[:1] + argv
+            code = self._run(argv) or 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else \
+                int(e.code is not None)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+
+class CommandServe(BaseCommand):
+    key = 'serve'
+
+    @classmethod
+    def build_argparse(cls, subparser):
+        parser = subparser.add_parser(cls.key, help='run qdk2 commands for'
+                                                    ' clients on a Unix'
+                                                    ' socket')
+        parser.add_argument('--' + cls.key, help=SUPPRESS)
+        parser.add_argument('--socket', metavar='PATH',
+                            help='socket to listen on (default: $QDK2_SOCKET,'
+                                 ' else qdk2.sock in $XDG_RUNTIME_DIR or'
+                                 ' /tmp/qdk2-UID.sock)')
+        parser.add_argument('--idle-timeout', metavar='SECONDS', type=float,
+                            help='stop after SECONDS without a command')
+
+    def run(self):
+        from cli import parser
+        # what a worker would otherwise do for every command
+        parser()
+        path = self._args.socket or socket_path()
+        try:
+            server = Server(path, _run, self._args.idle_timeout)
+            info('Serving on {}; qdk2 commands run here until it stops'
+                 .format(path))
+            return server.serve()
+        except (OSError, IOError) as e:
+            error(str(e))
+            return -1
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
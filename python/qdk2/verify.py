@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from argparse import SUPPRESS
+from os import listdir
+from os.path import (join as pjoin,
+                     isdir as pisdir,
+                     )
+
+from basecommand import BaseCommand
+from log import error, info, warning
+from settings import cpu_count
+from exception import QpkgFormatError
+
+
+class CommandVerify(BaseCommand):
+    key = 'verify'
+
+    @classmethod
+    def build_argparse(cls, subparser):
+        parser = subparser.add_parser(cls.key, help='verify the signatures of'
+                                                    ' QNAP Apps (.qpkg)')
+        parser.add_argument('--' + cls.key, help=SUPPRESS)
+        parser.add_argument('--keyring', metavar='FILE',
+                            help='gpg public keyring'
+                                 ' (default: $QDK_GPG_PUBKEYRING or'
+                                 ' /etc/config/qpkg.gpg)')
+        parser.add_argument('--ca-cert', metavar='FILE', action='append',
+                            help='CA certificate of code signing, repeatable'
+                                 ' (default: the QNAP CAs of QDK)')
+        parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                            help='verify N packages at once'
+                                 ' (default: number of CPUs)')
+        parser.add_argument('--require-signature', action='store_true',
+                            default=False,
+                            help='fail for a package without any signature')
+        parser.add_argument('paths', metavar='PATH', nargs='+',
+                            help='.qpkg file, or directory of them')
+
+    def _packages(self):
+        for path in self._args.paths:
+            if pisdir(path):
+                for name in sorted(listdir(path)):
+                    if name.endswith('.qpkg'):
+                        yield pjoin(path, name)
+            else:
+                yield path
+
+    def run(self):
+        from multiprocessing.pool import ThreadPool
+        from qpkgverify import QpkgVerifier
+        verifier = QpkgVerifier(self._args.keyring, self._args.ca_cert)
+
+        def verify(package):
+            try:
+                return package, verifier.verify(package), None
+            except (QpkgFormatError, IOError, OSError) as e:
+                return package, None, e
+
+        packages = list(self._packages())
+        failed = 0
+        # hashing and gpg release the GIL: threads verify in parallel
+        pool = ThreadPool(max(1, min(self._args.jobs or cpu_count(),
+                                     len(packages))))
+        try:
+            for package, results, e in pool.imap(verify, packages):
+                if e is not None:
+                    error('{}: {}'.format(package, e))
+                    failed += 1
+                    continue
+                if not results:
+                    if self._args.require_signature:
+                        error('{}: no signature'.format(package))
+                        failed += 1
+                    else:
+                        warning('{}: no signature'.format(package))
+                for kind, ok, message in results:
+                    if ok:
+                        info('{}: {}: {}'.format(package, kind, message))
+                    else:
+                        error('{}: {}: {}'.format(package, kind, message))
+                        failed += 1
+        finally:
+            pool.close()
+            pool.join()
+        return 1 if failed else 0
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+from os import fstat
+from subprocess import Popen, PIPE
+import re
+import struct
+import tarfile
+import zlib
+
+from exception import QpkgFormatError
+
+
+# QDK area (see add_qdk_area_* in qbuild)
+QDK_AREA_TAG = 'QDK'
+QDK_AREA_SIGNATURE = 1
+QDK_AREA_CODE_SIGNING = 254
+QDK_AREA_EOF = 255
+QDK_AREA_ENTRY = struct.Struct('!BI')
+
+# [MODEL(10)|RESERVED(40)|FW_VERSION(10)|NAME(20)|VERSION(10)|FLAG(10)]
+TAIL_LEN = 100
+TAIL_FLAG = 'QNAPQPKG  '
+
+# the header script ends with this line; see get_content_size in qbuild
+HEADER_END_LINE = 'exit 1'
+HEADER_MAX = 1 << 20
+
+# NAME="value" of qpkg.cfg
+CFG_ASSIGN_REOBJ = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)=(?:"([^"`$\\]*)"|'
+                              r"'([^']*)'|([^\s\"'`$\\;&|]*))\s*(?:#.*)?$")
+
+GZIP_MAGIC = '\037\213'
+CHUNK = 1 << 16
+
+# magic -> compression of the data package
+MAGICS = ((GZIP_MAGIC, 'gz'),
+          ('BZh', 'bz2'),
+          ('\3757zXZ\0', 'xz'))
+
+
+def normalize(name):
+    """Member name without leading / and ./, e.g. usr/bin/foo
+    """
+    name = name.lstrip('/')
+    while name.startswith('./'):
+        name = name[2:].lstrip('/')
+    return '' if name == '.' else name.rstrip('/')
+
+
+def parse_cfg(lines, strict=True):
+    """The assignments of a qpkg.cfg as a dict
+
+    Only plain NAME="value" assignments are understood; anything that needs
+    a shell to be evaluated raises ValueError, or is skipped unless strict.
+    """
+    result = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        m = CFG_ASSIGN_REOBJ.match(line)
+        if m is None:
+            if strict:
+                raise ValueError(line)
+            continue
+        value = [v for v in m.groups()[1:] if v is not None][0]
+        result[m.group(1)] = value
+    return result
+
+
+class Section(object):
+    """Read-only, seekable file-like view of length bytes at offset of
+    fileobj; views of the same file may be read in turns
+    """
+    def __init__(self, fileobj, offset, length):
+        self._fileobj = fileobj
+        self.offset = offset
+        self.length = length
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self._pos + size > self.length:
+            size = self.length - self._pos
+        if size <= 0:
+            return ''
+        self._fileobj.seek(self.offset + self._pos)
+        data = self._fileobj.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.length
+        if pos < 0:
+            raise IOError('negative seek position {}'.format(pos))
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+
+class ChunkReader(object):
+    """File-like read() over an iterable of strings
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ''
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buf[self._pos:] + ''.join(self._chunks)
+            self._buf, self._pos = '', 0
+            return data
+        while len(self._buf) - self._pos < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf, self._pos = self._buf[self._pos:] + chunk, 0
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def gunzip(fileobj):
+    """Chunks of the gzip stream of fileobj, of one or more members as
+    ParallelGzipWriter writes; tarfile of Python 2 stops after the first
+    """
+    d = zlib.decompressobj(31)
+    pending = ''
+    while True:
+        data = pending or fileobj.read(CHUNK)
+        if not data:
+            return
+        out = d.decompress(data)
+        if out:
+            yield out
+        pending = d.unused_data
+        if pending:
+            if not GZIP_MAGIC.startswith(pending[:2]):
+                # not another member
+                return
+            d = zlib.decompressobj(31)
+
+
+class XzReader(object):
+    """Read through xz(1), fed by a file positioned at an .xz stream;
+    Python 2 has no lzma module. Input after the stream is ignored.
+    """
+    def __init__(self, fileobj):
+        self._proc = Popen(['xz', '-dc', '--single-stream'], stdin=fileobj,
+                           stdout=PIPE)
+        self._eof = False
+
+    def read(self, size=-1):
+        data = self._proc.stdout.read(size)
+        if not data:
+            self._eof = True
+        return data
+
+    def close(self):
+        if not self._eof and self._proc.poll() is None:
+            # not read to the end
+            self._proc.kill()
+        self._proc.stdout.close()
+        if self._proc.wait() != 0 and self._eof:
+            raise QpkgFormatError('xz failed: {}'.format(
+                self._proc.returncode))
+
+
+class QpkgReader(object):
+    """Sections of a .qpkg, read in place
+
+    The header script gives the offsets of the sections, as for
+    get_content_size in qbuild: the control package (a tar holding
+    control.tar.gz), the compressed data package and the optional extra
+    package. The optional QDK area follows them, then the 100-byte tail.
+    Nothing is copied; every section is a Section of the file.
+    """
+    SCRIPT_LEN_REOBJ = re.compile(r'^script_len=(\d+)\s*$')
+    OFFSET_REOBJ = re.compile(
+        r'^offset=(?:\$\(|`)\s*\S*expr\s+\$\{?(\w+)\}?\s*\+\s*(\d+)\s*'
+        r'(?:\)|`)\s*$')
+    DATA_FILE_REOBJ = re.compile(r'of=\S*/(data\.\S+)')
+
+    def __init__(self, path):
+        self.path = path
+        self._fileobj = open(path, 'rb')
+        self._pipes = []
+        try:
+            self.size = fstat(self._fileobj.fileno()).st_size
+            self._parse_header()
+            self._parse_tail()
+            self._parse_qdk_area()
+        except:
+            self._fileobj.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the file, and wait for the xz(1) of open_data()
+        """
+        self._fileobj.close()
+        while self._pipes:
+            self._pipes.pop().close()
+
+    @property
+    def header(self):
+        return self.section(0, self.script_len).read()
+
+    @property
+    def control(self):
+        return self.section(*self._sections[0])
+
+    @property
+    def data(self):
+        return self.section(*self._sections[1])
+
+    @property
+    def extra(self):
+        """The extra package, or None
+        """
+        if len(self._sections) < 3:
+            return None
+        return self.section(*self._sections[2])
+
+    @property
+    def signature(self):
+        """The gpg signature in the QDK area, or None
+        """
+        return self._area(QDK_AREA_SIGNATURE)
+
+    @property
+    def code_signing(self):
+        """The code signing digital signature in the QDK area, or None
+        """
+        return self._area(QDK_AREA_CODE_SIGNING)
+
+    @property
+    def data_compression(self):
+        """'gz', 'bz2' or 'xz', from the magic of the data package
+        """
+        magic = self.data.read(6)
+        for prefix, compression in MAGICS:
+            if magic.startswith(prefix):
+                return compression
+        raise QpkgFormatError('{}: unknown compression of the data'
+                              ' package'.format(self.path))
+
+    def section(self, offset, length):
+        return Section(self._fileobj, offset, length)
+
+    def open_control(self, stream=False):
+        """TarFile of control.tar.gz, read in one pass when stream is true
+        """
+        outer = tarfile.open(fileobj=self.control, mode='r:')
+        for member in outer:
+            if member.isfile():
+                return tarfile.open(fileobj=outer.extractfile(member),
+                                    mode='r|gz' if stream else 'r:gz')
+        raise QpkgFormatError('{}: empty control package'.format(self.path))
+
+    def read_control(self, *names):
+        """{name: content} of the files names of control.tar.gz, e.g.
+        qpkg.cfg; decompression stops once they are all found
+        """
+        wanted = set(normalize(name) for name in names)
+        found = {}
+        tar = self.open_control(stream=True)
+        for member in tar:
+            name = normalize(member.name)
+            if member.isfile() and name in wanted:
+                found[name] = tar.extractfile(member).read()
+                if len(found) == len(wanted):
+                    break
+        return found
+
+    def open_data(self, stream=True):
+        """TarFile of the data package, read in one pass when stream is
+        true; data packages in xz can only be streamed
+        """
+        compression = self.data_compression
+        if compression == 'gz' and stream:
+            return tarfile.open(fileobj=ChunkReader(gunzip(self.data)),
+                                mode='r|')
+        if compression != 'xz':
+            return tarfile.open(fileobj=self.data, mode='r{}{}'.format(
+                '|' if stream else ':', compression))
+        if not stream:
+            raise QpkgFormatError('{}: data package in xz can only be'
+                                  ' streamed'.format(self.path))
+        with open(self.path, 'rb') as f:
+            f.seek(self._sections[1][0])
+            xz = XzReader(f)
+        self._pipes.append(xz)
+        return tarfile.open(fileobj=xz, mode='r|')
+
+    def open_extra(self):
+        """TarFile of the extra package, or None
+        """
+        extra = self.extra
+        return None if extra is None else \
+            tarfile.open(fileobj=extra, mode='r:')
+
+    def _parse_header(self):
+        f = self._fileobj
+        f.seek(0)
+        self.script_len = None
+        self.data_file = None
+        values = {}
+        boundaries = []
+        while f.tell() < HEADER_MAX:
+            line = f.readline(HEADER_MAX)
+            if not line:
+                break
+            line = line.rstrip('\n')
+            if line == HEADER_END_LINE:
+                break
+            reobj = self.SCRIPT_LEN_REOBJ.match(line)
+            if reobj:
+                self.script_len = values['script_len'] = int(reobj.group(1))
+                boundaries.append(self.script_len)
+                continue
+            reobj = self.OFFSET_REOBJ.match(line)
+            if reobj and reobj.group(1) in values:
+                values['offset'] = values[reobj.group(1)] + \
+                    int(reobj.group(2))
+                boundaries.append(values['offset'])
+                continue
+            reobj = self.DATA_FILE_REOBJ.search(line)
+            if reobj and self.data_file is None:
+                self.data_file = reobj.group(1)
+        else:
+            line = None
+        if line != HEADER_END_LINE or len(boundaries) < 3:
+            raise QpkgFormatError('{}: this does not look like a QPKG'
+                                  .format(self.path))
+        self.content_size = boundaries[-1]
+        if self.content_size > self.size or \
+                boundaries != sorted(boundaries):
+            raise QpkgFormatError('{}: truncated or corrupt'
+                                  .format(self.path))
+        self._sections = [(a, b - a) for a, b in zip(boundaries,
+                                                     boundaries[1:])]
+
+    def _parse_tail(self):
+        """model, fw_version, name, version of the tail; None without the
+        QNAPQPKG flag
+        """
+        self.tail = None
+        self.model = self.fw_version = self.name = self.version = None
+        if self.size - self.content_size < TAIL_LEN:
+            return
+        tail = self.section(self.size - TAIL_LEN, TAIL_LEN).read()
+        if tail[-len(TAIL_FLAG):] != TAIL_FLAG:
+            return
+        self.tail = tail
+        self.model = tail[:10].strip()
+        self.fw_version = tail[50:60].strip()
+        self.name = tail[60:80].strip()
+        self.version = tail[80:90].strip()
+
+    def _parse_qdk_area(self):
+        """(type, offset, length) of the QDK area entries, in qdk_areas
+        """
+        self.qdk_areas = []
+        self.qdk_area_begin = self.qdk_area_end = None
+        end = self.size - (TAIL_LEN if self.tail else 0)
+        pos = self.content_size
+        if self.section(pos, len(QDK_AREA_TAG)).read() != QDK_AREA_TAG:
+            return
+        self.qdk_area_begin = pos
+        pos += len(QDK_AREA_TAG)
+        while pos < end:
+            entry = self.section(pos, QDK_AREA_ENTRY.size).read()
+            if entry[:1] == chr(QDK_AREA_EOF):
+                pos += 1
+                break
+            if len(entry) < QDK_AREA_ENTRY.size:
+                break
+            area, length = QDK_AREA_ENTRY.unpack(entry)
+            pos += QDK_AREA_ENTRY.size
+            if pos + length > end:
+                raise QpkgFormatError('{}: QDK area entry {} beyond the end'
+                                      .format(self.path, area))
+            self.qdk_areas.append((area, pos, length))
+            pos += length
+        self.qdk_area_end = pos
+
+    def _area(self, area):
+        for a, offset, length in self.qdk_areas:
+            if a == area:
+                return self.section(offset, length)
+        return None
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
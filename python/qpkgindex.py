@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+from os import makedirs, rename, unlink, fdopen
+from os.path import (exists as pexists,
+                     join as pjoin,
+                     )
+from bisect import bisect_right
+from cStringIO import StringIO
+from subprocess import Popen, PIPE
+from threading import Thread
+import bz2
+import ctypes
+import ctypes.util
+import json
+import struct
+import tarfile
+import tempfile
+import zlib
+
+from log import debug
+from settings import Settings
+from exception import QpkgFormatError
+from qpkgfile import (ChunkReader, XzReader, gunzip, normalize, GZIP_MAGIC,
+                      CHUNK)
+
+
+def _load_zlib():
+    try:
+        libz = ctypes.CDLL(ctypes.util.find_library('z'))
+    except OSError:
+        return None
+    if not hasattr(libz, 'inflatePrime'):
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    return libz
+
+
+_zlib = _load_zlib()
+
+# zlib.h
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+GZIP_WBITS = 31
+RAW_WBITS = -15
+WINSIZE = 32768
+
+# xz file format: stream header and footer
+XZ_MAGIC = '\3757zXZ\0'
+XZ_FOOTER_MAGIC = 'YZ'
+XZ_HEADER_LEN = 12
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+
+class _Inflater(object):
+    """inflate(3) of libz, for what the zlib module of Python 2 lacks:
+    stopping at the end of deflate blocks, and starting in the middle of
+    a stream given its bit offset and the 32K of output before it (see
+    examples/zran.c of zlib). The output goes through a circular window.
+    """
+    def __init__(self, wbits):
+        self.raw = wbits < 0
+        self._strm = _ZStream()
+        self._window = ctypes.create_string_buffer(WINSIZE)
+        self._input = None
+        ret = _zlib.inflateInit2_(ctypes.byref(self._strm), wbits,
+                                  _zlib.zlibVersion(),
+                                  ctypes.sizeof(_ZStream))
+        if ret != Z_OK:
+            raise QpkgFormatError('inflateInit2: {}'.format(ret))
+
+    def __del__(self):
+        if _zlib is not None:
+            _zlib.inflateEnd(ctypes.byref(self._strm))
+
+    @property
+    def avail_in(self):
+        return self._strm.avail_in
+
+    @property
+    def data_type(self):
+        return self._strm.data_type
+
+    def feed(self, data):
+        self._input = ctypes.create_string_buffer(data, len(data))
+        self._strm.next_in = ctypes.addressof(self._input)
+        self._strm.avail_in = len(data)
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """(return code, output)
+        """
+        if not self._strm.avail_out:
+            self._strm.next_out = ctypes.addressof(self._window)
+            self._strm.avail_out = WINSIZE
+        start = WINSIZE - self._strm.avail_out
+        ret = _zlib.inflate(ctypes.byref(self._strm), flush)
+        if ret < 0 and ret != Z_BUF_ERROR:
+            raise QpkgFormatError('inflate: {}'.format(self._strm.msg or ret))
+        end = WINSIZE - self._strm.avail_out
+        return ret, ctypes.string_at(ctypes.addressof(self._window) + start,
+                                     end - start)
+
+    def window(self):
+        """The last 32K of output, oldest first
+        """
+        raw = self._window.raw
+        left = self._strm.avail_out
+        return raw[WINSIZE - left:] + raw[:WINSIZE - left]
+
+    def prime(self, bits, value):
+        _zlib.inflatePrime(ctypes.byref(self._strm), bits, value)
+
+    def set_dictionary(self, window):
+        ret = _zlib.inflateSetDictionary(ctypes.byref(self._strm), window,
+                                         len(window))
+        if ret != Z_OK:
+            raise QpkgFormatError('inflateSetDictionary: {}'.format(ret))
+
+
+def _varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _pack_varint(value):
+    out = ''
+    while value >= 0x80:
+        out += chr(value & 0x7f | 0x80)
+        value >>= 7
+    return out + chr(value)
+
+
+def _crc32(data):
+    return struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+
+def _pad4(n):
+    return (n + 3) & ~3
+
+
+class MemberIndex(object):
+    """Random access to the members of the data package of a .qpkg
+
+    The index holds the offsets of the members in the uncompressed tar,
+    and for gzip, access points every SPAN bytes of output: the offset in
+    the compressed data, the bit offset there and the 32K of output before
+    it, as examples/zran.c of zlib does. Multi-member gzip, as written with
+    several threads, also gets an access point at every member. For xz the
+    index of the stream gives the blocks; each can be decompressed alone.
+    Reading a member then decompresses at most SPAN bytes more than the
+    member, or the xz blocks holding it; bzip2 is read from the start.
+
+    The index is made in one pass over the package and kept in the cache,
+    found by the MD5 of the package.
+    """
+    VERSION = 1
+    SPAN = 1 << 20
+
+    def __init__(self, qpkg, cache_path=None):
+        self._qpkg = qpkg
+        self._cache_path = pjoin(cache_path or Settings.CACHE_PATH,
+                                 'qpkg-index')
+        self._windows = None
+        self.compression = qpkg.data_compression
+        self.digest = self._digest(cache_path)
+        self._index = self._load()
+        if self._index is None:
+            self._index = self._build()
+        self._members = dict((name, (offset, end)) for name, offset, end
+                             in self._index['members'])
+
+    def names(self):
+        return [name for name, _, _ in self._index['members']]
+
+    def __contains__(self, name):
+        return normalize(name) in self._members
+
+    def open(self, name):
+        """TarFile holding only the member name, read in one pass, and its
+        TarInfo
+        """
+        name = normalize(name)
+        if name not in self._members:
+            raise KeyError(name)
+        start, end = self._members[name]
+        tar = tarfile.open(fileobj=ChunkReader(self._range(start, end)),
+                           mode='r|')
+        return tar, tar.next()
+
+    def extract(self, name, path):
+        tar, member = self.open(name)
+        tar.extract(member, path)
+        return member
+
+    def read(self, name):
+        tar, member = self.open(name)
+        f = tar.extractfile(member)
+        return None if f is None else f.read()
+
+    def _digest(self, cache_path):
+        from qbuild.digest import Digester, DigestCache
+        cache = DigestCache(cache_path)
+        try:
+            return Digester('md5', workers=1, cache=cache).hexdigests(
+                [self._qpkg.path])[0]
+        finally:
+            cache.close()
+
+    def _paths(self):
+        base = pjoin(self._cache_path, '{}-v{}'.format(self.digest,
+                                                       self.VERSION))
+        return base + '.json', base + '.windows'
+
+    def _load(self):
+        index_path, _ = self._paths()
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return None
+        debug('member index: {}'.format(index_path))
+        return index
+
+    def _build(self):
+        index = {'compression': self.compression, 'points': [], 'blocks': []}
+        windows = StringIO()
+        if self.compression == 'gz' and _zlib is not None:
+            output = self._gzip_output(index['points'], windows)
+        else:
+            if self.compression == 'xz':
+                index['blocks'] = self._xz_blocks()
+            output = self._sequential_output()
+        members = []
+        tar = tarfile.open(fileobj=ChunkReader(output), mode='r|')
+        for member in tar:
+            members.append((normalize(member.name), member.offset,
+                            member.offset_data + member.size))
+        index['members'] = members
+        self._windows = windows
+        self._store(index, windows.getvalue())
+        return index
+
+    def _store(self, index, windows):
+        index_path, windows_path = self._paths()
+        try:
+            if not pexists(self._cache_path):
+                makedirs(self._cache_path)
+            for path, write in ((windows_path, lambda f: f.write(windows)),
+                                (index_path, lambda f: json.dump(index, f))):
+                fd, tmp = tempfile.mkstemp(dir=self._cache_path)
+                try:
+                    with fdopen(fd, 'wb') as f:
+                        write(f)
+                    rename(tmp, path)
+                except:
+                    unlink(tmp)
+                    raise
+        except (IOError, OSError) as e:
+            # the index still serves this process
+            debug('member index not cached: {}'.format(e))
+
+    def _window(self, offset, length):
+        if self._windows is None:
+            with open(self._paths()[1], 'rb') as f:
+                f.seek(offset)
+                return zlib.decompress(f.read(length))
+        self._windows.seek(offset)
+        return zlib.decompress(self._windows.read(length))
+
+    def _range(self, start, end):
+        """Chunks of the uncompressed data from start to end
+        """
+        if self._index['points']:
+            chunks = self._gzip_range(start)
+            pos = self._index['points'][self._point(start)][2]
+        elif self._index['blocks']:
+            chunks, pos = self._xz_range(start, end)
+        else:
+            chunks, pos = self._sequential_output(), 0
+        for chunk in chunks:
+            if pos + len(chunk) > start:
+                yield chunk[max(0, start - pos):end - pos]
+            pos += len(chunk)
+            if pos >= end:
+                break
+        if pos < end:
+            raise QpkgFormatError('{}: truncated {} data package'.format(
+                self._qpkg.path, self.compression))
+
+    def _point(self, start):
+        outs = [point[2] for point in self._index['points']]
+        return bisect_right(outs, start) - 1
+
+    def _gzip_output(self, points, windows):
+        """Chunks of the uncompressed data; the access points go to points
+        as (offset, bits, uncompressed offset, window offset, window
+        length), the window offset being -1 at the start of a member
+        """
+        data = self._qpkg.data
+        data.seek(0)
+        inflater = _Inflater(GZIP_WBITS)
+        total_in = total_out = 0
+        points.append((0, 0, 0, -1, 0))
+        last = 0
+        while True:
+            if not inflater.avail_in:
+                chunk = data.read(CHUNK)
+                if not chunk:
+                    raise QpkgFormatError('{}: truncated gzip data package'
+                                          .format(self._qpkg.path))
+                inflater.feed(chunk)
+            avail_in = inflater.avail_in
+            ret, out = inflater.inflate(Z_BLOCK)
+            total_in += avail_in - inflater.avail_in
+            total_out += len(out)
+            if out:
+                yield out
+            if ret == Z_STREAM_END:
+                data.seek(total_in)
+                if data.read(2) != GZIP_MAGIC:
+                    return
+                # the next member of a multi-member gzip
+                data.seek(total_in)
+                inflater = _Inflater(GZIP_WBITS)
+                points.append((total_in, 0, total_out, -1, 0))
+                last = total_out
+            elif inflater.data_type & 128 and \
+                    not inflater.data_type & 64 and \
+                    total_out - last >= self.SPAN:
+                # at the end of a deflate block but the last
+                window = zlib.compress(inflater.window())
+                points.append((total_in, inflater.data_type & 7, total_out,
+                               windows.tell(), len(window)))
+                windows.write(window)
+                last = total_out
+
+    def _gzip_range(self, start):
+        offset, bits, _, window_offset, window_length = \
+            self._index['points'][self._point(start)]
+        data = self._qpkg.data
+        if window_offset < 0:
+            inflater = _Inflater(GZIP_WBITS)
+            data.seek(offset)
+        else:
+            inflater = _Inflater(RAW_WBITS)
+            data.seek(offset - (1 if bits else 0))
+            if bits:
+                inflater.prime(bits, ord(data.read(1)) >> (8 - bits))
+            inflater.set_dictionary(self._window(window_offset,
+                                                 window_length))
+        pos = offset
+        while True:
+            if not inflater.avail_in:
+                chunk = data.read(CHUNK)
+                if not chunk:
+                    return
+                inflater.feed(chunk)
+            avail_in = inflater.avail_in
+            ret, out = inflater.inflate()
+            pos += avail_in - inflater.avail_in
+            if out:
+                yield out
+            if ret == Z_STREAM_END:
+                # the next member, after the trailer of a raw stream
+                pos += 8 if inflater.raw else 0
+                data.seek(pos)
+                if data.read(2) != GZIP_MAGIC:
+                    return
+                data.seek(pos)
+                inflater = _Inflater(GZIP_WBITS)
+
+    def _sequential_output(self):
+        data = self._qpkg.data
+        data.seek(0)
+        if self.compression == 'xz':
+            with open(self._qpkg.path, 'rb') as f:
+                f.seek(data.offset)
+                xz = XzReader(f)
+            try:
+                for chunk in iter(lambda: xz.read(CHUNK), ''):
+                    yield chunk
+            finally:
+                xz.close()
+            return
+        if self.compression == 'gz':
+            for chunk in gunzip(data):
+                yield chunk
+            return
+        d = bz2.BZ2Decompressor()
+        for chunk in iter(lambda: data.read(CHUNK), ''):
+            try:
+                out = d.decompress(chunk)
+            except EOFError:
+                # after the end of the stream
+                return
+            if out:
+                yield out
+
+    def _xz_blocks(self):
+        """(offset, padded length, uncompressed offset, uncompressed
+        length) of the blocks of a single-stream xz data package
+        """
+        data = self._qpkg.data
+        size = data.length
+        data.seek(size - 12)
+        footer = data.read(12)
+        if footer[10:] != XZ_FOOTER_MAGIC:
+            # stream padding or an unusual stream; read from the start
+            return []
+        backward = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        data.seek(size - 12 - backward)
+        index = data.read(backward)
+        count, pos = _varint(index, 1)
+        records = []
+        for _ in xrange(count):
+            unpadded, pos = _varint(index, pos)
+            uncompressed, pos = _varint(index, pos)
+            records.append((unpadded, uncompressed))
+        blocks = []
+        offset, out = XZ_HEADER_LEN, 0
+        for unpadded, uncompressed in records:
+            blocks.append((offset, _pad4(unpadded), out, uncompressed,
+                           unpadded))
+            offset += _pad4(unpadded)
+            out += uncompressed
+        if offset != size - 12 - backward:
+            # concatenated streams
+            return []
+        return blocks
+
+    def _xz_range(self, start, end):
+        """Chunks from the blocks holding start to end, decompressed as a
+        stream of their own, and the uncompressed offset of the first
+        """
+        blocks = [b for b in self._index['blocks']
+                  if b[2] + b[3] > start and b[2] < end]
+        data = self._qpkg.data
+        data.seek(0)
+        header = data.read(XZ_HEADER_LEN)
+        flags = header[6:8]
+        index = '\0' + _pack_varint(len(blocks)) + ''.join(
+            _pack_varint(unpadded) + _pack_varint(uncompressed)
+            for _, _, _, uncompressed, unpadded in blocks)
+        index += '\0' * (_pad4(len(index)) - len(index))
+        index += _crc32(index)
+        backward = struct.pack('<I', len(index) // 4 - 1)
+        footer = _crc32(backward + flags) + backward + flags + XZ_FOOTER_MAGIC
+
+        proc = Popen(['xz', '-dc'], stdin=PIPE, stdout=PIPE)
+
+        def feed():
+            try:
+                proc.stdin.write(header)
+                section = self._qpkg.section(data.offset + blocks[0][0],
+                                             sum(b[1] for b in blocks))
+                for chunk in iter(lambda: section.read(CHUNK), ''):
+                    proc.stdin.write(chunk)
+                proc.stdin.write(index + footer)
+            except IOError:
+                # xz stopped reading, once the range was read
+                pass
+            finally:
+                proc.stdin.close()
+        feeder = Thread(target=feed)
+        feeder.daemon = True
+
+        def chunks():
+            feeder.start()
+            try:
+                for chunk in iter(lambda: proc.stdout.read(CHUNK), ''):
+                    yield chunk
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+                feeder.join()
+        return chunks(), blocks[0][2]
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+from os import devnull, fdopen, unlink
+from os.path import abspath as pabspath
+from subprocess import Popen, PIPE
+from mmap import mmap, ACCESS_READ
+import hashlib
+import tempfile
+
+from log import debug
+from settings import Settings
+from qpkgfile import QpkgReader, QDK_AREA_SIGNATURE, QDK_AREA_CODE_SIGNING
+
+
+# the signed range goes to the digest and to gpg in views of this size
+SLICE = 1 << 20
+# verify_code_signing_offline of qbuild falls back to the system CAs
+SYSTEM_CA_PATH = '/etc/ssl/certs/'
+
+GPG, CODE_SIGNING = 'gpg', 'code signing'
+
+
+class _TempFile(object):
+    """A temporary file holding data, removed on exit
+    """
+    def __init__(self, data):
+        fd, self.path = tempfile.mkstemp(prefix='qdk2-verify.')
+        with fdopen(fd, 'wb') as f:
+            f.write(data)
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, *exc_info):
+        unlink(self.path)
+
+
+class QpkgVerifier(object):
+    """Check the signatures in the QDK area of .qpkg files in process, as
+    verify_qpkg and verify_code_signing of qbuild do
+
+    The package is memory-mapped. The signed range, everything before the
+    QDK area, is read once in views of the mapping: each view updates the
+    SHA-1 that the code signing signature holds and is piped to gpg, without
+    copying. Only the signatures themselves are read out, for
+    gpg --verify and openssl cms -verify; the online verification of qbuild
+    against the code signing server is not done.
+    """
+    def __init__(self, keyring=None, ca_certs=None):
+        self._keyring = pabspath(keyring or Settings.GPG_PUBKEYRING)
+        self._ca_certs = ca_certs or Settings.CODE_SIGNING_CA_CERTS
+
+    def verify(self, path):
+        """[(kind, ok, message)] of the signatures of the .qpkg path, kind
+        being GPG or CODE_SIGNING; empty for a package without any
+        """
+        with QpkgReader(path) as qpkg:
+            end = qpkg.qdk_area_begin
+            areas = dict((area, (offset, length))
+                         for area, offset, length in qpkg.qdk_areas)
+        if end is None or not (set(areas) & set((QDK_AREA_SIGNATURE,
+                                                 QDK_AREA_CODE_SIGNING))):
+            return []
+        with open(path, 'rb') as f:
+            mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        try:
+            return self._verify(mm, end, areas)
+        finally:
+            mm.close()
+
+    def _verify(self, mm, end, areas):
+        results = []
+        sha1 = hashlib.sha1() if QDK_AREA_CODE_SIGNING in areas else None
+        sinks = [] if sha1 is None else [sha1.update]
+        if QDK_AREA_SIGNATURE in areas:
+            offset, length = areas[QDK_AREA_SIGNATURE]
+            with _TempFile(mm[offset:offset + length]) as sig:
+                results.append(self._gpg(mm, end, sig, sinks))
+        else:
+            self._read(mm, end, sinks)
+        if sha1 is not None:
+            offset, length = areas[QDK_AREA_CODE_SIGNING]
+            results.append(self._code_signing(mm[offset:offset + length],
+                                              sha1.digest()))
+        return results
+
+    def _read(self, mm, end, sinks):
+        for pos in xrange(0, end, SLICE):
+            view = buffer(mm, pos, min(SLICE, end - pos))
+            for sink in sinks:
+                sink(view)
+
+    def _gpg(self, mm, end, sig, sinks):
+        """verify_qpkg of qbuild: a detached signature of the signed range,
+        which gpg reads from its stdin
+        """
+        with open(devnull, 'w') as null:
+            gpg = Popen([Settings.GPG, '--batch', '--no-default-keyring',
+                         '--keyring', self._keyring, '--verify', sig, '-'],
+                        stdin=PIPE, stdout=null, stderr=PIPE)
+
+        def write(view):
+            if gpg.stdin.closed:
+                return
+            try:
+                gpg.stdin.write(view)
+            except IOError:
+                # gpg gave up, e.g. without the keyring
+                gpg.stdin.close()
+        try:
+            self._read(mm, end, sinks + [write])
+        finally:
+            if not gpg.stdin.closed:
+                gpg.stdin.close()
+            err = gpg.stderr.read()
+            gpg.wait()
+        if gpg.returncode == 0:
+            return GPG, True, 'Verification OK'
+        debug(err)
+        lines = err.strip().splitlines()
+        if not lines:
+            return GPG, False, 'Verification Failure'
+        last = lines[-1]
+        return GPG, False, last[5:] if last.startswith('gpg: ') else last
+
+    def _code_signing(self, signature, digest):
+        """verify_code_signing_offline of qbuild: the CMS signature holds the
+        SHA-1 of the signed range, and is checked against the QNAP CAs,
+        then the CAs of the system
+        """
+        checks = [('-CAfile', ca) for ca in self._ca_certs] + \
+            [('-purpose', 'any', '-CApath', SYSTEM_CA_PATH)]
+        with _TempFile(signature) as path:
+            for check in checks:
+                proc = Popen(['openssl', 'cms', '-verify', '-binary',
+                              '-in', path] + list(check),
+                             stdout=PIPE, stderr=PIPE)
+                out, err = proc.communicate()
+                debug('openssl cms -verify {}: {}'.format(
+                    ' '.join(check), proc.returncode))
+                if proc.returncode == 0 and out == digest:
+                    return CODE_SIGNING, True, \
+                        'verification successful ({})'.format(check[-1])
+        return CODE_SIGNING, False, 'verification failed'
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
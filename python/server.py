@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# The client half of qdk2 serve, and its protocol, is imported by bin/qdk2
+# before anything else; keep this module cheap to import, with the standard
+# library only.
+
+from os.path import (join as pjoin,
+                     realpath as prealpath,
+                     exists as pexists,
+                     )
+import os
+import struct
+import sys
+
+
+# commands which talk to the terminal are never forwarded
+INTERACTIVE = ('serve', 'edit', 'changelog', 'create')
+# frame: channel, payload length
+FRAME = struct.Struct('!cI')
+STDOUT, STDERR, EXIT, REFUSED = '1', '2', 'x', 'r'
+# argv, cwd and environment are byte strings in any encoding; latin-1 maps
+# every byte to a character, so they go through json unchanged
+ENCODING = 'latin-1'
+# linux/socket.h; not exported by the socket module of Python 2
+SO_PEERCRED = 17
+# struct ucred: pid, uid, gid
+PEERCRED = struct.Struct('3i')
+
+
+def socket_path():
+    """$QDK2_SOCKET, or qdk2.sock in $XDG_RUNTIME_DIR, or in /tmp
+    """
+    path = os.environ.get('QDK2_SOCKET')
+    if path:
+        return path
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and pexists(runtime):
+        return pjoin(runtime, 'qdk2.sock')
+    return '/tmp/qdk2-{}.sock'.format(os.getuid())
+
+
+def _command(argv):
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+
+def peer_uid(sock):
+    """uid of the process at the other end of the Unix socket sock
+    """
+    import socket
+    return PEERCRED.unpack(sock.getsockopt(
+        socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', SO_PEERCRED),
+        PEERCRED.size))[1]
+
+
+def _trusted(sock, path):
+    """Whether the daemon at sock runs as the user; the client sends it its
+    whole environment. Without SO_PEERCRED, the socket and its directory
+    must be the user's and writable by nobody else.
+    """
+    import socket
+    try:
+        return peer_uid(sock) == os.getuid()
+    except socket.error:
+        pass
+    for p in (path, os.path.dirname(os.path.abspath(path))):
+        st = os.lstat(p)
+        if st.st_uid != os.getuid() or st.st_mode & 0022:
+            return False
+    return True
+
+
+def send(sock, channel, data=''):
+    sock.sendall(FRAME.pack(channel, len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def forward(argv):
+    """Run argv in the qdk2 serve daemon; return its exit code, or None
+    when there is no daemon or it cannot run the command
+    """
+    path = socket_path()
+    if os.environ.get('QDK2_NO_SERVE') or _command(argv) in INTERACTIVE or \
+            not pexists(path):
+        return None
+    # socket takes milliseconds to import, with ssl
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    if not _trusted(sock, path):
+        sys.stderr.write('qdk2: {} is not served by you, run in process\n'
+                         .format(path))
+        sock.close()
+        return None
+    umask = os.umask(0)
+    os.umask(umask)
+    request = json.dumps({'argv': argv,
+                          'qdk2': prealpath(sys.argv[0]),
+                          'cwd': os.getcwd(),
+                          'env': dict(os.environ),
+                          'umask': umask}, encoding=ENCODING)
+    channel = None
+    try:
+        sock.sendall(request + '\n')
+        while True:
+            channel, length = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+            data = _recv_exactly(sock, length)
+            if channel == STDOUT:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif channel == STDERR:
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif channel == EXIT:
+                return int(data)
+            elif channel == REFUSED:
+                return None
+    except (socket.error, EOFError):
+        # the daemon died before the command started, or while it ran
+        return None if channel is None else 1
+    finally:
+        sock.close()
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
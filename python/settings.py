@@ -2,10 +2,11 @@
 
 
 import sys
-from os import getenv
+from os import getenv, sysconf
 from os.path import (join as pjoin,
                      dirname as pdirname,
                      abspath as pabspath,
+                     expanduser as pexpanduser,
                      )
 
 if sys.argv[0].startswith('/usr'):
@@ -19,6 +20,16 @@ else:
 VERSION = 'v0.10-1-g04d7ce1'
 
 
+def cpu_count():
+    # as multiprocessing.cpu_count does, without importing multiprocessing
+    # at the start of every command
+    try:
+        return max(1, sysconf('SC_NPROCESSORS_ONLN'))
+    except (ValueError, OSError):
+        from multiprocessing import cpu_count
+        return cpu_count()
+
+
 class Settings(object):
     DEBUG = False if getenv('DEBUG') is None else True
     QPKG_VERSION = '2.2'
@@ -30,6 +41,36 @@ class Settings(object):
     TEMPLATE_PATH = pjoin(PREFIX, 'template')
     TEMPLATE_V1_PATH = pjoin(PREFIX, QDK_BINARY, 'template')
     QBUILD = pjoin(PREFIX, QDK_BINARY, 'bin', 'qbuild')
+    QDK_SCRIPTS_PATH = pjoin(PREFIX, QDK_BINARY, 'scripts')
+    # as verify_qpkg and verify_code_signing_offline of qbuild
+    GPG = getenv('QDK_GPG_APP') or 'gpg'
+    GPG_PUBKEYRING = getenv('QDK_GPG_PUBKEYRING') or '/etc/config/qpkg.gpg'
+    CODE_SIGNING_CA_CERTS = (pjoin(QDK_SCRIPTS_PATH, 'ca_cert3'),
+                             getenv('QNAP_CA_CERT') or
+                             pjoin(QDK_SCRIPTS_PATH, 'ca_cert3_2'))
+    QDK_USER_CONFIG = getenv('QDK_USER_CONFIG_FILE') or \
+        pexpanduser('~/.qdkrc')
+    CACHE_PATH = getenv('QDK2_CACHE_DIR') or pexpanduser('~/.cache/qdk2')
+    HASH_WORKERS = int(getenv('QDK2_HASH_WORKERS') or cpu_count())
+    HASH_BUFSIZE = int(getenv('QDK2_HASH_BUFSIZE') or 1 << 20)
+    DIGEST_CACHE_ENTRIES = int(getenv('QDK2_DIGEST_CACHE_ENTRIES') or 500000)
+    ARTIFACT_CACHE_SIZE = int(getenv('QDK2_ARTIFACT_CACHE_SIZE') or 4 << 30)
+    RECIPE_CACHE_SIZE = int(getenv('QDK2_RECIPE_CACHE_SIZE') or 256 << 20)
+    # https://reproducible-builds.org/specs/source-date-epoch/
+    SOURCE_DATE_EPOCH = int(getenv('SOURCE_DATE_EPOCH')) \
+        if getenv('SOURCE_DATE_EPOCH') else None
+
+
+def refresh():
+    """Read Settings from the environment again, e.g. in a worker of qdk2
+    serve; the class is updated in place for the modules that imported it
+    """
+    settings = Settings
+    module = reload(sys.modules[__name__])
+    for k, v in vars(module.Settings).items():
+        if not k.startswith('__'):
+            setattr(settings, k, v)
+    module.Settings = settings
 
 
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
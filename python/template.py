@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+from os import stat
+from os.path import abspath as pabspath
+import re
+
+
+class Template(object):
+    """File with placeholders such as %QPKG_NAME% or @@PACKAGE@@
+
+    The file is split once by a single regex into literal text and
+    placeholder names; rendering writes the pieces out one by one instead of
+    calling str.replace for every variable on every line. Compiled
+    templates are kept per process and recompiled when the file changes.
+    Placeholders without a value are left as they are.
+    """
+    # Cook.controls: %QPKG_PACKAGE%, %QPKG_VERSION%, ...
+    QPKG = r'%(QPKG_\w+)%'
+    # templates of qdk2 import/create: @@PACKAGE@@, @@IMAGE_ID@@, ...
+    AT = r'@@(\w+)@@'
+
+    _compiled = {}
+    _regexes = {}
+
+    def __init__(self, path, pattern=QPKG):
+        self._path = pabspath(path)
+        self._pattern = pattern
+        self._tokens = self._compile()
+
+    def render(self, variables, fout):
+        """Write the template to the file object fout
+        """
+        fout.writelines(self._render(variables))
+
+    def render_file(self, variables, dest):
+        with open(dest, 'w') as fout:
+            self.render(variables, fout)
+
+    def _render(self, variables):
+        # tokens: text, placeholder, name, text, placeholder, name, ..., text
+        tokens = self._tokens
+        for i in xrange(0, len(tokens) - 1, 3):
+            yield tokens[i]
+            yield variables.get(tokens[i + 2], tokens[i + 1])
+        yield tokens[-1]
+
+    def _compile(self):
+        st = stat(self._path)
+        key = (self._path, self._pattern)
+        cached = self._compiled.get(key)
+        if cached is not None and cached[0] == (st.st_mtime, st.st_size):
+            return cached[1]
+        if self._pattern not in self._regexes:
+            self._regexes[self._pattern] = re.compile(
+                '(' + self._pattern + ')')
+        with open(self._path) as f:
+            tokens = self._regexes[self._pattern].split(f.read())
+        self._compiled[key] = ((st.st_mtime, st.st_size), tokens)
+        return tokens
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
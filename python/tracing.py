@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+from os import (getpid, write, close, open as os_open,
+                O_WRONLY, O_CREAT, O_TRUNC, O_APPEND,
+                )
+import json
+import resource
+import thread
+import time
+
+from settings import VERSION
+
+
+class Tracer(object):
+    """Spans of a build in the Chrome trace event format
+
+    Load the file in chrome://tracing or https://ui.perfetto.dev. Events are
+    appended to the file, one per line, as soon as they end, so that the
+    workers of a parallel build and the qbuild script (see trace_event in
+    qbuild, which gets the file in QDK_TRACE_FILE) can write to it too.
+    close() turns the lines into the final JSON object.
+    """
+    def __init__(self):
+        self._path = None
+        self._fd = None
+        self._pids = set()
+
+    @property
+    def path(self):
+        return self._path
+
+    def open(self, path):
+        self._path = path
+        self._fd = os_open(path, O_WRONLY | O_CREAT | O_TRUNC | O_APPEND, 0644)
+        self._pids = set()
+
+    def close(self):
+        if self._fd is None:
+            return
+        close(self._fd)
+        self._fd = None
+        with open(self._path) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        with open(self._path, 'w') as f:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'version': VERSION}}, f)
+
+    def environ(self, env):
+        """env for a subprocess writing to the trace
+        """
+        if self._fd is not None:
+            env['QDK_TRACE_FILE'] = self._path
+        return env
+
+    @contextmanager
+    def span(self, name, cat='build', **args):
+        """Trace the time spent in the block
+
+        The dict of args is yielded so that the block can add results, e.g.
+        the number of bytes processed. The peak RSS of the process and of
+        its waited-for children is added at the end.
+        """
+        if self._fd is None:
+            yield args
+            return
+        start = time.time()
+        try:
+            yield args
+        finally:
+            end = time.time()
+            args['max_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+            children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            if children:
+                args['children_max_rss_kb'] = children
+            self._event({'name': name, 'cat': cat, 'ph': 'X',
+                         'ts': self._us(start), 'dur': self._us(end - start),
+                         'args': args})
+            self._event({'name': 'max_rss_kb', 'ph': 'C',
+                         'ts': self._us(end),
+                         'args': {'self': args['max_rss_kb']}})
+
+    def _event(self, event):
+        pid = getpid()
+        if pid not in self._pids:
+            self._pids.add(pid)
+            self._write({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                         'args': {'name': 'qdk2 [{}]'.format(pid)}})
+        event['pid'] = pid
+        event['tid'] = thread.get_ident()
+        self._write(event)
+
+    def _write(self, event):
+        # a single write on an O_APPEND file is not interleaved with others
+        write(self._fd, json.dumps(event) + '\n')
+
+    def _us(self, seconds):
+        return int(seconds * 1000000)
+
+
+tracer = Tracer()
+span = tracer.span
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4